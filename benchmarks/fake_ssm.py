@@ -0,0 +1,273 @@
+"""Local stand-ins for the AWS side of a port forwarding session.
+
+FakeSessionManagerEndpoint is a websocket server that speaks the Session
+Manager agent protocol like the SSM agent does: it checks the token, runs
+the handshake, connects to the target host:port and relays data both ways.
+FakeSSMClient hands out sessions pointing at it, so InProcessForwarder can
+run end to end without AWS. EchoServer is the remote service.
+
+install_fake_aws() writes an ``aws`` executable that plays the aws CLI and
+session-manager-plugin for the CLI engine: it prints the plugin's output
+lines and relays its local port to the remote port on 127.0.0.1.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ssm_port_forwarder import SessionDataChannel, WebSocketClient  # noqa: E402
+
+# The agent reads from the remote host in chunks of the same size the plugin uses
+AGENT_READ_CHUNK = 1024
+# Seconds the fake aws CLI waits before opening its local port, like the plugin starting a session
+FAKE_AWS_LATENCY_VARIABLE = 'FAKE_AWS_SESSION_LATENCY'
+
+FAKE_AWS = '''#!{python}
+"""aws ssm start-session stand-in: prints the plugin output and relays local clients to the remote port"""
+import json, os, socket, sys, threading, time
+
+args = sys.argv[1:]
+parameters = json.loads(args[args.index("--parameters") + 1])
+port = int(parameters["localPortNumber"][0])
+remote_port = int(parameters["portNumber"][0])
+print("Starting session with SessionId: fake-session", flush=True)
+time.sleep(float(os.environ.get("{latency_variable}", "0")))
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(("127.0.0.1", port))
+server.listen(16)
+print(f"Port {{port}} opened for sessionId fake-session.", flush=True)
+print("Waiting for connections...", flush=True)
+
+def pipe(source, target):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            target.sendall(data)
+        target.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+def relay(client):
+    with client, socket.create_connection(("127.0.0.1", remote_port)) as remote:
+        for sock in (client, remote):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        upstream = threading.Thread(target=pipe, args=(client, remote), daemon=True)
+        upstream.start()
+        pipe(remote, client)
+        upstream.join()
+
+while True:
+    client, _ = server.accept()
+    print("Connection accepted for session [fake-session].", flush=True)
+    threading.Thread(target=relay, args=(client,), daemon=True).start()
+'''
+
+
+def install_fake_aws(bin_dir):
+    """Write the fake aws executable into bin_dir, returns its path"""
+    path = os.path.join(bin_dir, 'aws')
+    with open(path, 'w') as f:
+        f.write(FAKE_AWS.format(python=sys.executable, latency_variable=FAKE_AWS_LATENCY_VARIABLE))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class ServerWebSocket(WebSocketClient):
+    """Server side of a websocket connection: accepts the upgrade and sends unmasked frames"""
+    
+    @classmethod
+    async def accept(cls, reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        key = None
+        for line in request.split(b"\r\n"):
+            if line.lower().startswith(b"sec-websocket-key:"):
+                key = line.split(b":", 1)[1].strip()
+        if key is None:
+            writer.close()
+            raise ConnectionError("Not a websocket upgrade request")
+        accept = base64.b64encode(hashlib.sha1(key + cls.GUID).digest())
+        writer.write(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        await writer.drain()
+        websocket = cls(reader, writer)
+        websocket.write_lock = asyncio.Lock()
+        return websocket
+        
+    def frame(self, data, opcode=WebSocketClient.OPCODE_BINARY):
+        length = len(data)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        return header + data
+
+
+class EchoServer:
+    """TCP server that sends back everything it receives"""
+    
+    def __init__(self):
+        self.server = None
+        self.port = None
+        
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+        
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            
+    def close(self):
+        self.server.close()
+
+
+class FakeSessionManagerEndpoint:
+    """Websocket endpoint that behaves like the SSM agent side of a port session.
+    
+    latency adds a delay, in seconds, before every message the endpoint sends,
+    to model the round trip to the AWS region.
+    """
+    
+    def __init__(self, target_host, target_port, token='fake-token', latency=0.0):
+        self.target_host = target_host
+        self.target_port = target_port
+        self.token = token
+        self.latency = latency
+        self.server = None
+        self.port = None
+        self.stats = {'sessions': 0, 'messages_in': 0, 'messages_out': 0, 'acknowledged': 0}
+        
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+        
+    def stream_url(self, session_id):
+        return f"ws://127.0.0.1:{self.port}/v1/data-channel/{session_id}?role=publish_subscribe"
+        
+    def close(self):
+        self.server.close()
+        
+    async def handle(self, reader, writer):
+        websocket = await ServerWebSocket.accept(reader, writer)
+        opening = json.loads(await websocket.recv())
+        if opening.get('TokenValue') != self.token:
+            await websocket.close()
+            return
+        self.stats['sessions'] += 1
+        
+        sequence_number = 0
+        send_lock = asyncio.Lock()
+        
+        async def send_output(payload, payload_type):
+            nonlocal sequence_number
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            async with send_lock:
+                message = SessionDataChannel.encode_message(
+                    SessionDataChannel.OUTPUT_STREAM_DATA, payload, sequence_number, payload_type=payload_type
+                )
+                sequence_number += 1
+                await websocket.send(message)
+            self.stats['messages_out'] += 1
+            
+        await send_output(json.dumps({
+            'AgentVersion': '3.3.0.0',
+            'RequestedClientActions': [{
+                'ActionType': 'SessionType',
+                'ActionParameters': {'SessionType': 'Port', 'Properties': {}}
+            }]
+        }).encode(), SessionDataChannel.PAYLOAD_HANDSHAKE_REQUEST)
+        
+        target_writer = None
+        relay = None
+        try:
+            while True:
+                data = await websocket.recv()
+                if data is None:
+                    break
+                message = SessionDataChannel.decode_message(data)
+                if message['message_type'] == SessionDataChannel.ACKNOWLEDGE:
+                    self.stats['acknowledged'] += 1
+                    continue
+                self.stats['messages_in'] += 1
+                await websocket.send(SessionDataChannel.encode_message(
+                    SessionDataChannel.ACKNOWLEDGE,
+                    json.dumps({
+                        'AcknowledgedMessageType': message['message_type'],
+                        'AcknowledgedMessageId': message['message_id'],
+                        'AcknowledgedMessageSequenceNumber': message['sequence_number'],
+                        'IsSequentialMessage': True
+                    }).encode(),
+                    flags=3
+                ))
+                
+                payload_type = message['payload_type']
+                if payload_type == SessionDataChannel.PAYLOAD_HANDSHAKE_RESPONSE:
+                    target_reader, target_writer = await asyncio.open_connection(self.target_host, self.target_port)
+                    relay = asyncio.ensure_future(self.relay_target(target_reader, send_output))
+                    await send_output(b'{}', SessionDataChannel.PAYLOAD_HANDSHAKE_COMPLETE)
+                elif payload_type == SessionDataChannel.PAYLOAD_OUTPUT and target_writer is not None:
+                    target_writer.write(message['payload'])
+                    await target_writer.drain()
+                elif payload_type == SessionDataChannel.PAYLOAD_FLAG:
+                    break
+        finally:
+            if relay is not None:
+                relay.cancel()
+            if target_writer is not None:
+                target_writer.close()
+            await websocket.close()
+            
+    async def relay_target(self, target_reader, send_output):
+        while True:
+            data = await target_reader.read(AGENT_READ_CHUNK)
+            if not data:
+                return
+            await send_output(data, SessionDataChannel.PAYLOAD_OUTPUT)
+
+
+
+class FakeSSMClient:
+    """Stands in for a boto3 SSM client: start_session points at a FakeSessionManagerEndpoint"""
+    
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.calls = {'start_session': 0, 'terminate_session': 0}
+        
+    def start_session(self, **kwargs):
+        self.calls['start_session'] += 1
+        session_id = f"fake-{uuid.uuid4().hex[:17]}"
+        return {
+            'SessionId': session_id,
+            'StreamUrl': self.endpoint.stream_url(session_id),
+            'TokenValue': self.endpoint.token
+        }
+        
+    def terminate_session(self, SessionId):
+        self.calls['terminate_session'] += 1
+        return {'SessionId': SessionId}
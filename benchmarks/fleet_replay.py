@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+"""Offline replay of a large SSM fleet against the real discovery, auth and tunnel code.
+
+Builds a synthetic fleet, 10,000 instances over several profiles and regions
+by default, or loads one saved with --save-fleet, and answers every boto3
+request from it through botocore's before-send event. Paginators, response
+parsing, batching, threads and caches all run exactly as against AWS, with
+no network access and no credentials. A fake ``aws`` executable plays the
+aws CLI and session-manager-plugin for the CLI engine, and the fake Session
+Manager endpoint of fake_ssm.py serves the in-process engine.
+
+Latency profiles inject the delay of each API call, of the plugin opening
+its local port and of every data channel message. The run fails when the
+API call counts differ from what the fleet requires, when cached paths call
+AWS again, or when a time goes over its budget:
+
+    python benchmarks/fleet_replay.py --latency-profile region --max-discovery-ms 3000
+    python benchmarks/fleet_replay.py --save-fleet fleet.json --instances 2000
+    python benchmarks/fleet_replay.py --fleet fleet.json --compare replay.json --max-regression 0.25
+
+--latency-profile also takes a JSON file with the keys of LATENCY_PROFILES,
+plus "service.Operation" keys that override "api" for one operation.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ssm import FAKE_AWS_LATENCY_VARIABLE, EchoServer, FakeSessionManagerEndpoint, install_fake_aws  # noqa: E402
+from tunnel_bench import summarize  # noqa: E402
+from ssm_port_forwarder import (  # noqa: E402
+    AsyncPortForwarder, EC2_DESCRIBE_BATCH_SIZE, PortAllocator, SSM_DESCRIBE_PAGE_SIZE, SSM_INSTANCE_FILTER_BATCH,
+    SSMPortForwarder
+)
+
+# Seconds per API call ("api"), for the plugin to open its local port
+# ("session") and per data channel message sent by the agent ("rtt")
+LATENCY_PROFILES = {
+    'none': {'api': 0.0, 'session': 0.0, 'rtt': 0.0},
+    'lan': {'api': 0.002, 'session': 0.05, 'rtt': 0.001},
+    'region': {'api': 0.03, 'session': 0.5, 'rtt': 0.02},
+    'remote': {'api': 0.15, 'session': 1.5, 'rtt': 0.08},
+}
+DEFAULT_INSTANCES = 10000
+DEFAULT_PROFILES = 4
+DEFAULT_REGIONS = ['us-east-1', 'eu-west-1']
+DEFAULT_TUNNELS = 5
+# Page size of describe_instance_information when no page size is given
+SSM_DEFAULT_PAGE_SIZE = 10
+ROLES = ['web', 'worker', 'db', 'cache', 'bastion']
+ACCOUNT_BASE = 100000000000
+
+
+class SyntheticFleet:
+    """Instances by "profile|region" target, generated or loaded from a saved fleet file"""
+    
+    def __init__(self, targets):
+        self.targets = targets
+        
+    @classmethod
+    def generate(cls, instances, profiles, regions, seed=0, offline_ratio=0.05, hybrid_ratio=0.01):
+        rng = random.Random(seed)
+        keys = [f"replay-{index}|{region}" for index in range(profiles) for region in regions]
+        targets = {key: [] for key in keys}
+        for number in range(instances):
+            role = ROLES[number % len(ROLES)]
+            hybrid = rng.random() < hybrid_ratio
+            targets[keys[number % len(keys)]].append({
+                'id': f"{'mi' if hybrid else 'i'}-{number:017x}",
+                'name': f"{role}-{number:05d}",
+                'ip': f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}",
+                'ping': 'ConnectionLost' if rng.random() < offline_ratio else 'Online',
+                'last_ping': 1700000000 + rng.randrange(86400),
+                'launch_time': 1600000000 + number,
+                'tags': {'Name': f"{role}-{number:05d}", 'Role': role},
+            })
+        return cls(targets)
+        
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['targets'])
+            
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'targets': self.targets}, f)
+            
+    @property
+    def profiles(self):
+        return sorted({key.split('|')[0] for key in self.targets})
+        
+    @property
+    def regions(self):
+        return sorted({key.split('|')[1] for key in self.targets})
+        
+    def find(self, profile, region):
+        return self.targets.get(f"{profile}|{region}", [])
+        
+    def online(self, profile=None, region=None):
+        keys = [f"{profile}|{region}"] if profile else list(self.targets)
+        return [i for key in keys for i in self.targets.get(key, []) if i['ping'] == 'Online']
+        
+    def expected_discovery_calls(self):
+        """API calls a cold discovery of every target needs"""
+        calls = {'ssm.DescribeInstanceInformation': 0, 'ec2.DescribeInstances': 0}
+        for key in self.targets:
+            online = self.online(*key.split('|'))
+            ec2_ids = [i for i in online if i['id'].startswith('i-')]
+            calls['ssm.DescribeInstanceInformation'] += max(1, math.ceil(len(online) / SSM_DESCRIBE_PAGE_SIZE))
+            calls['ec2.DescribeInstances'] += math.ceil(len(ec2_ids) / EC2_DESCRIBE_BATCH_SIZE)
+        return {operation: count for operation, count in calls.items() if count}
+        
+    def expected_lookup_calls(self, profile, region, role):
+        """API calls lookup_target needs for a Role tag selector"""
+        candidates = [i for i in self.find(profile, region) if i['id'].startswith('i-') and i['tags']['Role'] == role]
+        pages = sum(
+            max(1, math.ceil(min(SSM_INSTANCE_FILTER_BATCH, len(candidates) - start) / SSM_DESCRIBE_PAGE_SIZE))
+            for start in range(0, len(candidates), SSM_INSTANCE_FILTER_BATCH)
+        )
+        calls = {'ec2.DescribeInstances': 1}
+        if pages:
+            calls['ssm.DescribeInstanceInformation'] = pages
+        return calls
+
+
+class ReplayBody:
+    """Raw HTTP body for botocore's AWSResponse"""
+    
+    def __init__(self, data):
+        self.data = data
+        
+    def stream(self, **kwargs):
+        yield self.data
+
+
+class FleetReplay:
+    """Answer boto3 requests from a SyntheticFleet, counting calls and injecting latency.
+    
+    Register handle() for botocore's before-send event. The profile of a
+    request is found from its access key, so every profile of the fleet
+    needs the credentials written by write_aws_config().
+    """
+    
+    CREDENTIAL_PATTERN = re.compile(r'Credential=([^/]+)/\d+/([^/]+)/')
+    
+    def __init__(self, fleet, latency):
+        self.fleet = fleet
+        self.latency = latency
+        self.endpoint = None
+        self.access_keys = {f"REPLAY{index:012d}": profile for index, profile in enumerate(fleet.profiles)}
+        self.calls = {}
+        self.sessions = set()
+        self.lock = threading.Lock()
+        
+    def take_calls(self):
+        """Get the API calls counted since the last time, by "service.Operation\""""
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return calls
+        
+    def write_aws_config(self, config_file, credentials_file):
+        with open(config_file, 'w') as f:
+            for profile in self.fleet.profiles:
+                f.write(f"[profile {profile}]\nregion = {self.fleet.regions[0]}\n\n")
+        with open(credentials_file, 'w') as f:
+            for access_key, profile in self.access_keys.items():
+                f.write(f"[{profile}]\naws_access_key_id = {access_key}\naws_secret_access_key = replay\n\n")
+                
+    def handle(self, request, event_name, **kwargs):
+        from botocore.awsrequest import AWSResponse, HeadersDict
+        
+        _, service, operation = event_name.split('.')
+        key = f"{service}.{operation}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+        delay = self.latency.get(key, self.latency['api'])
+        if delay:
+            time.sleep(delay)
+            
+        authorization = request.headers.get('Authorization', b'')
+        if isinstance(authorization, bytes):
+            authorization = authorization.decode()
+        access_key, region = self.CREDENTIAL_PATTERN.search(authorization).groups()
+        profile = self.access_keys[access_key]
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+            
+        handler = getattr(self, f"{service}_{operation}".replace('-', '_'), None)
+        if handler is None:
+            raise NotImplementedError(f"No replay for {key}")
+        status, content_type, data = handler(profile, region, body)
+        return AWSResponse(request.url, status, HeadersDict({'Content-Type': content_type}), ReplayBody(data))
+        
+    def ssm_DescribeInstanceInformation(self, profile, region, body):
+        params = json.loads(body or b'{}')
+        instances = self.fleet.find(profile, region)
+        for condition in params.get('Filters', []):
+            if condition['Key'] == 'PingStatus':
+                instances = [i for i in instances if i['ping'] in condition['Values']]
+            elif condition['Key'] == 'InstanceIds':
+                ids = set(condition['Values'])
+                instances = [i for i in instances if i['id'] in ids]
+        start = int(params.get('NextToken') or 0)
+        end = start + params.get('MaxResults', SSM_DEFAULT_PAGE_SIZE)
+        result = {'InstanceInformationList': [{
+            'InstanceId': i['id'],
+            'PingStatus': i['ping'],
+            'LastPingDateTime': i['last_ping'],
+            'PlatformType': 'Linux',
+            'IPAddress': i['ip'],
+            'ComputerName': i['name'],
+        } for i in instances[start:end]]}
+        if end < len(instances):
+            result['NextToken'] = str(end)
+        return 200, 'application/x-amz-json-1.1', json.dumps(result).encode()
+        
+    def ssm_StartSession(self, profile, region, body):
+        session_id = f"replay-{time.time_ns()}"
+        with self.lock:
+            self.sessions.add(session_id)
+        return 200, 'application/x-amz-json-1.1', json.dumps({
+            'SessionId': session_id,
+            'StreamUrl': self.endpoint.stream_url(session_id),
+            'TokenValue': self.endpoint.token,
+        }).encode()
+        
+    def ssm_TerminateSession(self, profile, region, body):
+        session_id = json.loads(body)['SessionId']
+        with self.lock:
+            self.sessions.discard(session_id)
+        return 200, 'application/x-amz-json-1.1', json.dumps({'SessionId': session_id}).encode()
+        
+    def ec2_DescribeInstances(self, profile, region, body):
+        params = parse_qsl(body.decode())
+        instances = [i for i in self.fleet.find(profile, region) if i['id'].startswith('i-')]
+        ids = [value for name, value in params if name.startswith('InstanceId.')]
+        if ids:
+            by_id = {i['id']: i for i in instances}
+            missing = [instance_id for instance_id in ids if instance_id not in by_id]
+            if missing:
+                return 400, 'text/xml', (
+                    "<Response><Errors><Error><Code>InvalidInstanceID.NotFound</Code>"
+                    f"<Message>The instance IDs '{', '.join(missing)}' do not exist</Message></Error></Errors>"
+                    "<RequestID>replay</RequestID></Response>"
+                ).encode()
+            instances = [by_id[instance_id] for instance_id in ids]
+        fields = dict(params)
+        for index in range(1, 100):
+            name = fields.get(f"Filter.{index}.Name")
+            if name is None:
+                break
+            values = {value for key, value in params if key.startswith(f"Filter.{index}.Value.")}
+            if name.startswith('tag:'):
+                instances = [i for i in instances if i['tags'].get(name[4:]) in values]
+            elif name == 'instance-state-name' and 'running' not in values:
+                instances = []
+                
+        items = "".join(
+            f"<item><instanceId>{i['id']}</instanceId><privateIpAddress>{i['ip']}</privateIpAddress>"
+            f"<launchTime>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(i['launch_time']))}</launchTime>"
+            "<instanceState><code>16</code><name>running</name></instanceState><tagSet>"
+            + "".join(f"<item><key>{escape(k)}</key><value>{escape(v)}</value></item>" for k, v in i['tags'].items())
+            + "</tagSet></item>"
+            for i in instances
+        )
+        reservations = f"<item><reservationId>r-replay</reservationId><instancesSet>{items}</instancesSet></item>" \
+            if instances else ""
+        return 200, 'text/xml', (
+            '<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+            f"<requestId>replay</requestId><reservationSet>{reservations}</reservationSet>"
+            "</DescribeInstancesResponse>"
+        ).encode()
+        
+    def sts_GetCallerIdentity(self, profile, region, body):
+        account = ACCOUNT_BASE + self.fleet.profiles.index(profile)
+        return 200, 'text/xml', (
+            '<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/"><GetCallerIdentityResult>'
+            f"<Arn>arn:aws:iam::{account}:user/replay</Arn><UserId>REPLAY</UserId><Account>{account}</Account>"
+            "</GetCallerIdentityResult><ResponseMetadata><RequestId>replay</RequestId></ResponseMetadata>"
+            "</GetCallerIdentityResponse>"
+        ).encode()
+
+
+class ReplayForwarder(SSMPortForwarder):
+    """SSMPortForwarder whose boto3 sessions are answered by a FleetReplay"""
+    
+    def __init__(self, replay):
+        super().__init__()
+        self.replay = replay
+        
+    def get_session(self, profile):
+        session = super().get_session(profile)
+        session.events.register('before-send', self.replay.handle, unique_id='fleet-replay')
+        return session
+
+
+def load_latency_profile(value):
+    """Get a latency profile by name, or from a JSON file"""
+    if value in LATENCY_PROFILES:
+        return dict(LATENCY_PROFILES[value])
+    with open(value, 'r') as f:
+        return dict(LATENCY_PROFILES['none'], **json.load(f))
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, round((time.perf_counter() - started) * 1000, 3)
+
+
+async def open_and_echo(api, replay, connection, name, engine):
+    """Milliseconds from opening a tunnel to the first byte echoed through it"""
+    started = time.perf_counter()
+    tunnel = await api.open_tunnel(connection, name, engine)
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', tunnel.local_port)
+        writer.write(b"!")
+        await writer.drain()
+        await reader.readexactly(1)
+        elapsed = time.perf_counter() - started
+        writer.close()
+        await writer.wait_closed()
+        # Let the session end, and be terminated, before the tunnel goes away
+        deadline = time.perf_counter() + 5
+        while (tunnel.stats['clients'] or replay.sessions) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        return elapsed
+    finally:
+        await tunnel.close()
+
+
+async def measure_startup(forwarder, replay, connections, latency):
+    """Open the tunnels with each engine at the same time, returns setup times and API calls per engine"""
+    echo = await EchoServer().start()
+    replay.endpoint = await FakeSessionManagerEndpoint('127.0.0.1', echo.port, latency=latency['rtt']).start()
+    results = {}
+    try:
+        async with AsyncPortForwarder(forwarder) as api:
+            for engine in ('cli', 'python'):
+                tunnels = [dict(connection, remote_port=str(echo.port), local_port=str(PortAllocator.ephemeral()))
+                           for connection in connections]
+                samples = await asyncio.gather(*(
+                    open_and_echo(api, replay, tunnel, f"{engine}-{index}", engine) for index, tunnel in enumerate(tunnels)
+                ))
+                results[engine] = {'setup_ms': summarize(samples), 'calls': replay.take_calls()}
+    finally:
+        replay.endpoint.close()
+        echo.close()
+    return results
+
+
+def run(args, fleet, latency, work_dir):
+    replay = FleetReplay(fleet, latency)
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    install_fake_aws(bin_dir)
+    replay.write_aws_config(os.path.join(work_dir, 'config'), os.path.join(work_dir, 'credentials'))
+    for variable in ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_DEFAULT_REGION', 'AWS_ACCESS_KEY_ID',
+                     'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        os.environ.pop(variable, None)
+    os.environ.update({
+        'HOME': work_dir,
+        'AWS_CONFIG_FILE': os.path.join(work_dir, 'config'),
+        'AWS_SHARED_CREDENTIALS_FILE': os.path.join(work_dir, 'credentials'),
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        FAKE_AWS_LATENCY_VARIABLE: str(latency['session']),
+        'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+    })
+    
+    forwarder = ReplayForwarder(replay)
+    profiles, regions = fleet.profiles, fleet.regions
+    results = {'fleet': {
+        'instances': sum(len(instances) for instances in fleet.targets.values()),
+        'online': len(fleet.online()),
+        'profiles': len(profiles),
+        'targets': len(fleet.targets),
+    }}
+    
+    instances, cold_ms = timed(forwarder.discover_instances, profiles, regions)
+    cold_calls = replay.take_calls()
+    _, warm_ms = timed(forwarder.discover_instances, profiles, regions)
+    results['discovery'] = {
+        'instances': len(instances),
+        'cold_ms': cold_ms,
+        'warm_ms': warm_ms,
+        'calls': cold_calls,
+        'expected_calls': fleet.expected_discovery_calls(),
+        'warm_calls': replay.take_calls(),
+    }
+    
+    async def authenticate():
+        async with AsyncPortForwarder(forwarder) as api:
+            return await asyncio.gather(*(api.ensure_auth(profile) for profile in profiles))
+            
+    authenticated, cold_ms = timed(asyncio.run, authenticate())
+    cold_calls = replay.take_calls()
+    _, warm_ms = timed(asyncio.run, authenticate())
+    results['auth'] = {
+        'authenticated': sum(authenticated),
+        'cold_ms': cold_ms,
+        'warm_ms': warm_ms,
+        'calls': cold_calls,
+        'expected_calls': {'sts.GetCallerIdentity': len(profiles)},
+        'warm_calls': replay.take_calls(),
+    }
+    
+    selector = {'profile': profiles[0], 'region': regions[0], 'target': 'Role=bastion'}
+    resolved, cold_ms = timed(forwarder.resolve_target, selector)
+    cold_calls = replay.take_calls()
+    _, warm_ms = timed(forwarder.resolve_target, selector)
+    results['resolve'] = {
+        'instance_id': resolved['instance_id'],
+        'cold_ms': cold_ms,
+        'warm_ms': warm_ms,
+        'calls': cold_calls,
+        'expected_calls': fleet.expected_lookup_calls(profiles[0], regions[0], 'bastion'),
+        'warm_calls': replay.take_calls(),
+    }
+    
+    online = [i for i in fleet.online(profiles[0], regions[0]) if i['id'].startswith('i-')]
+    connections = [{
+        'profile': profiles[0],
+        'region': regions[0],
+        'instance_id': online[index % len(online)]['id'],
+        'remote_host': '127.0.0.1',
+    } for index in range(args.tunnels)]
+    results['startup'] = asyncio.run(measure_startup(forwarder, replay, connections, latency))
+    return results
+
+
+def check(results, args):
+    """List the failed call count checks and budgets"""
+    failures = []
+    if results['discovery']['instances'] != results['fleet']['online']:
+        failures.append(f"discovery found {results['discovery']['instances']} of {results['fleet']['online']} "
+                        "online instances")
+    if results['auth']['authenticated'] != results['fleet']['profiles']:
+        failures.append(f"{results['auth']['authenticated']} of {results['fleet']['profiles']} profiles authenticated")
+    for phase in ('discovery', 'auth', 'resolve'):
+        if results[phase]['calls'] != results[phase]['expected_calls']:
+            failures.append(f"{phase} made {results[phase]['calls']} API calls, "
+                            f"expected {results[phase]['expected_calls']}")
+        if results[phase]['warm_calls']:
+            failures.append(f"cached {phase} made API calls: {results[phase]['warm_calls']}")
+    python_calls = results['startup']['python']['calls']
+    if python_calls.get('ssm.StartSession') != args.tunnels:
+        failures.append(f"in-process tunnels started {python_calls.get('ssm.StartSession', 0)} sessions, "
+                        f"expected {args.tunnels}")
+                        
+    budgets = [
+        ('discovery', results['discovery']['cold_ms'], args.max_discovery_ms),
+        ('auth', results['auth']['cold_ms'], args.max_auth_ms),
+        ('cli startup p99', results['startup']['cli']['setup_ms']['p99'], args.max_startup_ms),
+        ('python startup p99', results['startup']['python']['setup_ms']['p99'], args.max_startup_ms),
+    ]
+    for phase, elapsed_ms, budget_ms in budgets:
+        if budget_ms is not None and elapsed_ms > budget_ms:
+            failures.append(f"{phase} took {elapsed_ms} ms, budget {budget_ms} ms")
+    return failures
+
+
+def regressions(current, saved, max_regression):
+    """List the timings that got worse than saved by more than max_regression"""
+    failures = []
+    for phase in ('discovery', 'auth', 'resolve'):
+        if current[phase]['cold_ms'] > saved[phase]['cold_ms'] * (1 + max_regression):
+            failures.append(f"{phase} {current[phase]['cold_ms']} ms > {saved[phase]['cold_ms']} ms")
+    for engine in ('cli', 'python'):
+        now, before = current['startup'][engine]['setup_ms'], saved['startup'][engine]['setup_ms']
+        if now['p50'] > before['p50'] * (1 + max_regression):
+            failures.append(f"{engine} startup p50 {now['p50']} ms > {before['p50']} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a synthetic SSM fleet against discovery, auth and tunnels")
+    parser.add_argument('--instances', type=int, default=DEFAULT_INSTANCES, help='Instances of the generated fleet')
+    parser.add_argument('--profiles', type=int, default=DEFAULT_PROFILES, help='Profiles of the generated fleet')
+    parser.add_argument('--regions', default=",".join(DEFAULT_REGIONS), help='Regions of the generated fleet')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated fleet')
+    parser.add_argument('--fleet', metavar='FILE', help='Replay a fleet saved with --save-fleet instead')
+    parser.add_argument('--save-fleet', metavar='FILE', help='Write the fleet to a file and exit')
+    parser.add_argument('--latency-profile', default='none',
+                        help=f"One of {', '.join(LATENCY_PROFILES)}, or a JSON file")
+    parser.add_argument('--tunnels', type=int, default=DEFAULT_TUNNELS, help='Tunnels opened at once per engine')
+    parser.add_argument('--max-discovery-ms', type=float, help='Budget of a cold discovery of the whole fleet')
+    parser.add_argument('--max-auth-ms', type=float, help='Budget of authenticating every profile')
+    parser.add_argument('--max-startup-ms', type=float, help='Budget of the p99 time to a working tunnel')
+    parser.add_argument('--output', metavar='FILE', help='Also write the JSON results to a file')
+    parser.add_argument('--compare', metavar='FILE', help='Fail on regressions against saved JSON results')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Allowed relative regression for --compare')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the code under test')
+    args = parser.parse_args()
+    
+    if args.fleet:
+        fleet = SyntheticFleet.load(args.fleet)
+    else:
+        regions = [region.strip() for region in args.regions.split(',') if region.strip()]
+        fleet = SyntheticFleet.generate(args.instances, args.profiles, regions, args.seed)
+    if args.save_fleet:
+        fleet.save(args.save_fleet)
+        print(f"Saved {sum(len(i) for i in fleet.targets.values())} instances to {args.save_fleet}")
+        return 0
+    latency = load_latency_profile(args.latency_profile)
+    
+    work_dir = tempfile.mkdtemp(prefix='fleet-replay-')
+    environ = dict(os.environ)
+    try:
+        output = sys.stdout if args.verbose else io.StringIO()
+        with redirect_stdout(output):
+            results = run(args, fleet, latency, work_dir)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results['parameters'] = {'latency_profile': latency, 'tunnels': args.tunnels, 'fleet': args.fleet,
+                             'seed': None if args.fleet else args.seed}
+    results['host'] = {'python': platform.python_version(), 'platform': platform.platform()}
+    results['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            
+    failures = check(results, args)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            failures += regressions(results, json.load(f), args.max_regression)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
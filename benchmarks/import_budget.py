@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Startup budget check for ssm_port_forwarder.
+
+Imports the module under ``python -X importtime`` and fails when it pulls in
+a heavy dependency at import time or when its cumulative import time goes
+over the budget. Run it from the repository root:
+
+    python benchmarks/import_budget.py --budget-ms 100
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Dependencies that must only load on the code paths that use them
+LAZY_MODULES = ['boto3', 'botocore', 'cryptography', 'tabulate', 'inquirer', 'webbrowser', 'concurrent.futures']
+DEFAULT_BUDGET_MS = 100
+DEFAULT_RUNS = 5
+
+
+def measure_import(repo_dir):
+    """Import the module once, returns (cumulative microseconds, imported module names)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import ssm_port_forwarder"],
+        cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+    )
+    cumulative = None
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "ssm_port_forwarder":
+            cumulative = int(cumulative_us)
+    return cumulative, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time budget of ssm_port_forwarder")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum cumulative import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help='Imports to run, the fastest one is kept')
+    args = parser.parse_args()
+    
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    modules = set()
+    for _ in range(args.runs):
+        cumulative, imported = measure_import(repo_dir)
+        timings.append(cumulative)
+        modules |= imported
+        
+    failed = False
+    eager = [lazy for lazy in LAZY_MODULES if any(m == lazy or m.startswith(lazy + ".") for m in modules)]
+    if eager:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(eager)}")
+        failed = True
+        
+    best_ms = min(timings) / 1000
+    print(f"Import time: {best_ms:.1f} ms (best of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    if best_ms > args.budget_ms:
+        print("FAIL: import time is over budget")
+        failed = True
+        
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
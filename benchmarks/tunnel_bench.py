@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""Throughput and latency benchmark for forwarded ports.
+
+Runs the in-process engine (InProcessForwarder) against a local echo server
+through a fake Session Manager endpoint, and the same traffic straight to the
+echo server as a baseline. The aws CLI engine (LazyTunnel) is measured too,
+with the fake aws executable of fake_ssm.py in place of the aws CLI and
+session-manager-plugin, including the time to start a session. Results are
+printed as JSON:
+
+    python benchmarks/tunnel_bench.py --output bench.json
+    python benchmarks/tunnel_bench.py --compare bench.json --max-regression 0.25
+
+With --standby N the forwarder keeps N pre-established sessions, to measure
+the setup time saved by claiming one. With --compare the run fails when throughput drops, or latency or connection
+setup time grow, by more than --max-regression relative to the saved results.
+
+The cost of each engine is measured by running it alone in a child process
+for one more bulk transfer: CPU seconds per MB echoed and peak RSS of that
+process, plus those of the fake aws executable for the CLI engine (a Python
+stand-in, so its numbers say little about the real session-manager-plugin).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ssm import EchoServer, FakeSessionManagerEndpoint, FakeSSMClient, install_fake_aws  # noqa: E402
+from ssm_port_forwarder import InProcessForwarder, LazyTunnel  # noqa: E402
+
+DEFAULT_BULK_MB = 8
+DEFAULT_ROUND_TRIPS = 500
+DEFAULT_CONNECTIONS = 20
+DEFAULT_SESSIONS = 5
+SMALL_MESSAGE = b"x" * 64
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples_s):
+    """p50/p99/mean of durations, in milliseconds"""
+    return {
+        'p50': round(percentile(samples_s, 0.50) * 1000, 3),
+        'p99': round(percentile(samples_s, 0.99) * 1000, 3),
+        'mean': round(sum(samples_s) / len(samples_s) * 1000, 3)
+    }
+
+
+async def measure_setup(port, connections):
+    """Time from connect() to the first echoed byte on a new connection"""
+    samples = []
+    for _ in range(connections):
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b"!")
+        await writer.drain()
+        await reader.readexactly(1)
+        samples.append(time.perf_counter() - started)
+        writer.close()
+    return summarize(samples)
+
+
+async def measure_latency(port, round_trips):
+    """Round trip time of small request/response messages on one connection"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    samples = []
+    for _ in range(round_trips):
+        started = time.perf_counter()
+        writer.write(SMALL_MESSAGE)
+        await writer.drain()
+        await reader.readexactly(len(SMALL_MESSAGE))
+        samples.append(time.perf_counter() - started)
+    writer.close()
+    return summarize(samples)
+
+
+async def measure_throughput(port, bulk_mb):
+    """MB/s of a bulk transfer echoed back on one connection"""
+    total = bulk_mb * 1024 * 1024
+    block = os.urandom(64 * 1024)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    
+    async def send():
+        sent = 0
+        while sent < total:
+            chunk = block[:total - sent]
+            writer.write(chunk)
+            await writer.drain()
+            sent += len(chunk)
+            
+    started = time.perf_counter()
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while received < total:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError(f"Connection closed after {received} of {total} bytes")
+        received += len(data)
+    elapsed = time.perf_counter() - started
+    await sender
+    writer.close()
+    return round(total / elapsed / (1024 * 1024), 3)
+
+
+async def measure(port, args):
+    return {
+        'setup_ms': await measure_setup(port, args.connections),
+        'latency_ms': await measure_latency(port, args.round_trips),
+        'throughput_mb_s': await measure_throughput(port, args.bulk_mb)
+    }
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def bench_connection(remote_port, local_port):
+    return {
+        'profile': 'bench',
+        'instance_id': 'i-0123456789abcdef0',
+        'remote_host': '127.0.0.1',
+        'remote_port': str(remote_port),
+        'local_port': str(local_port)
+    }
+
+
+def fake_aws_command(fake_aws):
+    """build_command for LazyTunnel that runs the fake aws executable"""
+    def build_command(connection, refresh=False):
+        parameters = json.dumps({
+            'host': [connection['remote_host']],
+            'portNumber': [connection['remote_port']],
+            'localPortNumber': [connection['local_port']]
+        })
+        return [fake_aws, 'ssm', 'start-session', '--target', connection['instance_id'], '--parameters', parameters]
+    return build_command
+
+
+def cpu_seconds(who):
+    """CPU seconds of this process or of its finished children"""
+    import resource
+    
+    rusage = resource.getrusage(who)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def peak_rss_mb(pid='self'):
+    """Peak RSS of a process in MB.
+    
+    Linux keeps ru_maxrss across fork and exec, so a child would report the
+    peak of the process that spawned it; VmHWM is per process image.
+    """
+    import resource
+    
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != 'self':
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT / (1024 * 1024)
+
+
+async def serve_engine(config):
+    """Child process side of measure_resources: run one engine until stdin closes"""
+    import resource
+    
+    connection = bench_connection(config['remote_port'], config['local_port'])
+    bin_dir = None
+    if config['engine'] == 'python':
+        # Only stream_url and token are used, to point sessions at the parent's endpoint
+        endpoint = FakeSessionManagerEndpoint('127.0.0.1', config['remote_port'], config['token'])
+        endpoint.port = config['endpoint_port']
+        tunnel = InProcessForwarder('bench', connection, FakeSSMClient(endpoint), lambda message: None)
+    else:
+        bin_dir = tempfile.mkdtemp()
+        build_command = fake_aws_command(install_fake_aws(bin_dir))
+        tunnel = LazyTunnel('bench-cli', connection, build_command, lambda: True, lambda message: None, None)
+    server = asyncio.ensure_future(tunnel.serve_forever())
+    try:
+        while tunnel.server is None:
+            await asyncio.sleep(0.01)
+        if config['engine'] == 'cli' and not await tunnel.activate():
+            raise RuntimeError("The fake aws CLI session did not start")
+        cpu_before = cpu_seconds(resource.RUSAGE_SELF)
+        print(json.dumps({'ready': True}), flush=True)
+        await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+        report = {'cpu_s': cpu_seconds(resource.RUSAGE_SELF) - cpu_before, 'rss_mb': peak_rss_mb()}
+        if config['engine'] == 'cli':
+            report['plugin_rss_mb'] = peak_rss_mb(tunnel.process.pid)
+    finally:
+        server.cancel()
+        # Reaps the fake aws process, so its usage counts as a finished child
+        await asyncio.gather(server, return_exceptions=True)
+        if bin_dir:
+            shutil.rmtree(bin_dir, ignore_errors=True)
+    if config['engine'] == 'cli':
+        report['plugin_cpu_s'] = cpu_seconds(resource.RUSAGE_CHILDREN)
+    print(json.dumps(report), flush=True)
+
+
+async def measure_resources(engine, echo, endpoint, bulk_mb):
+    """CPU seconds per MB echoed and peak RSS of one engine, run alone in a child process"""
+    local_port = free_port()
+    config = {
+        'engine': engine,
+        'local_port': local_port,
+        'remote_port': echo.port,
+        'endpoint_port': endpoint.port,
+        'token': endpoint.token
+    }
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--engine-child', json.dumps(config),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    try:
+        if not await process.stdout.readline():
+            raise RuntimeError(f"The {engine} engine process did not start")
+        throughput = await measure_throughput(local_port, bulk_mb)
+        process.stdin.close()
+        report = json.loads(await process.stdout.readline())
+    finally:
+        if process.returncode is None:
+            process.stdin.close()
+            await process.wait()
+    results = {
+        'throughput_mb_s': throughput,
+        'cpu_s_per_mb': round(report['cpu_s'] / bulk_mb, 4),
+        'rss_mb': round(report['rss_mb'], 1)
+    }
+    if 'plugin_cpu_s' in report:
+        results['plugin_cpu_s_per_mb'] = round(report['plugin_cpu_s'] / bulk_mb, 4)
+        if report['plugin_rss_mb'] is not None:
+            results['plugin_rss_mb'] = round(report['plugin_rss_mb'], 1)
+    return results
+
+
+async def run_cli(args, echo):
+    """Measure the aws CLI engine: session start time, then the same traffic through its relay"""
+    bin_dir = tempfile.mkdtemp()
+    build_command = fake_aws_command(install_fake_aws(bin_dir))
+    local_port = free_port()
+    connection = bench_connection(echo.port, local_port)
+    tunnel = LazyTunnel('bench-cli', connection, build_command, lambda: True, lambda message: None, None)
+    server = asyncio.ensure_future(tunnel.serve_forever())
+    try:
+        while tunnel.server is None:
+            await asyncio.sleep(0.01)
+        samples = []
+        for _ in range(args.sessions):
+            started = time.perf_counter()
+            if not await tunnel.activate():
+                raise RuntimeError("The fake aws CLI session did not start")
+            samples.append(time.perf_counter() - started)
+            await tunnel.deactivate()
+        await tunnel.activate()
+        return {
+            'session_setup_ms': summarize(samples),
+            'tunnel': await measure(local_port, args)
+        }
+    finally:
+        server.cancel()
+        # Stops the fake aws process before its directory goes away
+        await asyncio.gather(server, return_exceptions=True)
+        shutil.rmtree(bin_dir, ignore_errors=True)
+
+
+async def run(args):
+    echo = await EchoServer().start()
+    endpoint = await FakeSessionManagerEndpoint('127.0.0.1', echo.port, latency=args.latency_ms / 1000).start()
+    ssm_client = FakeSSMClient(endpoint)
+    local_port = free_port()
+    connection = bench_connection(echo.port, local_port)
+    standby = {'size': args.standby} if args.standby else None
+    forwarder = InProcessForwarder('bench', connection, ssm_client, lambda message: None, standby)
+    server = asyncio.ensure_future(forwarder.serve_forever())
+    await asyncio.sleep(0.1)
+    deadline = time.perf_counter() + 5
+    while forwarder.pool and len(forwarder.pool.standby) < args.standby and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    try:
+        results = {
+            'engine': 'python',
+            'baseline': await measure(echo.port, args),
+            'tunnel': await measure(local_port, args),
+        }
+        # Let the last sessions finish tearing down before reading the counters
+        deadline = time.perf_counter() + 5
+        standby = len(forwarder.pool.standby) if forwarder.pool else 0
+        while (forwarder.stats['clients'] or
+               endpoint.stats['sessions'] > ssm_client.calls['terminate_session'] + standby) \
+                and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        results.update({
+            'standby_hits': forwarder.stats['standby_hits'],
+            'api_calls': dict(ssm_client.calls),
+            'agent_messages': dict(endpoint.stats)
+        })
+        if not args.skip_cli:
+            results['cli'] = await run_cli(args, echo)
+        if not args.skip_resources:
+            results['resources'] = {'python': await measure_resources('python', echo, endpoint, args.bulk_mb)}
+            if not args.skip_cli:
+                results['resources']['cli'] = await measure_resources('cli', echo, endpoint, args.bulk_mb)
+    finally:
+        server.cancel()
+        # Lets the standby pool close its sessions before the endpoint goes away
+        await asyncio.gather(server, return_exceptions=True)
+        endpoint.close()
+        echo.close()
+    results['parameters'] = {
+        'bulk_mb': args.bulk_mb,
+        'round_trips': args.round_trips,
+        'connections': args.connections,
+        'latency_ms': args.latency_ms,
+        'standby': args.standby,
+        'sessions': 0 if args.skip_cli else args.sessions
+    }
+    results['host'] = {'python': platform.python_version(), 'platform': platform.platform()}
+    results['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    return results
+
+
+def regressions(current, saved, max_regression):
+    """List the tunnel metrics that got worse than saved by more than max_regression"""
+    failures = []
+    sections = [('', current['tunnel'], saved['tunnel'])]
+    if 'cli' in current and 'cli' in saved:
+        sections.append(('cli ', current['cli']['tunnel'], saved['cli']['tunnel']))
+        sections.append(('cli ', {'session_setup_ms': current['cli']['session_setup_ms']},
+                         {'session_setup_ms': saved['cli']['session_setup_ms']}))
+    for engine, now in current.get('resources', {}).items():
+        before = saved.get('resources', {}).get(engine)
+        if before and now['cpu_s_per_mb'] > before['cpu_s_per_mb'] * (1 + max_regression):
+            failures.append(f"{engine} cpu {now['cpu_s_per_mb']} s/MB > {before['cpu_s_per_mb']} s/MB")
+    for prefix, now, before in sections:
+        if 'throughput_mb_s' in now and now['throughput_mb_s'] < before['throughput_mb_s'] * (1 - max_regression):
+            failures.append(f"{prefix}throughput {now['throughput_mb_s']} MB/s < {before['throughput_mb_s']} MB/s")
+        for metric in ('setup_ms', 'latency_ms', 'session_setup_ms'):
+            if metric not in now:
+                continue
+            for stat in ('p50', 'p99'):
+                if now[metric][stat] > before[metric][stat] * (1 + max_regression):
+                    failures.append(f"{prefix}{metric} {stat} {now[metric][stat]} ms > {before[metric][stat]} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark forwarded ports against a local echo server")
+    parser.add_argument('--bulk-mb', type=int, default=DEFAULT_BULK_MB, help='Megabytes sent for the throughput test')
+    parser.add_argument('--round-trips', type=int, default=DEFAULT_ROUND_TRIPS, help='Small messages for the latency test')
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS, help='Connections for the setup test')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Delay the fake endpoint adds to every message it sends')
+    parser.add_argument('--standby', type=int, default=0,
+                        help='Pre-established sessions kept by the forwarder (0 disables the pool)')
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS,
+                        help='Sessions started to time the aws CLI engine setup')
+    parser.add_argument('--skip-cli', action='store_true', help='Do not measure the aws CLI engine')
+    parser.add_argument('--skip-resources', action='store_true',
+                        help='Do not measure CPU and memory of the engines in child processes')
+    parser.add_argument('--engine-child', metavar='CONFIG', help=argparse.SUPPRESS)
+    parser.add_argument('--output', metavar='FILE', help='Also write the JSON results to a file')
+    parser.add_argument('--compare', metavar='FILE', help='Fail on regressions against saved JSON results')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Allowed relative regression for --compare')
+    args = parser.parse_args()
+    if args.engine_child:
+        asyncio.run(serve_engine(json.loads(args.engine_child)))
+        return 0
+    # The fake aws CLI is a script run through its shebang line, and resource is POSIX only
+    args.skip_cli = args.skip_cli or os.name == 'nt'
+    args.skip_resources = args.skip_resources or os.name == 'nt'
+    
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            saved = json.load(f)
+        failures = regressions(results, saved, args.max_regression)
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
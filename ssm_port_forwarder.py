@@ -5,93 +5,2187 @@ import subprocess
 import argparse
 import getpass
 import base64
+import bisect
+import hashlib
+import hmac
+import itertools
+import shutil
 import time
 import re
-import webbrowser
-from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import boto3
-import inquirer
-from tabulate import tabulate
+import random
+import signal
+import socket
+import struct
+import threading
+import uuid
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
 
+# boto3, botocore, cryptography, tabulate, webbrowser, asyncio and concurrent.futures are
+# imported inside the methods that use them: commands that never touch AWS must
+# not pay for loading them (see benchmarks/import_budget.py)
+
+# describe_instances accepts at most 1000 instance ids per call
+EC2_DESCRIBE_BATCH_SIZE = 1000
+# Page size of describe_instance_information, which allows at most 50
+SSM_DESCRIBE_PAGE_SIZE = 50
+DISCOVERY_MAX_WORKERS = 8
+# Profile/region pairs searched, and blocking calls run by AsyncPortForwarder, at the same time
+DISCOVERY_MAX_TARGETS = 16
+# Seconds a cached instance inventory is served without a background refresh
+INVENTORY_CACHE_TTL = 300
+# Identities are re-checked this many seconds before their credentials expire
+IDENTITY_CACHE_MARGIN = 60
+# Upper bound for caching identities whose credentials have no expiry (static keys)
+IDENTITY_CACHE_MAX_AGE = 3600
+# Seconds between liveness checks of supervised tunnels
+TUNNEL_POLL_INTERVAL = 0.5
+# Seconds a tunnel is given to exit after SIGTERM before it is killed
+TUNNEL_STOP_TIMEOUT = 5
+# Lines of recent output kept per tunnel to classify why it exited
+TUNNEL_OUTPUT_LINES = 20
+# Seconds a new session has to open its local port before it is restarted
+TUNNEL_STARTUP_TIMEOUT = 60
+# Seconds between checks for an opened tunnel's local port to be listening
+TUNNEL_LISTEN_POLL = 0.01
+# Reconnect backoff, in seconds: base * 2^attempt, capped and jittered
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# A session that stayed up this long resets the backoff
+RECONNECT_STABLE_AFTER = 120
+# Checks that the local port is still bound while a session is up
+HEALTH_PROBE_INTERVAL = 30
+HEALTH_PROBE_FAILURES = 2
+# Session output that means the credentials, not the network, caused the exit
+AUTH_ERROR_PATTERN = re.compile(
+    r'ExpiredToken|UnauthorizedSSOToken|InvalidClientTokenId|UnrecognizedClient|'
+    r'Token has expired|Error when retrieving token|Unable to locate credentials|'
+    r'SSO session .* (expired|invalid)|AccessDenied',
+    re.IGNORECASE
+)
+# Seconds between the JSON lines written by --metrics-log
+METRICS_LOG_INTERVAL = 10
+# aws CLI output lines marking a session ready for clients, and an accepted client
+TUNNEL_READY_PATTERN = re.compile(r'Waiting for connections')
+TUNNEL_CLIENT_PATTERN = re.compile(r'Connection accepted')
+# Seconds a lazy tunnel keeps its session after the last client leaves
+LAZY_IDLE_TIMEOUT = 300
+LAZY_RELAY_CHUNK = 64 * 1024
+# Pre-established sessions kept per connection by --standby
+STANDBY_POOL_SIZE = 1
+# Seconds without new clients before the standby sessions are closed
+STANDBY_IDLE_TIMEOUT = 900
+# Seconds a standby session is kept before it is replaced (the agent closes idle sessions)
+STANDBY_MAX_AGE = 600
+# Seconds between standby pool checks
+STANDBY_CHECK_INTERVAL = 5
+# Range local ports are picked from when a connection leaves them empty
+LOCAL_PORT_RANGE = (20000, 20999)
+# Seconds a tag selector stays resolved to the same instance
+TARGET_CACHE_TTL = 60
+# Instance ids per describe_instance_information filter
+SSM_INSTANCE_FILTER_BATCH = 50
+# Formats and columns of --import / --export files
+CONNECTION_FILE_FORMATS = ['json', 'yaml', 'csv']
+CONNECTION_FILE_FIELDS = ['name', 'profile', 'region', 'instance_id', 'target', 'remote_host', 'remote_port',
+                          'local_port', 'group']
+# Matches shown per page by --find
+FIND_PAGE_SIZE = 20
+# Connection store format: one encrypted file per connection plus meta.json,
+# version 2 records the key derivation parameters in meta.json
+STORE_VERSION = 2
+# Key derivation of stores without parameters in meta.json, and of connections.enc
+LEGACY_KDF = {'algorithm': 'pbkdf2', 'iterations': 100000}
+# Key derivation function of new and upgraded stores
+DEFAULT_KDF = 'scrypt'
+# Seconds to derive the key that --calibrate-kdf aims for
+KDF_TARGET_SECONDS = 0.5
+# Most memory (128 * r * n bytes) a calibrated scrypt derivation may use on
+# every unlock; beyond it calibration raises p, which costs time but no memory
+SCRYPT_MAX_MEMORY = 64 * 1024 * 1024
+# Seconds between dashboard redraws, and tunnel output lines it shows
+DASHBOARD_REFRESH_INTERVAL = 0.25
+DASHBOARD_LOG_LINES = 6
+# Plaintext of the verifier in meta.json, used to check a password without any record
+STORE_VERIFIER = b"ssm-port-forwarder-store"
+# Seconds the unlock agent keeps the key without being used
+AGENT_IDLE_TIMEOUT = 900
+AGENT_REQUEST_TIMEOUT = 2
+# Version announced by the in-process engine; below 1.1.70 the agent uses
+# basic (non-multiplexed) port forwarding, which is what the engine speaks
+SESSION_CLIENT_VERSION = "1.0.0.0"
+# Bytes of local client data per input message. session-manager-plugin sends
+# 1024, but the agent writes each message to the remote host as a whole, and
+# every message costs a header, a digest, a frame and an acknowledgement
+SESSION_STREAM_CHUNK = 32 * 1024
+WEBSOCKET_MAX_MESSAGE = 1024 * 1024
+# Frames at least this long are masked with bytes.translate, shorter ones as one big integer
+WEBSOCKET_TRANSLATE_MASK_MIN = 4096
+
+class MetricsRegistry:
+    """Per-tunnel counters and phase timings, exported for Prometheus and as JSON lines.
+    
+    Each tunnel gets one stats dict that the engine running it updates in
+    place (InProcessForwarder uses it as its `stats`), so recording a value
+    costs a dict update. Phases such as the SSO check or a process spawn are
+    timed with `timed()`. Exporters only read the dicts, from their own
+    threads.
+    """
+    
+    TUNNEL_DEFAULTS = {
+        'bytes_in': 0,
+        'bytes_out': 0,
+        'clients': 0,
+        'clients_total': 0,
+        'sessions': 0,
+        'standby_hits': 0,
+        'reconnects': 0,
+        'setup_seconds_sum': 0.0,
+        'setup_count': 0,
+        'setup_seconds_last': None,
+        'session_started': None
+    }
+    
+    # (metric, type, help, stats key) exported for every tunnel whose engine
+    # measures the value; unmeasured values are None and have no series
+    TUNNEL_METRICS = [
+        ('ssm_tunnel_bytes_in_total', 'counter',
+         'Bytes received from the remote host (not measured for aws CLI sessions without --lazy)', 'bytes_in'),
+        ('ssm_tunnel_bytes_out_total', 'counter',
+         'Bytes sent to the remote host (not measured for aws CLI sessions without --lazy)', 'bytes_out'),
+        ('ssm_tunnel_active_clients', 'gauge',
+         'Local clients currently connected (not measured for aws CLI sessions without --lazy)', 'clients'),
+        ('ssm_tunnel_clients_total', 'counter', 'Local clients accepted', 'clients_total'),
+        ('ssm_tunnel_sessions_total', 'counter', 'SSM sessions started', 'sessions'),
+        ('ssm_tunnel_standby_hits_total', 'counter', 'Clients served by a standby session', 'standby_hits'),
+        ('ssm_tunnel_reconnects_total', 'counter', 'Sessions restored after a failure', 'reconnects')
+    ]
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tunnels = {}
+        self.phases = {}
+        self.server = None
+        self.log_stop = None
+        self.log_thread = None
+        
+    @property
+    def exporting(self):
+        """Whether an exporter is running"""
+        return self.server is not None or self.log_thread is not None
+        
+    def tunnel(self, name):
+        """Get the stats dict of a tunnel, creating it on first use"""
+        with self.lock:
+            if name not in self.tunnels:
+                self.tunnels[name] = dict(self.TUNNEL_DEFAULTS)
+            return self.tunnels[name]
+            
+    def observe_setup(self, name, seconds):
+        """Record the time a tunnel took to become usable"""
+        stats = self.tunnel(name)
+        stats['setup_seconds_sum'] += seconds
+        stats['setup_count'] += 1
+        stats['setup_seconds_last'] = seconds
+        
+    def observe_phase(self, phase, seconds):
+        """Record the duration of one run of a phase"""
+        with self.lock:
+            entry = self.phases.setdefault(phase, {'count': 0, 'sum': 0.0, 'last': None})
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['last'] = seconds
+            
+    @contextmanager
+    def timed(self, phase):
+        """Time the body of a with block as one run of a phase"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - started_at)
+            
+    def snapshot(self):
+        """Copy the current values, with session ages computed now"""
+        now = time.time()
+        with self.lock:
+            tunnels = {name: dict(stats) for name, stats in self.tunnels.items()}
+            phases = {phase: dict(entry) for phase, entry in self.phases.items()}
+        for stats in tunnels.values():
+            started = stats.pop('session_started')
+            stats['session_age_seconds'] = round(now - started, 3) if started is not None else None
+        return {'timestamp': round(now, 3), 'tunnels': tunnels, 'phases': phases}
+        
+    def render_prometheus(self):
+        """Render a snapshot in the Prometheus text exposition format"""
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            
+        snapshot = self.snapshot()
+        tunnels = snapshot['tunnels']
+        lines = []
+        for metric, metric_type, help_text, key in self.TUNNEL_METRICS:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+            lines += [f'{metric}{{tunnel="{label(name)}"}} {stats[key]}'
+                      for name, stats in tunnels.items() if stats[key] is not None]
+            
+        lines += ["# HELP ssm_tunnel_setup_seconds Time until a session accepted traffic",
+                  "# TYPE ssm_tunnel_setup_seconds summary"]
+        for name, stats in tunnels.items():
+            lines.append(f'ssm_tunnel_setup_seconds_sum{{tunnel="{label(name)}"}} {stats["setup_seconds_sum"]:.6f}')
+            lines.append(f'ssm_tunnel_setup_seconds_count{{tunnel="{label(name)}"}} {stats["setup_count"]}')
+            
+        lines += ["# HELP ssm_tunnel_session_age_seconds Age of the oldest open session",
+                  "# TYPE ssm_tunnel_session_age_seconds gauge"]
+        for name, stats in tunnels.items():
+            lines.append(f'ssm_tunnel_session_age_seconds{{tunnel="{label(name)}"}} {stats["session_age_seconds"] or 0}')
+            
+        lines += ["# HELP ssm_forwarder_phase_seconds Time spent in SSO checks, discovery, spawns and session starts",
+                  "# TYPE ssm_forwarder_phase_seconds summary"]
+        for phase, entry in snapshot['phases'].items():
+            lines.append(f'ssm_forwarder_phase_seconds_sum{{phase="{label(phase)}"}} {entry["sum"]:.6f}')
+            lines.append(f'ssm_forwarder_phase_seconds_count{{phase="{label(phase)}"}} {entry["count"]}')
+        return "\n".join(lines) + "\n"
+        
+    def serve(self, port):
+        """Serve /metrics (Prometheus) and /metrics.json on 127.0.0.1 from a background thread"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        registry = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.render_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                pass
+                
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+    def log_json_lines(self, path, interval=METRICS_LOG_INTERVAL):
+        """Append a snapshot as one JSON line every `interval` seconds ('-' is stdout)"""
+        self.log_stop = threading.Event()
+        
+        def write_snapshot():
+            line = json.dumps(self.snapshot())
+            if path == '-':
+                print(line, flush=True)
+            else:
+                with open(path, 'a') as f:
+                    f.write(line + "\n")
+                    
+        def worker():
+            while not self.log_stop.wait(interval):
+                write_snapshot()
+            # One last line with the final counters
+            write_snapshot()
+            
+        self.log_thread = threading.Thread(target=worker, daemon=True)
+        self.log_thread.start()
+        
+    def close(self):
+        """Stop the exporters, writing the final JSON line"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.log_thread is not None:
+            self.log_stop.set()
+            self.log_thread.join()
+            self.log_thread = None
+            
+            
+class TunnelSupervisor:
+    """Run several port forwarding sessions from one process.
+    
+    Each tunnel is a child process started in its own process group, so the
+    terminal's Ctrl+C reaches only the supervisor, which then stops every child.
+    Child output is multiplexed on stdout with a per-tunnel prefix.
+    
+    With reconnect enabled every tunnel gets a monitor thread that restarts
+    the session with jittered exponential backoff when the child exits or
+    stops listening on the local port. Liveness comes from the child and its
+    output, never from a connection through the tunnel, which would open a
+    stream to the remote host. Credentials are re-validated, through the
+    revalidate callback, only when the failure looks auth-related.
+    
+    Setup time, accepted clients, sessions and reconnects are recorded in a
+    MetricsRegistry, from the session-manager-plugin output. The plugin
+    does not report bytes or disconnects, so those stats are left unset.
+    
+    The rebuild callback, when given, returns the command for a restart; it
+    is told whether the last session failed before accepting clients, so
+    tag-selector targets are looked up again only then.
+    """
+    
+    # Stats the plugin output says nothing about
+    UNMEASURED_STATS = ['bytes_in', 'bytes_out', 'clients']
+    
+    def __init__(self, reconnect=False, revalidate=None, metrics=None, rebuild=None):
+        self.tunnels = {}
+        self.metrics = metrics or MetricsRegistry()
+        self.rebuild = rebuild
+        self.print_lock = threading.Lock()
+        self.reconnect = reconnect
+        self.revalidate = revalidate
+        self.stopping = threading.Event()
+        
+    def log(self, name, message):
+        """Print a line prefixed with the tunnel name"""
+        with self.print_lock:
+            print(f"[{name}] {message}", flush=True)
+            
+    def start(self, name, cmd, local_port=None):
+        """Start a tunnel, supervised when reconnect is enabled"""
+        self.tunnels[name] = {
+            'cmd': cmd,
+            'local_port': local_port,
+            'process': None,
+            'reader': None,
+            'monitor': None,
+            'output': deque(maxlen=TUNNEL_OUTPUT_LINES),
+            'reconnects': 0,
+            'downtime': 0.0,
+            'down_since': None,
+            'spawned_at': None,
+            'ready': False,
+            'stats': self.metrics.tunnel(name)
+        }
+        for key in self.UNMEASURED_STATS:
+            self.tunnels[name]['stats'][key] = None
+        if self.reconnect:
+            monitor = threading.Thread(target=self.supervise, args=(name,), daemon=True)
+            self.tunnels[name]['monitor'] = monitor
+            monitor.start()
+        else:
+            self.spawn(name)
+            
+    def spawn(self, name):
+        """Start the child process of a tunnel and a thread that relays its output"""
+        tunnel = self.tunnels[name]
+        popen_kwargs = {}
+        if os.name == 'nt':
+            popen_kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            popen_kwargs['start_new_session'] = True
+            
+        tunnel['output'].clear()
+        tunnel['spawned_at'] = time.time()
+        tunnel['ready'] = False
+        with self.metrics.timed('spawn'):
+            process = subprocess.Popen(
+                tunnel['cmd'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                **popen_kwargs
+            )
+        tunnel['stats']['sessions'] += 1
+        reader = threading.Thread(target=self.pump_output, args=(name, process), daemon=True)
+        tunnel['process'] = process
+        tunnel['reader'] = reader
+        reader.start()
+        return process
+        
+    def pump_output(self, name, process):
+        """Relay the output of a tunnel until it exits"""
+        tunnel = self.tunnels[name]
+        output = tunnel['output']
+        stats = tunnel['stats']
+        for line in process.stdout:
+            line = line.rstrip()
+            if line:
+                output.append(line)
+                self.log(name, line)
+                if TUNNEL_READY_PATTERN.search(line):
+                    self.session_ready(name)
+                elif TUNNEL_CLIENT_PATTERN.search(line):
+                    stats['clients_total'] += 1
+        returncode = process.wait()
+        stats['session_started'] = None
+        self.log(name, f"Session exited with code {returncode}")
+        
+    def session_ready(self, name):
+        """Record the setup time of a session the first time it is seen accepting clients"""
+        tunnel = self.tunnels[name]
+        tunnel['ready'] = True
+        if tunnel['stats']['session_started'] is None:
+            now = time.time()
+            tunnel['stats']['session_started'] = now
+            self.metrics.observe_setup(name, now - tunnel['spawned_at'])
+        
+    def running(self):
+        """Get the names of the tunnels that are still running"""
+        names = []
+        for name, tunnel in self.tunnels.items():
+            if tunnel['monitor'] is not None and tunnel['monitor'].is_alive():
+                names.append(name)
+            elif tunnel['process'] is not None and tunnel['process'].poll() is None:
+                names.append(name)
+        return names
+        
+    def wait(self):
+        """Block until every tunnel has exited"""
+        while self.running():
+            time.sleep(TUNNEL_POLL_INTERVAL)
+        for tunnel in self.tunnels.values():
+            if tunnel['reader'] is not None:
+                tunnel['reader'].join()
+                
+    def stop(self, timeout=TUNNEL_STOP_TIMEOUT):
+        """Stop every running tunnel, escalating to kill after the timeout"""
+        self.stopping.set()
+        for tunnel in self.tunnels.values():
+            if tunnel['process'] is not None and tunnel['process'].poll() is None:
+                self.signal(tunnel['process'], signal.SIGTERM)
+                
+        deadline = time.time() + timeout
+        for name, tunnel in self.tunnels.items():
+            if tunnel['monitor'] is not None:
+                tunnel['monitor'].join(timeout=max(0, deadline - time.time()))
+            process = tunnel['process']
+            if process is None:
+                continue
+            # A monitor may have restarted the session while stop was starting
+            if process.poll() is None:
+                self.signal(process, signal.SIGTERM)
+            try:
+                process.wait(timeout=max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                self.log(name, "Session did not stop, killing it")
+                self.signal(process, signal.SIGKILL if os.name != 'nt' else signal.SIGTERM)
+                process.wait()
+            tunnel['reader'].join()
+            
+    @staticmethod
+    def signal(process, sig):
+        """Send a signal to a tunnel and the processes it started"""
+        try:
+            if os.name == 'nt':
+                process.terminate()
+            else:
+                # The aws CLI starts session-manager-plugin in the same process group
+                os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+            
+    def probe(self, local_port):
+        """Check that something still listens on the local end of a tunnel, without connecting to it"""
+        return not PortAllocator.is_free(local_port)
+        
+    def supervise(self, name):
+        """Keep a tunnel running, restarting it with backoff until the supervisor stops"""
+        tunnel = self.tunnels[name]
+        attempt = 0
+        
+        while not self.stopping.is_set():
+            started_at = time.time()
+            try:
+                self.spawn(name)
+            except OSError as e:
+                self.log(name, f"Error starting port forwarding session: {e}")
+            else:
+                self.monitor(name)
+                if self.stopping.is_set():
+                    break
+                # Probe failures leave the child running, make sure it is gone
+                if tunnel['process'].poll() is None:
+                    self.signal(tunnel['process'], signal.SIGTERM)
+                    try:
+                        tunnel['process'].wait(timeout=TUNNEL_STOP_TIMEOUT)
+                    except subprocess.TimeoutExpired:
+                        self.log(name, "Session did not stop, killing it")
+                        self.signal(tunnel['process'], signal.SIGKILL if os.name != 'nt' else signal.SIGTERM)
+                        tunnel['process'].wait()
+                tunnel['reader'].join()
+                
+            if tunnel['down_since'] is None:
+                tunnel['down_since'] = time.time()
+            if time.time() - started_at >= RECONNECT_STABLE_AFTER:
+                attempt = 0
+            auth_failure = any(AUTH_ERROR_PATTERN.search(line) for line in tunnel['output'])
+            failed = not tunnel['ready']
+            
+            while not self.stopping.is_set():
+                attempt += 1
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** (attempt - 1))
+                # Equal jitter: never reconnect immediately, never all tunnels at once
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self.log(name, f"Reconnecting in {delay:.1f}s (attempt {attempt})")
+                if self.stopping.wait(delay):
+                    break
+                if auth_failure and self.revalidate is not None and not self.revalidate(name):
+                    self.log(name, "Credentials are still not valid, waiting before retrying")
+                    continue
+                if self.rebuild is not None:
+                    try:
+                        tunnel['cmd'] = self.rebuild(name, failed)
+                    except LookupError as e:
+                        self.log(name, f"{e}, waiting before retrying")
+                        continue
+                break
+                
+    def monitor(self, name):
+        """Watch a tunnel until its child exits or its local port is released"""
+        tunnel = self.tunnels[name]
+        process = tunnel['process']
+        started_at = time.time()
+        listening = False
+        failures = 0
+        next_probe = started_at + TUNNEL_POLL_INTERVAL
+        
+        while not self.stopping.is_set() and process.poll() is None:
+            now = time.time()
+            if tunnel['local_port'] is not None and now >= next_probe:
+                # The plugin's "Waiting for connections" line is enough to call the session up
+                if (tunnel['ready'] and not listening) or self.probe(tunnel['local_port']):
+                    failures = 0
+                    if not listening:
+                        listening = True
+                        self.session_ready(name)
+                        self.mark_up(name)
+                elif listening:
+                    failures += 1
+                    if failures >= HEALTH_PROBE_FAILURES:
+                        self.log(name, f"Local port {tunnel['local_port']} is no longer open, restarting session")
+                        return
+                elif now - started_at > TUNNEL_STARTUP_TIMEOUT:
+                    self.log(name, f"Local port {tunnel['local_port']} did not open, restarting session")
+                    return
+                next_probe = now + (HEALTH_PROBE_INTERVAL if listening else TUNNEL_POLL_INTERVAL)
+            self.stopping.wait(TUNNEL_POLL_INTERVAL)
+            
+    def mark_up(self, name):
+        """Record that a tunnel is accepting connections again"""
+        tunnel = self.tunnels[name]
+        if tunnel['down_since'] is None:
+            return
+        downtime = time.time() - tunnel['down_since']
+        tunnel['downtime'] += downtime
+        tunnel['reconnects'] += 1
+        tunnel['stats']['reconnects'] = tunnel['reconnects']
+        tunnel['down_since'] = None
+        self.log(name, f"Session restored after {downtime:.1f}s of downtime (reconnect #{tunnel['reconnects']})")
+        
+    def report(self):
+        """Print the reconnect count and total downtime of every tunnel"""
+        for name, tunnel in self.tunnels.items():
+            downtime = tunnel['downtime']
+            if tunnel['down_since'] is not None:
+                downtime += time.time() - tunnel['down_since']
+            self.log(name, f"Reconnects: {tunnel['reconnects']}, total downtime: {downtime:.1f}s")
+            
+
+class KeyDerivation:
+    """Derive the store key from its password with tunable parameters.
+    
+    Parameters are plain dicts kept in the store's meta.json, such as
+    {'algorithm': 'scrypt', 'n': 65536, 'r': 8, 'p': 1}, so the cost can be
+    changed per store and per machine without a new store format.
+    """
+    
+    ALGORITHMS = ['pbkdf2', 'scrypt', 'argon2id']
+    # Parameters of new stores
+    DEFAULTS = {
+        'pbkdf2': {'algorithm': 'pbkdf2', 'iterations': 600000},
+        'scrypt': {'algorithm': 'scrypt', 'n': 2 ** 16, 'r': 8, 'p': 1},
+        'argon2id': {'algorithm': 'argon2id', 'iterations': 3, 'memory_cost': 64 * 1024, 'lanes': 4},
+    }
+    # Lowest accepted costs: weaker stores are upgraded and calibrate() never goes below them
+    MINIMUMS = {
+        'pbkdf2': {'iterations': 310000},
+        'scrypt': {'n': 2 ** 14},
+        'argon2id': {'iterations': 2, 'memory_cost': 19 * 1024},
+    }
+    # Parameter scaled by calibrate()
+    COST = {'pbkdf2': 'iterations', 'scrypt': 'n', 'argon2id': 'iterations'}
+    
+    @staticmethod
+    def is_available(algorithm):
+        """Check if the installed cryptography package implements an algorithm"""
+        if algorithm != 'argon2id':
+            return algorithm in KeyDerivation.ALGORITHMS
+        try:
+            from cryptography.hazmat.primitives.kdf.argon2 import Argon2id  # noqa: F401
+            return True
+        except ImportError:
+            return False
+            
+    @staticmethod
+    def derive(password, salt, params):
+        """Derive a Fernet key from a password, raises ValueError for unknown parameters"""
+        algorithm = params.get('algorithm')
+        if algorithm == 'pbkdf2':
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=params['iterations'])
+        elif algorithm == 'scrypt':
+            from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+            kdf = Scrypt(salt=salt, length=32, n=params['n'], r=params['r'], p=params['p'])
+        elif algorithm == 'argon2id' and KeyDerivation.is_available(algorithm):
+            from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+            kdf = Argon2id(salt=salt, length=32, iterations=params['iterations'],
+                           lanes=params['lanes'], memory_cost=params['memory_cost'])
+        elif algorithm == 'argon2id':
+            raise ValueError("argon2id key derivation needs cryptography 44 or later")
+        else:
+            raise ValueError(f"Unknown key derivation function: {algorithm}")
+        return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+        
+    @staticmethod
+    def is_weak(params):
+        """Check if parameters cost less than the minimum of their algorithm"""
+        minimums = KeyDerivation.MINIMUMS.get(params.get('algorithm'), {})
+        return any(params.get(field, 0) < minimum for field, minimum in minimums.items())
+        
+    @staticmethod
+    def describe(params):
+        """Format parameters for display, e.g. 'scrypt (n=65536, r=8, p=1)'"""
+        details = ", ".join(f"{field}={value}" for field, value in params.items() if field != 'algorithm')
+        return f"{params['algorithm']} ({details})"
+        
+    @staticmethod
+    def calibrate(algorithm, target_seconds=KDF_TARGET_SECONDS):
+        """Find the parameters that take about target_seconds on this host, returns (params, seconds)"""
+        field = KeyDerivation.COST[algorithm]
+        params = dict(KeyDerivation.DEFAULTS[algorithm])
+        params[field] = KeyDerivation.MINIMUMS[algorithm][field]
+        salt = os.urandom(16)
+        
+        def measure():
+            started_at = time.perf_counter()
+            KeyDerivation.derive("calibration", salt, params)
+            return time.perf_counter() - started_at
+            
+        elapsed = measure()
+        if algorithm == 'scrypt':
+            # n must be a power of two: double it while that gets closer to the target
+            while elapsed * 1.5 < target_seconds and 128 * params['r'] * params['n'] * 2 <= SCRYPT_MAX_MEMORY:
+                params['n'] *= 2
+                elapsed = measure()
+            if elapsed * 1.5 < target_seconds:
+                # Memory is at its cap: the p lanes run one after another, so time grows linearly with p
+                params['p'] = round(params['p'] * target_seconds / elapsed)
+                elapsed = measure()
+        elif elapsed < target_seconds:
+            # The cost of the other algorithms grows linearly with their iterations
+            params[field] = round(params[field] * target_seconds / elapsed)
+            elapsed = measure()
+        return params, elapsed
+        
+
+class UnlockAgent:
+    """Hold the derived encryption key in memory behind a Unix socket, like ssh-agent.
+    
+    The socket lives in the config directory and is only accessible by its
+    owner. The agent exits, removing the socket, after idle_timeout seconds
+    without requests.
+    """
+    
+    def __init__(self, socket_path, key, idle_timeout=AGENT_IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.key = key
+        self.idle_timeout = idle_timeout
+        
+    @staticmethod
+    def request(socket_path, command):
+        """Send a command to a running agent, returns its reply or None if no agent answers"""
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(AGENT_REQUEST_TIMEOUT)
+                client.connect(socket_path)
+                client.sendall(command + b"\n")
+                reply = b""
+                while not reply.endswith(b"\n"):
+                    chunk = client.recv(4096)
+                    if not chunk:
+                        break
+                    reply += chunk
+                return reply.strip()
+        except OSError:
+            return None
+            
+    def start(self):
+        """Fork the agent into the background, returns True once it is listening"""
+        if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+            print("Error: The unlock agent needs Unix sockets and is not available on this platform")
+            return False
+            
+        if os.fork() == 0:
+            # Detach from the terminal so the agent outlives this command
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            try:
+                self.serve()
+            finally:
+                os._exit(0)
+                
+        deadline = time.time() + AGENT_REQUEST_TIMEOUT
+        while time.time() < deadline:
+            if UnlockAgent.request(self.socket_path, b"PING") == b"PONG":
+                return True
+            time.sleep(0.05)
+        return False
+        
+    def serve(self):
+        """Answer requests until stopped or idle for too long"""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+            
+        # Create the socket owner-only from the start, not chmod it afterwards
+        old_umask = os.umask(0o177)
+        try:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        server.settimeout(1)
+        
+        last_used = time.time()
+        try:
+            while time.time() - last_used < self.idle_timeout:
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+                with client:
+                    client.settimeout(AGENT_REQUEST_TIMEOUT)
+                    try:
+                        command = client.makefile('rb').readline().strip()
+                        command, _, argument = command.partition(b" ")
+                        if command == b"GET":
+                            client.sendall(self.key + b"\n")
+                            last_used = time.time()
+                        elif command == b"SET" and argument:
+                            self.key = argument
+                            client.sendall(b"OK\n")
+                            last_used = time.time()
+                        elif command == b"PING":
+                            client.sendall(b"PONG\n")
+                        elif command == b"STOP":
+                            client.sendall(b"OK\n")
+                            break
+                        else:
+                            client.sendall(b"ERROR\n")
+                    except OSError:
+                        continue
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+                
+
+class WebSocketClient:
+    """Minimal RFC 6455 websocket client over asyncio streams.
+    
+    Only what the Session Manager data channel needs: one connection, client
+    masking, binary/text messages, ping/pong and close. Kept in this module
+    so the in-process engine does not add a dependency.
+    """
+    
+    GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    OPCODE_CONTINUATION = 0x0
+    OPCODE_TEXT = 0x1
+    OPCODE_BINARY = 0x2
+    OPCODE_CLOSE = 0x8
+    OPCODE_PING = 0x9
+    OPCODE_PONG = 0xA
+    
+    # XOR translation table for every masking key byte, built on first use
+    MASK_TABLES = None
+    
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = None
+        self.closed = False
+        
+    @classmethod
+    async def connect(cls, url):
+        """Open a websocket connection to a ws:// or wss:// URL"""
+        import asyncio
+        from urllib.parse import urlsplit
+        
+        parts = urlsplit(url)
+        secure = parts.scheme == 'wss'
+        port = parts.port or (443 if secure else 80)
+        ssl_context = None
+        if secure:
+            import ssl
+            ssl_context = ssl.create_default_context()
+            
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=ssl_context, limit=WEBSOCKET_MAX_MESSAGE
+        )
+        key = base64.b64encode(os.urandom(16))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        writer.write(
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key.decode()}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n".encode()
+        )
+        await writer.drain()
+        
+        response = await reader.readuntil(b"\r\n\r\n")
+        status_line, *header_lines = response.decode('latin-1').split("\r\n")
+        if " 101 " not in f"{status_line} ":
+            writer.close()
+            raise ConnectionError(f"Websocket upgrade refused: {status_line}")
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        expected = base64.b64encode(hashlib.sha1(key + cls.GUID).digest()).decode()
+        if headers.get('sec-websocket-accept') != expected:
+            writer.close()
+            raise ConnectionError("Websocket upgrade returned an invalid accept key")
+            
+        client = cls(reader, writer)
+        client.write_lock = asyncio.Lock()
+        return client
+        
+    @classmethod
+    def mask(cls, data, masking_key):
+        """XOR data with a 4 byte masking key over the whole buffer at once"""
+        length = len(data)
+        if length < WEBSOCKET_TRANSLATE_MASK_MIN:
+            if not data:
+                return data
+            repeated = (masking_key * (length // 4 + 1))[:length]
+            return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+            
+        # Every fourth byte shares a key byte, so each lane is one C-level translate
+        if cls.MASK_TABLES is None:
+            cls.MASK_TABLES = [bytes(value ^ key for value in range(256)) for key in range(256)]
+        masked = bytearray(data)
+        for lane in range(4):
+            masked[lane::4] = data[lane::4].translate(cls.MASK_TABLES[masking_key[lane]])
+        return bytes(masked)
+        
+    def frame(self, data, opcode=OPCODE_BINARY):
+        """Build one masked frame holding a whole message"""
+        length = len(data)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masking_key = os.urandom(4)
+        return header + masking_key + self.mask(data, masking_key)
+        
+    async def send(self, data, opcode=OPCODE_BINARY):
+        """Send one message in a single frame"""
+        frame = self.frame(data, opcode)
+        async with self.write_lock:
+            self.writer.write(frame)
+            await self.writer.drain()
+            
+    def send_nowait(self, messages, opcode=OPCODE_BINARY):
+        """Queue several small messages in one write, without waiting for the buffer to drain.
+        
+        Frames are written whole, so they never interleave with a send()
+        in progress.
+        """
+        if self.closed or self.writer.is_closing():
+            return
+        self.writer.write(b"".join(self.frame(data, opcode) for data in messages))
+        
+    async def recv_frame(self):
+        """Read one frame, returns (fin, opcode, payload)"""
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack('>H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('>Q', await self.reader.readexactly(8))
+        if length > WEBSOCKET_MAX_MESSAGE:
+            raise ConnectionError(f"Websocket frame of {length} bytes is too large")
+        masking_key = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if masking_key:
+            payload = self.mask(payload, masking_key)
+        return bool(first & 0x80), first & 0x0F, payload
+        
+    async def recv(self):
+        """Receive the next data message, returns None once the connection is closed"""
+        message = b""
+        while True:
+            try:
+                fin, frame_opcode, payload = await self.recv_frame()
+            except (EOFError, ConnectionError, OSError):
+                self.closed = True
+                return None
+            if frame_opcode == self.OPCODE_PING:
+                await self.send(payload, self.OPCODE_PONG)
+                continue
+            if frame_opcode == self.OPCODE_PONG:
+                continue
+            if frame_opcode == self.OPCODE_CLOSE:
+                await self.close(payload[:2])
+                return None
+            message += payload
+            if fin:
+                return message
+                
+    async def close(self, code=b"\x03\xe8"):
+        """Send a close frame, once, and close the underlying stream"""
+        if not self.closed:
+            self.closed = True
+            try:
+                await self.send(code, self.OPCODE_CLOSE)
+            except (ConnectionError, OSError):
+                pass
+        self.writer.close()
+        
+        
+class SessionDataChannel:
+    """One Session Manager port forwarding session bridged to one local TCP stream.
+    
+    Speaks the agent message protocol of session-manager-plugin in basic
+    (non-multiplexed) port forwarding mode: every local client gets its own
+    SSM session. Incoming messages are acknowledged and reordered by sequence
+    number; outgoing messages are not retransmitted, the websocket's TCP
+    connection already guarantees their delivery.
+    """
+    
+    # Header: length, message type, schema version, created date, sequence number,
+    # flags, message id, payload digest, payload type; then payload length and payload
+    HEADER = struct.Struct('>I32sIQqQ16s32sI')
+    PAYLOAD_LENGTH = struct.Struct('>I')
+    
+    INPUT_STREAM_DATA = 'input_stream_data'
+    OUTPUT_STREAM_DATA = 'output_stream_data'
+    ACKNOWLEDGE = 'acknowledge'
+    CHANNEL_CLOSED = 'channel_closed'
+    START_PUBLICATION = 'start_publication'
+    PAUSE_PUBLICATION = 'pause_publication'
+    
+    PAYLOAD_OUTPUT = 1
+    PAYLOAD_ERROR = 2
+    PAYLOAD_HANDSHAKE_REQUEST = 5
+    PAYLOAD_HANDSHAKE_RESPONSE = 6
+    PAYLOAD_HANDSHAKE_COMPLETE = 7
+    PAYLOAD_FLAG = 10
+    
+    FLAG_DISCONNECT_TO_PORT = 1
+    FLAG_TERMINATE_SESSION = 2
+    FLAG_CONNECT_TO_PORT_ERROR = 3
+    
+    ACTION_STATUS_SUCCESS = 1
+    ACTION_STATUS_FAILED = 2
+    
+    ACKNOWLEDGE_PAYLOAD = ('{"AcknowledgedMessageType": "%s", "AcknowledgedMessageId": "%s", '
+                           '"AcknowledgedMessageSequenceNumber": %d, "IsSequentialMessage": true}')
+    
+    def __init__(self, websocket, log, stats=None):
+        self.websocket = websocket
+        self.log = log
+        self.stats = stats if stats is not None else {}
+        self.sequence_number = 0
+        self.expected_sequence_number = 0
+        self.pending = {}
+        self.handshake_complete = None
+        self.publication = None
+        self.agent_task = None
+        self.client_writer = None
+        self.backlog = []
+        self.output = []
+        self.acknowledgements = []
+        self.flush_scheduled = False
+        
+    @classmethod
+    def encode_message(cls, message_type, payload, sequence_number=0, flags=0, payload_type=0):
+        """Serialize an agent message"""
+        # A random UUID, already in the agent's byte order (see format_message_id)
+        message_id = os.urandom(16)
+        header = cls.HEADER.pack(
+            cls.HEADER.size,
+            message_type.encode().ljust(32, b" "),
+            1,
+            int(time.time() * 1000),
+            sequence_number,
+            flags,
+            message_id,
+            hashlib.sha256(payload).digest(),
+            payload_type
+        )
+        return header + cls.PAYLOAD_LENGTH.pack(len(payload)) + payload
+        
+    @classmethod
+    def decode_message(cls, data):
+        """Parse an agent message into a dict"""
+        if len(data) < cls.HEADER.size + cls.PAYLOAD_LENGTH.size:
+            raise ValueError("Agent message is too short")
+        (_, message_type, schema_version, created_date, sequence_number, flags,
+         message_id, _, payload_type) = cls.HEADER.unpack_from(data)
+        payload_length, = cls.PAYLOAD_LENGTH.unpack_from(data, cls.HEADER.size)
+        payload_start = cls.HEADER.size + cls.PAYLOAD_LENGTH.size
+        return {
+            'message_type': message_type.decode().strip(" \x00"),
+            'schema_version': schema_version,
+            'created_date': created_date,
+            'sequence_number': sequence_number,
+            'flags': flags,
+            'message_id': cls.format_message_id(message_id),
+            'payload_type': payload_type,
+            'payload': data[payload_start:payload_start + payload_length]
+        }
+        
+    @staticmethod
+    def format_message_id(message_id):
+        """Format a message id like str(uuid.UUID), cheaper; the agent stores the two 8 byte halves swapped"""
+        digits = (message_id[8:] + message_id[:8]).hex()
+        return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+        
+    async def open(self, token_value):
+        """Authenticate the data channel with the session token"""
+        await self.websocket.send(json.dumps({
+            "MessageSchemaVersion": "1.0",
+            "RequestId": str(uuid.uuid4()),
+            "TokenValue": token_value,
+            "ClientId": str(uuid.uuid4()),
+            "ClientVersion": SESSION_CLIENT_VERSION
+        }).encode(), WebSocketClient.OPCODE_TEXT)
+        
+    async def send_input(self, payload, payload_type=PAYLOAD_OUTPUT):
+        """Send data or a control payload to the agent"""
+        message = self.encode_message(
+            self.INPUT_STREAM_DATA, payload, self.sequence_number, payload_type=payload_type
+        )
+        self.sequence_number += 1
+        await self.websocket.send(message)
+        
+    def acknowledge(self, message):
+        """Acknowledge an output message so the agent does not resend it"""
+        # Same bytes as json.dumps of the acknowledgement, without its per-call cost
+        payload = self.ACKNOWLEDGE_PAYLOAD % (
+            message['message_type'], message['message_id'], message['sequence_number']
+        )
+        self.acknowledgements.append(self.encode_message(self.ACKNOWLEDGE, payload.encode(), flags=3))
+        self.schedule_flush()
+        
+    def schedule_flush(self):
+        """Flush once every message already received has been processed.
+        
+        The callback runs when pump_agent waits for more data, so client
+        output and acknowledgements go out in one write per burst instead
+        of one write per 1 KiB agent message.
+        """
+        import asyncio
+        
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+            
+    def flush(self):
+        """Write the queued client output and acknowledgements"""
+        self.flush_scheduled = False
+        output, self.output = self.output, []
+        acknowledgements, self.acknowledgements = self.acknowledgements, []
+        try:
+            if output and not self.client_writer.is_closing():
+                self.client_writer.write(b"".join(output))
+            if acknowledgements:
+                self.websocket.send_nowait(acknowledgements)
+        except (ConnectionError, OSError):
+            pass
+            
+    def start(self):
+        """Start processing agent messages, before a local client is attached"""
+        import asyncio
+        
+        if self.agent_task is None:
+            self.handshake_complete = asyncio.Event()
+            self.publication = asyncio.Event()
+            self.publication.set()
+            self.agent_task = asyncio.ensure_future(self.pump_agent())
+            
+    @property
+    def alive(self):
+        """Whether the agent side of the channel is still open"""
+        return self.agent_task is not None and not self.agent_task.done()
+        
+    async def bridge(self, client_reader, client_writer):
+        """Relay data between the local client and the agent until either side closes"""
+        import asyncio
+        
+        self.start()
+        # Output the remote host sent before the client was attached (a standby session)
+        self.client_writer = client_writer
+        if self.backlog:
+            client_writer.write(b"".join(self.backlog))
+            self.backlog = []
+            
+        agent_task = self.agent_task
+        client_task = asyncio.ensure_future(self.pump_client(client_reader))
+        try:
+            done, _ = await asyncio.wait([agent_task, client_task], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    self.log(f"Session error: {task.exception()}")
+            if client_task in done and client_task.exception() is None:
+                # Local client went away, tell the agent before closing the channel
+                await self.send_input(struct.pack('>I', self.FLAG_TERMINATE_SESSION), self.PAYLOAD_FLAG)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for task in (agent_task, client_task):
+                task.cancel()
+            await self.websocket.close()
+            client_writer.close()
+            
+    async def pump_client(self, client_reader):
+        """Send local client data to the agent once the handshake is complete"""
+        await self.handshake_complete.wait()
+        while True:
+            data = await client_reader.read(SESSION_STREAM_CHUNK)
+            if not data:
+                return
+            await self.publication.wait()
+            await self.send_input(data)
+            self.stats['bytes_out'] = self.stats.get('bytes_out', 0) + len(data)
+            
+    async def pump_agent(self):
+        """Process agent messages in sequence order until the channel closes"""
+        while True:
+            if self.client_writer is not None:
+                # Output is written by flush(); wait here while the client reads slowly
+                await self.client_writer.drain()
+            data = await self.websocket.recv()
+            if data is None:
+                return
+            message = self.decode_message(data)
+            message_type = message['message_type']
+            
+            if message_type == self.OUTPUT_STREAM_DATA:
+                self.acknowledge(message)
+                sequence_number = message['sequence_number']
+                if sequence_number < self.expected_sequence_number:
+                    continue
+                self.pending[sequence_number] = message
+                while self.expected_sequence_number in self.pending:
+                    if not await self.process_output(self.pending.pop(self.expected_sequence_number)):
+                        return
+                    self.expected_sequence_number += 1
+            elif message_type == self.CHANNEL_CLOSED:
+                self.log(f"Session closed by the agent: {message['payload'].decode(errors='replace')}")
+                return
+            elif message_type == self.START_PUBLICATION:
+                self.publication.set()
+            elif message_type == self.PAUSE_PUBLICATION:
+                self.publication.clear()
+                
+    async def process_output(self, message):
+        """Handle one in-order output message, returns False when the session is over"""
+        payload_type = message['payload_type']
+        payload = message['payload']
+        
+        if payload_type == self.PAYLOAD_OUTPUT:
+            if self.client_writer is None:
+                self.backlog.append(payload)
+            else:
+                self.output.append(payload)
+                self.schedule_flush()
+            self.stats['bytes_in'] = self.stats.get('bytes_in', 0) + len(payload)
+        elif payload_type == self.PAYLOAD_HANDSHAKE_REQUEST:
+            await self.handle_handshake(json.loads(payload))
+        elif payload_type == self.PAYLOAD_HANDSHAKE_COMPLETE:
+            self.handshake_complete.set()
+        elif payload_type == self.PAYLOAD_FLAG:
+            flag, = struct.unpack('>I', payload[:4])
+            if flag == self.FLAG_CONNECT_TO_PORT_ERROR:
+                self.log("The instance could not connect to the remote host")
+                return False
+        elif payload_type == self.PAYLOAD_ERROR:
+            self.log(f"Agent error: {payload.decode(errors='replace')}")
+        return True
+        
+    async def handle_handshake(self, request):
+        """Accept the port session type and refuse actions this engine cannot do"""
+        processed = []
+        errors = []
+        for action in request.get('RequestedClientActions', []):
+            action_type = action.get('ActionType')
+            if action_type == 'SessionType':
+                processed.append({'ActionType': action_type, 'ActionStatus': self.ACTION_STATUS_SUCCESS})
+            else:
+                # KMS encrypted sessions need the aws CLI engine
+                processed.append({'ActionType': action_type, 'ActionStatus': self.ACTION_STATUS_FAILED})
+                errors.append(f"{action_type} is not supported by the in-process engine")
+        if errors:
+            self.log("; ".join(errors))
+        await self.send_input(json.dumps({
+            'ClientVersion': SESSION_CLIENT_VERSION,
+            'ProcessedClientActions': processed,
+            'Errors': errors
+        }).encode(), self.PAYLOAD_HANDSHAKE_RESPONSE)
+        
+        
+class InProcessForwarder:
+    """Forward a local port through Session Manager without the aws CLI.
+    
+    Listens on the connection's local port with asyncio and starts one SSM
+    session, through boto3, for each local client. Blocking boto3 calls run
+    in the default executor so they never stall other clients. With a
+    StandbyPool, clients are handed an already open session instead.
+    """
+    
+    def __init__(self, name, connection, ssm_client, log, standby=None, metrics=None, resolve=None):
+        self.name = name
+        self.connection = connection
+        self.ssm_client = ssm_client
+        self.resolve = resolve
+        self.log = log
+        self.metrics = metrics or MetricsRegistry()
+        self.stats = self.metrics.tunnel(name)
+        self.open_sessions = {}
+        self.pool = StandbyPool(self, **standby) if standby else None
+        self.server = None
+        
+    async def serve_forever(self):
+        """Accept local clients until cancelled"""
+        import asyncio
+        
+        server = self.server = await asyncio.start_server(
+            self.handle_client, '127.0.0.1', int(self.connection['local_port'])
+        )
+        self.log(f"Listening on 127.0.0.1:{self.connection['local_port']}")
+        pool_task = asyncio.ensure_future(self.pool.run()) if self.pool else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if pool_task:
+                pool_task.cancel()
+                await self.pool.close()
+                
+    async def open_channel(self):
+        """Start an SSM session and open its data channel, returns (session_id, channel)"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        with self.metrics.timed('session_start'):
+            session = await loop.run_in_executor(None, self.start_session)
+        self.stats['sessions'] += 1
+        try:
+            websocket = await WebSocketClient.connect(session['StreamUrl'])
+            channel = SessionDataChannel(websocket, self.log, self.stats)
+            await channel.open(session['TokenValue'])
+        except BaseException:
+            await loop.run_in_executor(None, self.terminate_session, session['SessionId'])
+            raise
+        return session['SessionId'], channel
+        
+    async def handle_client(self, client_reader, client_writer):
+        """Open an SSM session for a local client, or claim a standby one, and bridge the two"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        self.stats['clients'] += 1
+        self.stats['clients_total'] += 1
+        accepted_at = time.time()
+        session_id = None
+        try:
+            claimed = self.pool.claim() if self.pool else None
+            if claimed:
+                self.stats['standby_hits'] += 1
+                session_id, channel = claimed
+            else:
+                session_id, channel = await self.open_channel()
+            self.metrics.observe_setup(self.name, time.time() - accepted_at)
+            self.open_sessions[session_id] = accepted_at
+            self.stats['session_started'] = min(self.open_sessions.values())
+            await channel.bridge(client_reader, client_writer)
+        except Exception as e:
+            self.log(f"Error forwarding connection: {e}")
+            client_writer.close()
+        finally:
+            self.stats['clients'] -= 1
+            self.open_sessions.pop(session_id, None)
+            self.stats['session_started'] = min(self.open_sessions.values(), default=None)
+            if session_id:
+                await loop.run_in_executor(None, self.terminate_session, session_id)
+                
+    def start_session(self):
+        """Start a port forwarding session to the remote host"""
+        if self.resolve is None:
+            return self.request_session(self.connection['instance_id'])
+        try:
+            return self.request_session(self.resolve(False))
+        except Exception:
+            # The cached instance of a tag-selector target may be gone, look it up again
+            return self.request_session(self.resolve(True))
+            
+    def request_session(self, instance_id):
+        """Call StartSession for the port forwarding document"""
+        return self.ssm_client.start_session(
+            Target=instance_id,
+            DocumentName='AWS-StartPortForwardingSessionToRemoteHost',
+            Parameters={
+                'host': [self.connection['remote_host']],
+                'portNumber': [str(self.connection['remote_port'])],
+                'localPortNumber': [str(self.connection['local_port'])]
+            }
+        )
+        
+    def terminate_session(self, session_id):
+        """Terminate a session, ignoring errors for sessions that already ended"""
+        try:
+            self.ssm_client.terminate_session(SessionId=session_id)
+        except Exception as e:
+            self.log(f"Error terminating session {session_id}: {e}")
+            
+            
+class StandbyPool:
+    """Pre-established SSM sessions kept ready for an InProcessForwarder.
+    
+    Keeps up to `size` sessions open, with their data channel handshake
+    done, so a new local client is bridged at once instead of waiting for
+    StartSession and the websocket setup. The pool is refilled in the
+    background after every claim. Sessions older than `max_age` are
+    replaced, since the agent closes idle sessions, and the whole pool is
+    drained after `idle_timeout` seconds without claims until the next
+    client arrives. When refills fail, they are retried with the jittered
+    exponential backoff of reconnects, and claims do not retry them early.
+    """
+    
+    def __init__(self, forwarder, size=STANDBY_POOL_SIZE, idle_timeout=STANDBY_IDLE_TIMEOUT,
+                 max_age=STANDBY_MAX_AGE):
+        self.forwarder = forwarder
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.standby = deque()
+        self.last_claim = time.monotonic()
+        self.wakeup = None
+        self.failures = 0
+        self.retry_at = 0
+        
+    def claim(self):
+        """Take a live standby session, returns (session_id, channel) or None"""
+        self.last_claim = time.monotonic()
+        if self.wakeup:
+            self.wakeup.set()
+        while self.standby:
+            created_at, session_id, channel = self.standby.popleft()
+            if channel.alive and time.monotonic() - created_at < self.max_age:
+                return session_id, channel
+            self.discard(session_id, channel)
+        return None
+        
+    async def run(self):
+        """Evict stale sessions and refill the pool until cancelled"""
+        import asyncio
+        
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            idle = now - self.last_claim >= self.idle_timeout
+            if idle and self.standby:
+                self.forwarder.log(f"No clients for {self.idle_timeout}s, closing standby sessions")
+                
+            for entry in list(self.standby):
+                created_at, session_id, channel = entry
+                if idle or not channel.alive or now - created_at >= self.max_age:
+                    self.standby.remove(entry)
+                    self.discard(session_id, channel)
+                    
+            missing = 0 if idle or now < self.retry_at else self.size - len(self.standby)
+            if missing > 0:
+                results = await asyncio.gather(
+                    *(self.forwarder.open_channel() for _ in range(missing)), return_exceptions=True
+                )
+                for result in results:
+                    if isinstance(result, BaseException):
+                        self.forwarder.log(f"Error opening standby session: {result}")
+                        continue
+                    session_id, channel = result
+                    channel.start()
+                    self.standby.append((time.monotonic(), session_id, channel))
+                if all(isinstance(result, BaseException) for result in results):
+                    self.failures += 1
+                    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** (self.failures - 1))
+                    delay = delay / 2 + random.uniform(0, delay / 2)
+                    self.retry_at = time.monotonic() + delay
+                    self.forwarder.log(f"Retrying standby sessions in {delay:.1f}s (attempt {self.failures})")
+                else:
+                    self.failures = 0
+                    self.retry_at = 0
+                    
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), STANDBY_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+                
+    def discard(self, session_id, channel):
+        """Close a standby session in the background"""
+        import asyncio
+        
+        asyncio.ensure_future(self.close_session(session_id, channel))
+        
+    async def close_session(self, session_id, channel):
+        """Close a standby session's data channel and terminate it"""
+        import asyncio
+        
+        if channel.agent_task:
+            channel.agent_task.cancel()
+        try:
+            await channel.websocket.close()
+        except (ConnectionError, OSError):
+            pass
+        await asyncio.get_running_loop().run_in_executor(None, self.forwarder.terminate_session, session_id)
+        
+    async def close(self):
+        """Terminate every standby session"""
+        import asyncio
+        
+        entries = list(self.standby)
+        self.standby.clear()
+        await asyncio.gather(*(self.close_session(session_id, channel) for _, session_id, channel in entries),
+                             return_exceptions=True)
+        
+        
+class LazyTunnel:
+    """Keep a connection's local port open and start its session on demand.
+    
+    The tunnel binds the local port itself, so it costs nothing while no
+    client is connected. The first client starts the aws CLI session on a
+    private ephemeral port and every client is relayed to it; once the last
+    client has been gone for `idle_timeout` seconds the session is stopped
+    again, until the next client arrives. With `idle_timeout` None the
+    session is kept once started.
+    """
+    
+    def __init__(self, name, connection, build_command, authenticate, log,
+                 idle_timeout=LAZY_IDLE_TIMEOUT, metrics=None):
+        # build_command(connection, refresh) may raise LookupError for an unresolvable target
+        self.name = name
+        self.connection = connection
+        self.build_command = build_command
+        self.authenticate = authenticate
+        self.log = log
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics or MetricsRegistry()
+        self.stats = self.metrics.tunnel(name)
+        self.process = None
+        self.backend_port = None
+        self.ready = None
+        self.lock = None
+        self.idle_timer = None
+        self.failed = False
+        self.server = None
+        
+    async def serve_forever(self):
+        """Accept local clients until cancelled"""
+        import asyncio
+        
+        self.lock = asyncio.Lock()
+        server = self.server = await asyncio.start_server(
+            self.handle_client, '127.0.0.1', int(self.connection['local_port'])
+        )
+        self.log(f"Waiting for clients on 127.0.0.1:{self.connection['local_port']}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.deactivate()
+            
+    async def activate(self):
+        """Start the session if it is not running, returns False when it could not start"""
+        import asyncio
+        
+        async with self.lock:
+            if self.process is not None and self.process.returncode is None:
+                return True
+                
+            loop = asyncio.get_running_loop()
+            started_at = time.time()
+            if not await loop.run_in_executor(None, self.authenticate):
+                self.log(f"Failed to authenticate with profile '{self.connection['profile']}'")
+                return False
+                
+            self.backend_port = PortAllocator.ephemeral()
+            try:
+                cmd = await loop.run_in_executor(
+                    None, self.build_command, dict(self.connection, local_port=str(self.backend_port)), self.failed
+                )
+            except LookupError as e:
+                self.log(str(e))
+                return False
+            popen_kwargs = {}
+            if os.name == 'nt':
+                popen_kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+            else:
+                popen_kwargs['start_new_session'] = True
+            self.log("Starting session")
+            self.ready = asyncio.Event()
+            with self.metrics.timed('spawn'):
+                self.process = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **popen_kwargs
+                )
+            self.stats['sessions'] += 1
+            output = asyncio.ensure_future(self.pump_output(self.process))
+            
+            ready = asyncio.ensure_future(self.ready.wait())
+            await asyncio.wait([ready, output], timeout=TUNNEL_STARTUP_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+            ready.cancel()
+            self.failed = not self.ready.is_set()
+            if self.failed:
+                self.log("Session did not start")
+                await self.deactivate()
+                return False
+            self.stats['session_started'] = time.time()
+            self.metrics.observe_setup(self.name, time.time() - started_at)
+            return True
+            
+    async def pump_output(self, process):
+        """Relay the session output and notice when it is ready for clients"""
+        async for line in process.stdout:
+            line = line.decode(errors='replace').rstrip()
+            if line:
+                self.log(line)
+                if TUNNEL_READY_PATTERN.search(line):
+                    self.ready.set()
+        returncode = await process.wait()
+        self.stats['session_started'] = None
+        self.log(f"Session exited with code {returncode}")
+        
+    async def deactivate(self):
+        """Stop the session, escalating to kill after the timeout"""
+        import asyncio
+        
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+        TunnelSupervisor.signal(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), TUNNEL_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log("Session did not stop, killing it")
+            TunnelSupervisor.signal(process, signal.SIGKILL if os.name != 'nt' else signal.SIGTERM)
+            await process.wait()
+            
+    async def deactivate_if_idle(self):
+        """Stop the session if no client came back during the idle period"""
+        if self.stats['clients'] == 0 and self.process is not None and self.process.returncode is None:
+            self.log(f"No clients for {self.idle_timeout}s, stopping session")
+            await self.deactivate()
+            
+    async def handle_client(self, client_reader, client_writer):
+        """Start the session if needed and relay a local client to it"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        self.stats['clients'] += 1
+        self.stats['clients_total'] += 1
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        backend_writer = None
+        try:
+            if await self.activate():
+                backend_reader, backend_writer = await asyncio.open_connection('127.0.0.1', self.backend_port)
+                await asyncio.gather(
+                    self.relay(client_reader, backend_writer, 'bytes_out'),
+                    self.relay(backend_reader, client_writer, 'bytes_in')
+                )
+        except OSError as e:
+            self.log(f"Error forwarding connection: {e}")
+        finally:
+            self.stats['clients'] -= 1
+            for writer in (client_writer, backend_writer):
+                if writer is not None:
+                    writer.close()
+            if self.stats['clients'] == 0 and self.idle_timeout is not None:
+                self.idle_timer = loop.call_later(
+                    self.idle_timeout, lambda: asyncio.ensure_future(self.deactivate_if_idle())
+                )
+                
+    async def relay(self, reader, writer, counter):
+        """Copy one direction of a connection until EOF, then half-close the other side"""
+        try:
+            while True:
+                data = await reader.read(LAZY_RELAY_CHUNK)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+                self.stats[counter] += len(data)
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
+            
+            
+class ConnectionIndex:
+    """In-memory index over saved connections for ranked prefix and fuzzy lookup.
+    
+    Every searchable field (name, profile, instance, remote host, ports and
+    group) is split into lowercase tokens kept in one sorted list, so exact
+    and prefix matches are found with a binary search. Only query terms
+    without any prefix match fall back to a fuzzy (subsequence) scan.
+    Matches in the connection name weigh more than matches in other fields.
+    """
+    
+    FIELDS = {
+        'name': 3,
+        'profile': 1,
+        'instance_id': 1,
+        'target': 1,
+        'remote_host': 1,
+        'remote_port': 1,
+        'local_port': 1,
+        'group': 1
+    }
+    EXACT_SCORE = 100
+    PREFIX_SCORE = 60
+    FUZZY_SCORE = 30
+    
+    def __init__(self, connections):
+        self.connections = connections
+        self.values = {}
+        tokens = set()
+        for name, connection in connections.items():
+            fields = dict(connection, name=name)
+            values = []
+            for field, weight in self.FIELDS.items():
+                value = str(fields.get(field, '')).lower()
+                if not value:
+                    continue
+                values.append((value, weight))
+                for token in {value, *re.split(r'[-_.:/\s]+', value)}:
+                    if token:
+                        tokens.add((token, name, weight))
+            self.values[name] = values
+        self.tokens = sorted(tokens)
+        
+    def prefix_matches(self, term):
+        """Score connections with a token equal to, or starting with, the term"""
+        scores = {}
+        start = bisect.bisect_left(self.tokens, (term,))
+        for token, name, weight in itertools.islice(self.tokens, start, None):
+            if not token.startswith(term):
+                break
+            score = (self.EXACT_SCORE if token == term else self.PREFIX_SCORE) * weight
+            scores[name] = max(scores.get(name, 0), score)
+        return scores
+        
+    def fuzzy_matches(self, term):
+        """Score connections where the term's characters appear in order in a field"""
+        scores = {}
+        for name, values in self.values.items():
+            for value, weight in values:
+                position = -1
+                gaps = 0
+                for char in term:
+                    found = value.find(char, position + 1)
+                    if found < 0:
+                        break
+                    if position >= 0:
+                        gaps += found - position - 1
+                    position = found
+                else:
+                    score = max(1, self.FUZZY_SCORE - gaps) * weight
+                    scores[name] = max(scores.get(name, 0), score)
+        return scores
+        
+    def search(self, query):
+        """Return (name, score) pairs matching every term of the query, best first"""
+        terms = query.lower().split()
+        if not terms:
+            return [(name, 0) for name in sorted(self.connections)]
+            
+        scores = None
+        for term in terms:
+            term_scores = self.prefix_matches(term) or self.fuzzy_matches(term)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {name: scores[name] + score for name, score in term_scores.items() if name in scores}
+            if not scores:
+                return []
+                
+        # Ties go to the most recently used connection, then alphabetical order
+        ranked = sorted(scores, key=lambda name: name)
+        ranked.sort(key=lambda name: self.connections[name].get('last_used', ''), reverse=True)
+        ranked.sort(key=lambda name: scores[name], reverse=True)
+        return [(name, scores[name]) for name in ranked]
+        
+        
+class PortAllocator:
+    """Index of the local ports reserved by saved connections.
+    
+    Checks a port against that index and against what is bound on this
+    machine right now, so that a launch on a busy port is rejected before
+    any SSO check or SSM session, and picks free ports from a range.
+    """
+    
+    def __init__(self, connections, port_range=LOCAL_PORT_RANGE):
+        self.port_range = port_range
+        self.reserved = {}
+        for name, connection in connections.items():
+            self.reserved.setdefault(int(connection['local_port']), []).append(name)
+            
+    @staticmethod
+    def is_free(port):
+        """Check whether a local port can be bound on both loopback addresses.
+        
+        Clients connecting to 'localhost' may try ::1 first, so a service
+        listening there only makes the port as unusable as one on 127.0.0.1.
+        """
+        import errno
+        
+        for family, address in ((socket.AF_INET, '127.0.0.1'), (socket.AF_INET6, '::1')):
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+            except OSError:
+                # IPv6 is disabled on this machine
+                continue
+            with sock:
+                if os.name != 'nt':
+                    # Listeners set SO_REUSEADDR, so sockets in TIME_WAIT do not count as busy
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    sock.bind((address, int(port)))
+                except OSError as e:
+                    # No ::1 configured, so nothing can listen there
+                    if family == socket.AF_INET6 and e.errno == errno.EADDRNOTAVAIL:
+                        continue
+                    return False
+        return True
+        
+    def owners(self, port, exclude=None):
+        """Return the saved connections, other than `exclude`, that use a local port"""
+        return [name for name in self.reserved.get(int(port), []) if name != exclude]
+        
+    @staticmethod
+    def ephemeral():
+        """Get a port the operating system considers free right now"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+            
+    def allocate(self):
+        """Return the first port of the range not reserved by a connection and free to bind"""
+        start, end = self.port_range
+        for port in range(start, end + 1):
+            if port not in self.reserved and self.is_free(port):
+                return port
+        return None
+        
+        
+class ProfileCatalog:
+    """AWS profiles parsed once from the shared config and credentials files.
+    
+    Both files are read with configparser, honouring AWS_CONFIG_FILE and
+    AWS_SHARED_CREDENTIALS_FILE, and each profile keeps its metadata
+    (region, SSO account, role and start URL, including the values it
+    inherits from an [sso-session] block). The result is cached in memory
+    and on disk, keyed on the size and mtime of both files, so it is only
+    parsed again after one of them changes.
+    """
+    
+    METADATA_KEYS = ['region', 'sso_account_id', 'sso_role_name', 'sso_session', 'sso_start_url', 'sso_region']
+    # The only metadata keys a profile takes from its [sso-session] block
+    SSO_SESSION_KEYS = ['sso_start_url', 'sso_region']
+    
+    def __init__(self, cache_file, write_file):
+        self.cache_file = cache_file
+        self.write_file = write_file
+        self.signature = None
+        self.profiles = {}
+        
+    @staticmethod
+    def get_files():
+        """Get the config and credentials file paths the AWS CLI would use"""
+        return [
+            os.path.expanduser(os.environ.get('AWS_CONFIG_FILE', '~/.aws/config')),
+            os.path.expanduser(os.environ.get('AWS_SHARED_CREDENTIALS_FILE', '~/.aws/credentials'))
+        ]
+        
+    def get_signature(self):
+        """Identify the current version of both files by path, size and mtime"""
+        signature = []
+        for path in self.get_files():
+            try:
+                stat = os.stat(path)
+                signature.append([path, stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                signature.append([path, None, None])
+        return signature
+        
+    @staticmethod
+    def read_ini(path):
+        """Parse an AWS INI file, returns {section: {key: value}}"""
+        import configparser
+        
+        # No DEFAULT section, no interpolation and duplicates tolerated, like the AWS CLI
+        parser = configparser.RawConfigParser(default_section='\0', strict=False, interpolation=None)
+        try:
+            parser.read(path)
+        except configparser.Error as e:
+            print(f"Warning: Could not parse {path}: {e}")
+            return {}
+        return {section: dict(parser.items(section)) for section in parser.sections()}
+        
+    def parse(self):
+        """Build {profile: metadata}, with 'default' first and profiles in file order"""
+        config_path, credentials_path = self.get_files()
+        config = self.read_ini(config_path)
+        credentials = self.read_ini(credentials_path)
+        
+        sso_sessions = {}
+        config_profiles = {}
+        for section, values in config.items():
+            if section.startswith('sso-session '):
+                sso_sessions[section[len('sso-session '):].strip()] = values
+            elif section.startswith('profile '):
+                config_profiles[section[len('profile '):].strip()] = values
+            elif section == 'default':
+                config_profiles['default'] = values
+                
+        profiles = {'default': {'sources': []}}
+        for profile, values in credentials.items():
+            entry = profiles.setdefault(profile, {'sources': []})
+            entry['sources'].append('credentials')
+            if values.get('region'):
+                entry['region'] = values['region']
+                
+        for profile, values in config_profiles.items():
+            entry = profiles.setdefault(profile, {'sources': []})
+            entry['sources'].append('config')
+            sso_session = sso_sessions.get(values.get('sso_session'), {})
+            for key in self.METADATA_KEYS:
+                value = values.get(key) or (sso_session.get(key) if key in self.SSO_SESSION_KEYS else None)
+                if value:
+                    entry[key] = value
+        return profiles
+        
+    def load(self):
+        """Get {profile: metadata}, parsing the files only when they changed"""
+        signature = self.get_signature()
+        if signature == self.signature:
+            return self.profiles
+            
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached = json.load(f)
+            if cached['signature'] == signature:
+                self.signature, self.profiles = signature, cached['profiles']
+                return self.profiles
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+            
+        self.signature, self.profiles = signature, self.parse()
+        try:
+            self.write_file(self.cache_file, json.dumps({'signature': signature, 'profiles': self.profiles}).encode())
+        except OSError as e:
+            print(f"Error saving profile cache: {e}")
+        return self.profiles
+        
+    def select(self, selectors):
+        """Get the profiles matching any selector.
+        
+        A selector is a shell pattern on the profile name ('prod-*') or on a
+        metadata value ('region=eu-*', 'sso_account_id=1234*'); selectors
+        joined with '+' must all match.
+        """
+        from fnmatch import fnmatchcase
+        
+        def matches(profile, info, selector):
+            for condition in selector.split('+'):
+                key, _, pattern = condition.rpartition('=')
+                value = info.get(key) if key else profile
+                if value is None or not fnmatchcase(str(value), pattern):
+                    return False
+            return True
+            
+        return [profile for profile, info in self.load().items()
+                if any(matches(profile, info, selector) for selector in selectors)]
+                
+                
 class SSMPortForwarder:
     def __init__(self):
         self.config_dir = os.path.expanduser("~/.ssm-port-forwarder")
+        self.store_dir = os.path.join(self.config_dir, "connections")
+        self.store_meta_file = os.path.join(self.store_dir, "meta.json")
+        self.store_lock_file = os.path.join(self.config_dir, "connections.lock")
+        # Single-file store of earlier versions, migrated on first load
         self.connections_file = os.path.join(self.config_dir, "connections.enc")
         self.key_file = os.path.join(self.config_dir, "key.salt")
+        self.cache_dir = os.path.join(self.config_dir, "cache")
+        self.agent_socket = os.path.join(self.config_dir, "agent.sock")
+        self.identity_cache_file = os.path.join(self.cache_dir, "identity.json")
+        self.target_cache_file = os.path.join(self.cache_dir, "targets.json")
+        self.profile_catalog = ProfileCatalog(os.path.join(self.cache_dir, "profiles.json"), self.write_file_atomic)
+        self.inventory_ttl = INVENTORY_CACHE_TTL
+        self.engine = 'cli'
+        self.kdf = DEFAULT_KDF
+        self.standby = None
+        self.metrics = MetricsRegistry()
+        self.print_lock = threading.Lock()
+        self.discovery_regions = None
+        self.discovery_profiles = None
+        self.port_range = LOCAL_PORT_RANGE
+        self.sessions = {}
+        self.clients = {}
+        # Guards profile_locks only; each profile's lock guards its session and clients
+        self.client_lock = threading.Lock()
+        self.profile_locks = {}
+        self.identity_cache = {}
+        self.auth_lock = threading.Lock()
+        self.identity_lock = threading.Lock()
+        self.target_lock = threading.Lock()
         self.connections = {}
+        self.encryption_key = None
         self.ensure_config_dir()
         
     def ensure_config_dir(self):
         """Create config directory if it doesn't exist"""
         if not os.path.exists(self.config_dir):
             os.makedirs(self.config_dir)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
             
-    def get_encryption_key(self, password=None):
-        """Get or create encryption key based on password"""
+    def get_encryption_key(self, password=None, salt=None, kdf=None):
+        """Get encryption key based on password, the store salt and the store key derivation"""
+        if salt is None:
+            salt = self.get_store_salt()
+        if kdf is None:
+            kdf = self.get_store_kdf()
         if not password:
-            if os.path.exists(self.key_file):
-                try:
-                    with open(self.key_file, 'rb') as f:
-                        salt = f.read()
-                    password = getpass.getpass("Enter password to decrypt connections: ")
-                except IOError as e:
-                    print(f"Error reading key file: {e}")
-                    salt = os.urandom(16)
-                    password = getpass.getpass("Create a password to encrypt connections: ")
-                    with open(self.key_file, 'wb') as f:
-                        f.write(salt)
-            else:
-                salt = os.urandom(16)
-                password = getpass.getpass("Create a password to encrypt connections: ")
-                with open(self.key_file, 'wb') as f:
-                    f.write(salt)
-        else:
-            if os.path.exists(self.key_file):
-                with open(self.key_file, 'rb') as f:
-                    salt = f.read()
-            else:
-                salt = os.urandom(16)
-                with open(self.key_file, 'wb') as f:
-                    f.write(salt)
-                
+            password = getpass.getpass("Enter password to decrypt connections: ")
+            
         # Ensure password is not empty
         if not password or password.strip() == "":
             raise ValueError("Password cannot be empty")
-                
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        return key
+            
+        return KeyDerivation.derive(password, salt, kdf)
+        
+    def write_file_atomic(self, path, data):
+        """Write a file readable only by its owner, replacing the old one with a rename"""
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, path)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+            
+    @contextmanager
+    def store_lock(self):
+        """Hold the exclusive lock that serializes writers of the connection store"""
+        with open(self.store_lock_file, 'a+') as lock:
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == 'nt':
+                    import msvcrt
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    
+    def store_exists(self):
+        """Check if the connection store has been created"""
+        if not os.path.exists(self.store_meta_file) and os.path.exists(os.path.join(self.store_dir + ".new", "meta.json")):
+            # A password change was interrupted after the new store was complete
+            with self.store_lock():
+                if not os.path.exists(self.store_meta_file):
+                    if os.path.exists(self.store_dir):
+                        shutil.rmtree(self.store_dir)
+                    os.rename(self.store_dir + ".new", self.store_dir)
+        return os.path.exists(self.store_meta_file)
+        
+    def read_store_meta(self):
+        """Read the store metadata: format version, salt, key derivation and password verifier"""
+        with open(self.store_meta_file, 'r') as f:
+            return json.load(f)
+            
+    def get_store_salt(self):
+        """Get the key derivation salt of the store, or of the legacy single-file store"""
+        if self.store_exists():
+            return base64.b64decode(self.read_store_meta()['salt'])
+        with open(self.key_file, 'rb') as f:
+            return f.read()
+            
+    def get_store_kdf(self):
+        """Get the key derivation parameters of the store, or of the legacy single-file store"""
+        if self.store_exists():
+            return self.read_store_meta().get('kdf', LEGACY_KDF)
+        return LEGACY_KDF
+        
+    def verify_key(self, key):
+        """Raise InvalidToken unless the key opens the store"""
+        from cryptography.fernet import Fernet, InvalidToken
+        
+        verifier = self.read_store_meta()['verifier'].encode()
+        if Fernet(key).decrypt(verifier) != STORE_VERIFIER:
+            raise InvalidToken
+            
+    def get_record_file(self, name, key):
+        """Get the file of a connection record; names are hashed with the key so they stay private"""
+        digest = hmac.new(key, name.encode(), hashlib.sha256).hexdigest()
+        return os.path.join(self.store_dir, f"{digest}.enc")
+        
+    def encrypt_record(self, fernet, name, connection):
+        """Encrypt one connection record"""
+        return fernet.encrypt(json.dumps({'name': name, 'connection': connection}).encode())
+        
+    def write_store(self, store_dir, salt, key, connections, kdf):
+        """Write a complete store into an empty directory, `key` being derived with `kdf`"""
+        from cryptography.fernet import Fernet
+        
+        fernet = Fernet(key)
+        os.makedirs(store_dir, mode=0o700)
+        for name, connection in connections.items():
+            record_file = os.path.join(store_dir, os.path.basename(self.get_record_file(name, key)))
+            self.write_file_atomic(record_file, self.encrypt_record(fernet, name, connection))
+        # The metadata goes last: a store directory without it is incomplete
+        meta = {
+            'version': STORE_VERSION,
+            'salt': base64.b64encode(salt).decode(),
+            'kdf': kdf,
+            'verifier': fernet.encrypt(STORE_VERIFIER).decode()
+        }
+        self.write_file_atomic(os.path.join(store_dir, "meta.json"), json.dumps(meta).encode())
+        
+    def read_records(self, key):
+        """Decrypt every connection record of the store"""
+        from cryptography.fernet import Fernet, InvalidToken
+        
+        fernet = Fernet(key)
+        connections = {}
+        for record_name in os.listdir(self.store_dir):
+            if not record_name.endswith('.enc'):
+                continue
+            try:
+                with open(os.path.join(self.store_dir, record_name), 'rb') as f:
+                    record = json.loads(fernet.decrypt(f.read()).decode())
+                connections[record['name']] = record['connection']
+            except FileNotFoundError:
+                # Deleted by another invocation since the directory was listed
+                continue
+            except (InvalidToken, ValueError, KeyError, IOError) as e:
+                print(f"Warning: Skipping unreadable connection record {record_name}: {type(e).__name__}")
+        return connections
         
+    def migrate_legacy_store(self, key, connections):
+        """Convert the single-file store to the per-record store, keeping the same password"""
+        with self.store_lock():
+            if self.store_exists():
+                return
+            tmp_dir = self.store_dir + ".new"
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            self.write_store(tmp_dir, self.get_store_salt(), key, connections, LEGACY_KDF)
+            os.rename(tmp_dir, self.store_dir)
+            os.replace(self.connections_file, self.connections_file + ".migrated")
+        print(f"Migrated {len(connections)} connections to the per-record store")
+        
+    def remove_legacy_store(self):
+        """Delete the migrated single-file store and its salt.
+        
+        They still open with the original password and its weak key
+        derivation, whatever the password and key derivation of the store.
+        """
+        for path in (self.connections_file + ".migrated", self.key_file):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"Warning: Could not delete {path}: {e}")
+                
     def load_connections(self):
-        """Load saved connections from encrypted file"""
-        if not os.path.exists(self.connections_file):
+        """Load saved connections from the encrypted store"""
+        from cryptography.fernet import Fernet, InvalidToken
+        
+        legacy = not self.store_exists()
+        if legacy and not os.path.exists(self.connections_file):
             self.connections = {}
             return
             
+        # A running unlock agent saves the password prompt and the key derivation
+        agent_key = UnlockAgent.request(self.agent_socket, b"GET")
+        keys = [agent_key] if agent_key else []
+        
         max_attempts = 3
         attempts = 0
         
         while attempts < max_attempts:
             try:
-                key = self.get_encryption_key()
-                fernet = Fernet(key)
+                password = None
+                if keys:
+                    key = keys.pop()
+                else:
+                    password = getpass.getpass("Enter password to decrypt connections: ")
+                    key = self.get_encryption_key(password)
                 
-                with open(self.connections_file, 'rb') as f:
-                    encrypted_data = f.read()
+                if legacy:
+                    with open(self.connections_file, 'rb') as f:
+                        connections = json.loads(Fernet(key).decrypt(f.read()).decode())
+                    self.migrate_legacy_store(key, connections)
+                else:
+                    self.verify_key(key)
                     
-                decrypted_data = fernet.decrypt(encrypted_data)
-                self.connections = json.loads(decrypted_data.decode())
+                self.connections = self.read_records(key)
+                # The old copy goes once every connection has been read back from the store
+                if not legacy or set(connections) <= set(self.connections):
+                    self.remove_legacy_store()
+                # Keep the key so saving in this run does not prompt and derive again
+                self.encryption_key = key
                 print(f"Loaded {len(self.connections)} saved connections")
+                if password and KeyDerivation.is_weak(self.get_store_kdf()):
+                    self.upgrade_store_kdf(password)
                 return
             except InvalidToken:
+                if key == agent_key:
+                    print("The unlock agent holds an outdated key, asking for the password")
+                    agent_key = None
+                    continue
                 attempts += 1
                 if attempts < max_attempts:
                     print(f"Error: Incorrect password. Attempt {attempts} of {max_attempts}")
@@ -100,96 +2194,317 @@ class SSMPortForwarder:
             except ValueError as e:
                 print(f"Error: {str(e)}")
                 break
-            except json.JSONDecodeError:
-                print("Error: Connection file is corrupted")
-                break
             except IOError as e:
-                print(f"Error reading connection file: {e}")
+                print(f"Error reading connection store: {e}")
                 break
                 
         self.connections = {}
+        
+    def get_store_key(self):
+        """Get the key of the store, creating the store on first use. Returns None on failure"""
+        from cryptography.fernet import InvalidToken
+        
+        if self.encryption_key:
+            return self.encryption_key
             
-    def save_connections(self):
-        """Save connections to encrypted file"""
         try:
-            # If first time saving, request password confirmation
-            if not os.path.exists(self.connections_file):
+            if self.store_exists():
+                # A running unlock agent saves the password prompt
+                key = UnlockAgent.request(self.agent_socket, b"GET")
+                if key:
+                    try:
+                        self.verify_key(key)
+                    except (InvalidToken, ValueError):
+                        key = None
+                if not key:
+                    key = self.get_encryption_key()
+                    self.verify_key(key)
+            else:
+                # If first time saving, request password confirmation
                 password = getpass.getpass("Create a password to encrypt connections: ")
                 if not password or password.strip() == "":
                     print("Error: Password cannot be empty")
-                    return
+                    return None
                     
                 confirm_password = getpass.getpass("Confirm password: ")
                 if password != confirm_password:
                     print("Error: Passwords do not match")
+                    return None
+                    
+                salt = os.urandom(16)
+                kdf = KeyDerivation.DEFAULTS[self.kdf]
+                key = self.get_encryption_key(password, salt, kdf)
+                with self.store_lock():
+                    if self.store_exists():
+                        print("Error: The connection store was created by another session, try again")
+                        return None
+                    self.write_store(self.store_dir, salt, key, {}, kdf)
+        except InvalidToken:
+            print("Error: Incorrect password")
+            return None
+        except ValueError as e:
+            print(f"Error: {str(e)}")
+            return None
+            
+        self.encryption_key = key
+        return key
+        
+    @contextmanager
+    def writable_store(self):
+        """Hold the store lock with a key that opens the store as it is now, or yield None.
+        
+        Another invocation may have changed the password or the key derivation
+        since the key was derived; records written with the old key could not
+        be read back, so the key is asked for again, from the unlock agent or
+        the password, before writing.
+        """
+        from cryptography.fernet import InvalidToken
+        
+        for _ in range(2):
+            key = self.get_store_key()
+            if not key:
+                break
+            with self.store_lock():
+                try:
+                    self.verify_key(key)
+                except InvalidToken:
+                    pass
+                else:
+                    yield key
                     return
-                
-                key = self.get_encryption_key(password)
-            else:
-                key = self.get_encryption_key()
-                
-            fernet = Fernet(key)
+            print("The connection store was re-encrypted by another session, asking for its key again")
+            self.encryption_key = None
+        else:
+            print("Error: The connection store keeps changing, try again")
+        yield None
+        
+    def save_connection(self, name, quiet=False):
+        """Save one connection record; costs the same whatever the size of the store"""
+        from cryptography.fernet import Fernet
+        
+        try:
+            with self.writable_store() as key:
+                if not key:
+                    return False
+                self.write_file_atomic(
+                    self.get_record_file(name, key), self.encrypt_record(Fernet(key), name, self.connections[name])
+                )
+            if not quiet:
+                print(f"Saved connection '{name}'")
+            return True
+        except (IOError, OSError) as e:
+            print(f"Error saving connection '{name}': {e}")
+            return False
             
-            encrypted_data = fernet.encrypt(json.dumps(self.connections).encode())
+    def remove_connection(self, name):
+        """Delete one connection record from the store"""
+        try:
+            with self.writable_store() as key:
+                if not key:
+                    return False
+                record_file = self.get_record_file(name, key)
+                if os.path.exists(record_file):
+                    os.remove(record_file)
+            return True
+        except (IOError, OSError) as e:
+            print(f"Error deleting connection '{name}': {e}")
+            return False
             
-            with open(self.connections_file, 'wb') as f:
-                f.write(encrypted_data)
-                
-            print(f"Saved {len(self.connections)} connections")
-        except ValueError as e:
-            print(f"Error: {str(e)}")
-        except IOError as e:
-            print(f"Error saving connections file: {e}")
-        except Exception as e:
-            print(f"Error saving connections: {str(e)}")
-            print(f"Exception type: {type(e).__name__}")
+    def save_connections(self, names):
+        """Save the records of several connections under one lock and one key derivation.
+        
+        Records of other connections are left as they are, so connections
+        saved by other invocations are kept.
+        """
+        from cryptography.fernet import Fernet
+        
+        try:
+            with self.writable_store() as key:
+                if not key:
+                    return
+                fernet = Fernet(key)
+                for name in names:
+                    self.write_file_atomic(
+                        self.get_record_file(name, key), self.encrypt_record(fernet, name, self.connections[name])
+                    )
+            print(f"Saved {len(names)} connections")
+        except (IOError, OSError) as e:
+            print(f"Error saving connections: {e}")
             
+    def touch_connection(self, name):
+        """Record when a connection was last used"""
+        self.connections[name]['last_used'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.save_connection(name, quiet=True)
+        
     def get_aws_profiles(self):
-        """Get available AWS profiles"""
-        profiles = []
-        
-        # Check ~/.aws/credentials
-        credentials_path = os.path.expanduser("~/.aws/credentials")
-        if os.path.exists(credentials_path):
-            with open(credentials_path, 'r') as f:
-                for line in f:
-                    if line.strip().startswith('[') and line.strip().endswith(']'):
-                        profile = line.strip()[1:-1]
-                        if profile != 'default' and profile not in profiles:
-                            profiles.append(profile)
-        
-        # Check ~/.aws/config for SSO profiles
-        config_path = os.path.expanduser("~/.aws/config")
-        if os.path.exists(config_path):
-            with open(config_path, 'r') as f:
-                for line in f:
-                    if line.strip().startswith('[profile '):
-                        profile = line.strip()[9:-1]
-                        if profile not in profiles:
-                            profiles.append(profile)
-        
-        # Add default profile
-        if 'default' not in profiles:
-            profiles.insert(0, 'default')
+        """Get available AWS profiles, 'default' first"""
+        return list(self.profile_catalog.load())
+        
+    def get_profile_info(self, profile):
+        """Get the metadata of a profile (region, sso_account_id, ...) from the AWS config files"""
+        return self.profile_catalog.load().get(profile, {})
+        
+    def get_profile_lock(self, profile):
+        """Get the lock that serializes the use of one profile's boto3 session"""
+        with self.client_lock:
+            if profile not in self.profile_locks:
+                self.profile_locks[profile] = threading.RLock()
+            return self.profile_locks[profile]
+            
+    def get_session(self, profile):
+        """Get the boto3 session for a profile, built once per process"""
+        import boto3
+        
+        with self.get_profile_lock(profile):
+            if profile not in self.sessions:
+                self.sessions[profile] = boto3.Session(profile_name=profile)
+            return self.sessions[profile]
+            
+    def get_client(self, profile, service, region=None):
+        """Get a boto3 client with adaptive retries, built once per profile, service and region.
+        
+        boto3 sessions are not thread-safe, so each profile's clients are
+        created one at a time, while other profiles create theirs in
+        parallel; the clients themselves can then be used from any thread.
+        """
+        from botocore.config import Config
+        
+        key = (profile, service, region)
+        client = self.clients.get(key)
+        if client is None:
+            with self.get_profile_lock(profile):
+                client = self.clients.get(key)
+                if client is None:
+                    client = self.clients[key] = self.get_session(profile).client(
+                        service,
+                        region_name=region,
+                        config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+                    )
+        return client
+        
+    def forget_session(self, profile):
+        """Drop a profile's boto3 session and clients, so the next call reads its credentials again"""
+        with self.get_profile_lock(profile):
+            self.sessions.pop(profile, None)
+            for key in [key for key in self.clients if key[0] == profile]:
+                del self.clients[key]
+                
+    def load_identity_cache(self):
+        """Load cached caller identities from disk"""
+        try:
+            with open(self.identity_cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+            
+    def save_identity_cache(self, cache):
+        """Save cached caller identities to disk using an atomic rename"""
+        try:
+            self.write_file_atomic(self.identity_cache_file, json.dumps(cache).encode())
+        except (IOError, OSError) as e:
+            print(f"Error saving identity cache: {e}")
+            
+    def invalidate_identity_cache(self, profile=None):
+        """Forget cached identities, for one profile or for all of them"""
+        if profile:
+            self.identity_cache.pop(profile, None)
+            cache = self.load_identity_cache()
+            if cache.pop(profile, None) is not None:
+                self.save_identity_cache(cache)
         else:
-            profiles.remove('default')
-            profiles.insert(0, 'default')
+            self.identity_cache = {}
+            if os.path.exists(self.identity_cache_file):
+                os.remove(self.identity_cache_file)
+                
+    def get_sso_token_file(self, profile):
+        """Get the SSO token cache file used by a profile, or None if it is not an SSO profile"""
+        # The AWS CLI names the cache file after the sso-session, or the start URL of legacy profiles
+        info = self.get_profile_info(profile)
+        token_key = info.get('sso_session') or info.get('sso_start_url')
+        if not token_key:
+            return None
+        token_name = hashlib.sha1(token_key.encode()).hexdigest()
+        return os.path.expanduser(os.path.join("~/.aws/sso/cache", f"{token_name}.json"))
+        
+    def get_sso_token_expiry(self, token_file):
+        """Get the expiry timestamp of a cached SSO token, or None if there is no usable token"""
+        try:
+            with open(token_file, 'r') as f:
+                expires_at = json.load(f)['expiresAt']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+        expires_at = expires_at.replace('UTC', '+00:00').replace('Z', '+00:00')
+        try:
+            return datetime.fromisoformat(expires_at).timestamp()
+        except ValueError:
+            return None
             
-        return profiles
+    def is_identity_cached(self, profile):
+        """Check, without any network call, if a previous identity check is still valid"""
+        entry = self.identity_cache.get(profile)
+        if entry is None:
+            entry = self.load_identity_cache().get(profile)
+        if not entry or entry['expires_at'] - IDENTITY_CACHE_MARGIN <= time.time():
+            return False
+            
+        # The SSO token may have been removed (aws sso logout) or replaced since
+        if entry.get('sso_token_file'):
+            token_expiry = self.get_sso_token_expiry(entry['sso_token_file'])
+            if token_expiry is None or token_expiry - IDENTITY_CACHE_MARGIN <= time.time():
+                return False
+                
+        self.identity_cache[profile] = entry
+        return True
         
-    def check_sso_login(self, profile):
+    def get_credentials_expiry(self, profile, session):
+        """Get when the credentials of a profile's session stop being usable"""
+        expires_at = time.time() + IDENTITY_CACHE_MAX_AGE
+        
+        sso_token_file = self.get_sso_token_file(profile)
+        if sso_token_file:
+            # SSO role credentials are refreshed from the token until the token expires
+            token_expiry = self.get_sso_token_expiry(sso_token_file)
+            if token_expiry:
+                expires_at = token_expiry
+        else:
+            credentials = session.get_credentials()
+            expiry_time = getattr(credentials, '_expiry_time', None)
+            if expiry_time:
+                expires_at = expiry_time.timestamp()
+                
+        return expires_at, sso_token_file
+        
+    def check_sso_login(self, profile, prompt=True):
         """Check if SSO login is needed and perform login if necessary"""
+        from botocore.exceptions import BotoCoreError, ClientError
+        
         # Validate that profile only contains allowed characters
         if not re.match(r'^[a-zA-Z0-9_-]+$', profile):
             print(f"ERROR: Invalid profile name: {profile}")
             return False
             
+        if self.is_identity_cached(profile):
+            return True
+            
         try:
-            # Use argument list instead of shell=True
-            cmd = ["aws", "sts", "get-caller-identity", "--profile", profile]
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            with self.metrics.timed('sso_check'):
+                session = self.get_session(profile)
+                identity = self.get_client(profile, 'sts').get_caller_identity()
+                expires_at, sso_token_file = self.get_credentials_expiry(profile, session)
+            
+            entry = {
+                'account': identity['Account'],
+                'arn': identity['Arn'],
+                'expires_at': expires_at,
+                'sso_token_file': sso_token_file
+            }
+            with self.identity_lock:
+                self.identity_cache[profile] = entry
+                cache = self.load_identity_cache()
+                cache[profile] = entry
+                self.save_identity_cache(cache)
             return True
-        except subprocess.CalledProcessError:
+        except (BotoCoreError, ClientError):
             print("\n" + "=" * 70)
             print(f"ERROR: You are not logged in with AWS SSO profile '{profile}'")
             print(f"\nTo continue, please run this command in your terminal and follow the prompts:")
@@ -197,10 +2512,14 @@ class SSMPortForwarder:
             print("\nAfter successful login, run this script again.")
             print("=" * 70 + "\n")
             
+            if not prompt:
+                return False
+                
             # Optionally, ask if user wants to open browser for SSO
             try:
                 response = input("Would you like to open the AWS SSO login page now? (y/n): ")
                 if response.lower() == 'y':
+                    import webbrowser
                     print("Opening AWS SSO login page...")
                     # Use webbrowser to open login page (safer than executing commands)
                     webbrowser.open("https://signin.aws.amazon.com/signin")
@@ -209,95 +2528,629 @@ class SSMPortForwarder:
                 
             return False
                 
-    def get_ssm_instances(self, profile):
-        """Get instances managed by SSM"""
-        # Create boto3 session with specified profile
-        session = boto3.Session(profile_name=profile)
-        ssm_client = session.client('ssm')
-        ec2_client = session.client('ec2')
-        
-        # Get instances managed by SSM
-        instances = []
+    def load_target_cache(self):
+        """Load cached target resolutions from disk"""
         try:
-            response = ssm_client.describe_instance_information()
+            with open(self.target_cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
             
-            for instance in response['InstanceInformationList']:
-                instance_id = instance['InstanceId']
-                status = instance['PingStatus']
+    def save_target_cache(self, cache):
+        """Save cached target resolutions to disk using an atomic rename"""
+        try:
+            self.write_file_atomic(self.target_cache_file, json.dumps(cache).encode())
+        except (IOError, OSError) as e:
+            print(f"Error saving target cache: {e}")
+            
+    def get_target_cache_key(self, connection):
+        """Get the target cache key of a connection with a target selector"""
+        profile = connection['profile']
+        region = connection.get('region') or self.get_profile_region(profile)
+        return f"{profile}|{region}|{connection['target']}"
+        
+    def invalidate_target_cache(self, connection):
+        """Forget the cached resolution of a connection's target selector, if it has one"""
+        if not connection.get('target'):
+            return
+        key = self.get_target_cache_key(connection)
+        with self.target_lock:
+            cache = self.load_target_cache()
+            if cache.pop(key, None) is not None:
+                self.save_target_cache(cache)
                 
-                # Skip instances that are not online
-                if status != 'Online':
-                    continue
-                    
-                # Get instance details from EC2
-                try:
-                    ec2_response = ec2_client.describe_instances(InstanceIds=[instance_id])
-                    ec2_instance = ec2_response['Reservations'][0]['Instances'][0]
-                    
-                    # Get instance name from tags
-                    name = instance_id
-                    for tag in ec2_instance.get('Tags', []):
-                        if tag['Key'] == 'Name':
-                            name = tag['Value']
-                            break
-                            
-                    # Get private IP
-                    private_ip = ec2_instance.get('PrivateIpAddress', 'N/A')
-                    
-                    instances.append({
-                        'id': instance_id,
-                        'name': name,
-                        'ip': private_ip,
-                        'status': status
-                    })
-                except Exception as e:
-                    print(f"Error getting EC2 details for instance {instance_id}: {e}")
-                    
-            return instances
+    def resolve_target(self, connection, refresh=False):
+        """Get the connection with the instance its target selector points to right now.
+        
+        Connections without a target are returned as they are. Resolutions
+        are cached for TARGET_CACHE_TTL seconds; `refresh` looks the target
+        up again, for when a session on the cached instance failed. Raises
+        LookupError when no online instance matches.
+        """
+        target = connection.get('target')
+        if not target:
+            return connection
+            
+        profile = connection['profile']
+        region = connection.get('region') or self.get_profile_region(profile)
+        key = self.get_target_cache_key(connection)
+        with self.target_lock:
+            entry = self.load_target_cache().get(key)
+        if refresh or not entry or time.time() - entry['resolved_at'] >= TARGET_CACHE_TTL:
+            # Looked up without the lock, so tunnels with other targets resolve in parallel
+            entry = {'instance_id': self.lookup_target(profile, region, target), 'resolved_at': time.time()}
+            with self.target_lock:
+                cache = self.load_target_cache()
+                cache[key] = entry
+                self.save_target_cache(cache)
+        return dict(connection, instance_id=entry['instance_id'])
+        
+    def lookup_target(self, profile, region, target):
+        """Find the healthiest online instance matching a tag selector ('Role=jump', or a Name)"""
+        key, _, value = target.partition('=') if '=' in target else ('Name', '=', target)
+        try:
+            ec2_client = self.get_client(profile, 'ec2', region)
+            ssm_client = self.get_client(profile, 'ssm', region)
+            
+            # Running instances with the tag, filtered server side
+            candidates = {}
+            paginator = ec2_client.get_paginator('describe_instances')
+            for page in paginator.paginate(Filters=[
+                {'Name': f"tag:{key.strip()}", 'Values': [value.strip()]},
+                {'Name': 'instance-state-name', 'Values': ['running']}
+            ]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        candidates[instance['InstanceId']] = instance
+                        
+            # Their SSM agent status, in batches of ids
+            instance_ids = list(candidates)
+            online = []
+            paginator = ssm_client.get_paginator('describe_instance_information')
+            for start in range(0, len(instance_ids), SSM_INSTANCE_FILTER_BATCH):
+                batch = instance_ids[start:start + SSM_INSTANCE_FILTER_BATCH]
+                pages = paginator.paginate(
+                    Filters=[{'Key': 'InstanceIds', 'Values': batch}],
+                    PaginationConfig={'PageSize': SSM_DESCRIBE_PAGE_SIZE}
+                )
+                for page in pages:
+                    online.extend(i for i in page['InstanceInformationList'] if i['PingStatus'] == 'Online')
+        except Exception as e:
+            raise LookupError(f"Could not look up '{target}': {e}")
+            
+        if not online:
+            raise LookupError(f"No running instance with '{target}' is online in SSM")
+            
+        def health(info):
+            # Latest agent heartbeat first, then the newest instance
+            last_ping = info.get('LastPingDateTime')
+            launched = candidates[info['InstanceId']].get('LaunchTime')
+            return (last_ping.timestamp() if last_ping else 0, launched.timestamp() if launched else 0)
+            
+        return max(online, key=health)['InstanceId']
+        
+    def get_ssm_instances(self, profile, region=None):
+        """Get instances managed by SSM"""
+        try:
+            with self.metrics.timed('inventory'):
+                return self.fetch_ssm_instances(profile, region)
         except Exception as e:
             print(f"Error getting SSM instances: {e}")
             return []
             
-    def start_port_forwarding(self, connection):
+    def fetch_ssm_instances(self, profile, region=None):
+        """Get instances managed by SSM in a region, raising if SSM cannot be listed"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        # Reuse the boto3 session for the specified profile
+        ssm_client = self.get_client(profile, 'ssm', region)
+        ec2_client = self.get_client(profile, 'ec2', region)
+        
+        # Get online instances managed by SSM, filtered server side and paginated
+        paginator = ssm_client.get_paginator('describe_instance_information')
+        pages = paginator.paginate(
+            Filters=[{'Key': 'PingStatus', 'Values': ['Online']}],
+            PaginationConfig={'PageSize': SSM_DESCRIBE_PAGE_SIZE}
+        )
+        ssm_instances = []
+        for page in pages:
+            ssm_instances.extend(page['InstanceInformationList'])
+            
+        # Hybrid managed nodes (mi-*) are not EC2 instances and would make the whole
+        # describe_instances batch fail, so only EC2 ids are sent to EC2
+        ec2_ids = [i['InstanceId'] for i in ssm_instances if i['InstanceId'].startswith('i-')]
+        batches = [
+            ec2_ids[start:start + EC2_DESCRIBE_BATCH_SIZE]
+            for start in range(0, len(ec2_ids), EC2_DESCRIBE_BATCH_SIZE)
+        ]
+        
+        # Get instance details from EC2, one call per batch, batches in parallel
+        ec2_details = {}
+        if batches:
+            workers = min(DISCOVERY_MAX_WORKERS, len(batches))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for details in executor.map(
+                        lambda batch: self._describe_ec2_batch(ec2_client, batch), batches):
+                    ec2_details.update(details)
+                    
+        instances = []
+        for ssm_instance in ssm_instances:
+            instance_id = ssm_instance['InstanceId']
+            ec2_instance = ec2_details.get(instance_id)
+            
+            if ec2_instance is not None:
+                # Get instance name from tags
+                tags = {tag['Key']: tag['Value'] for tag in ec2_instance.get('Tags', [])}
+                name = tags.get('Name', instance_id)
+                
+                # Get private IP
+                private_ip = ec2_instance.get('PrivateIpAddress', 'N/A')
+            else:
+                # Fall back to what the SSM agent reports about itself
+                tags = {}
+                name = ssm_instance.get('Name') or ssm_instance.get('ComputerName') or instance_id
+                private_ip = ssm_instance.get('IPAddress', 'N/A')
+                
+            instances.append({
+                'id': instance_id,
+                'name': name,
+                'ip': private_ip,
+                'status': ssm_instance['PingStatus'],
+                'tags': tags
+            })
+            
+        return instances
+        
+    def _describe_ec2_batch(self, ec2_client, instance_ids):
+        """Describe a batch of EC2 instances and index them by instance id"""
+        from botocore.exceptions import ClientError
+        
+        details = {}
+        try:
+            response = ec2_client.describe_instances(InstanceIds=instance_ids)
+        except ClientError as e:
+            # A single stale id fails the whole batch; bisect it so a few stale ids
+            # cost a logarithmic number of extra calls instead of one per id
+            if len(instance_ids) > 1 and e.response['Error']['Code'].startswith('InvalidInstanceID'):
+                middle = len(instance_ids) // 2
+                details.update(self._describe_ec2_batch(ec2_client, instance_ids[:middle]))
+                details.update(self._describe_ec2_batch(ec2_client, instance_ids[middle:]))
+            else:
+                print(f"Error getting EC2 details for instances {', '.join(instance_ids)}: {e}")
+            return details
+        except Exception as e:
+            print(f"Error getting EC2 details for instances {', '.join(instance_ids)}: {e}")
+            return details
+            
+        for reservation in response['Reservations']:
+            for ec2_instance in reservation['Instances']:
+                details[ec2_instance['InstanceId']] = ec2_instance
+        return details
+            
+    def get_profile_region(self, profile):
+        """Get the region configured for a profile, without building a boto3 session"""
+        region = os.environ.get('AWS_DEFAULT_REGION') or self.get_profile_info(profile).get('region')
+        if region:
+            return region
+        return self.get_session(profile).region_name or 'us-east-1'
+        
+    def get_inventory_cache_file(self, profile, region):
+        """Get the inventory cache file for a profile and region"""
+        return os.path.join(self.cache_dir, f"inventory-{profile}-{region}.json")
+        
+    def load_inventory_cache(self, profile, region):
+        """Load cached instances for a profile and region, returns (instances, age)"""
+        cache_file = self.get_inventory_cache_file(profile, region)
+        try:
+            with open(cache_file, 'r') as f:
+                data = json.load(f)
+            return data['instances'], time.time() - data['fetched_at']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None, None
+            
+    def save_inventory_cache(self, profile, region, instances):
+        """Save instances to the inventory cache using an atomic rename"""
+        cache_file = self.get_inventory_cache_file(profile, region)
+        try:
+            self.write_file_atomic(cache_file, json.dumps({'fetched_at': time.time(), 'instances': instances}).encode())
+        except (IOError, OSError) as e:
+            print(f"Error saving inventory cache: {e}")
+            
+    def invalidate_inventory_cache(self, profile=None):
+        """Delete cached inventories, for one profile or for all of them"""
+        prefix = f"inventory-{profile}-" if profile else "inventory-"
+        removed = 0
+        for cache_name in os.listdir(self.cache_dir):
+            if cache_name.startswith(prefix) and cache_name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, cache_name))
+                removed += 1
+        return removed
+        
+    def refresh_inventory(self, profile, region):
+        """Fetch instances from AWS and store them in the inventory cache"""
+        instances = self.get_ssm_instances(profile, region)
+        # An empty result may be a transient error, keep the previous cache
+        if instances:
+            self.save_inventory_cache(profile, region, instances)
+        return instances
+        
+    def refresh_inventory_async(self, profile, region):
+        """Refresh the inventory cache in a background thread"""
+        result = {}
+        
+        def worker():
+            result['instances'] = self.refresh_inventory(profile, region)
+            
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.result = result
+        thread.start()
+        return thread
+        
+    def get_cached_ssm_instances(self, profile):
+        """Get instances from the inventory cache, refreshing it when stale.
+        
+        Returns (instances, refresh_thread). Fresh cache entries are returned
+        without touching AWS. Stale entries are returned at once while a
+        background thread refreshes them. Only a missing cache blocks on AWS.
+        """
+        region = self.get_profile_region(profile)
+        instances, age = self.load_inventory_cache(profile, region)
+        
+        if instances is None:
+            print(f"\nGetting instances managed by SSM for profile '{profile}'...")
+            return self.refresh_inventory(profile, region), None
+            
+        print(f"\nUsing cached instances for profile '{profile}' ({int(age)}s old)")
+        if age < self.inventory_ttl:
+            return instances, None
+        return instances, self.refresh_inventory_async(profile, region)
+        
+    def get_discovery_targets(self, profiles=None, regions=None):
+        """Get the (profile, region) pairs to search, a None region meaning the profile's default"""
+        if profiles is None and self.discovery_profiles:
+            profiles = self.profile_catalog.select(self.discovery_profiles)
+        elif profiles is None:
+            profiles = self.get_aws_profiles()
+        return [(profile, region) for profile in profiles for region in (regions or [None])]
+        
+    def discover_target(self, profile, region=None):
+        """Get the SSM instances of one profile/region pair, from the inventory cache while it is fresh"""
+        region = region or self.get_profile_region(profile)
+        instances, age = self.load_inventory_cache(profile, region)
+        if instances is None or age >= self.inventory_ttl:
+            instances = self.fetch_ssm_instances(profile, region)
+            if instances:
+                self.save_inventory_cache(profile, region, instances)
+        return [dict(instance, profile=profile, region=region) for instance in instances]
+        
+    def discover_instances(self, profiles=None, regions=None, targets=None):
+        """Search SSM instances across profiles and regions in parallel.
+        
+        Runs AsyncPortForwarder.discover, so every profile/region pair is
+        searched at the same time, up to DISCOVERY_MAX_TARGETS, and the total
+        time is close to the slowest pair rather than the sum of all. Returns
+        one list, sorted by name, where each instance is tagged with its
+        profile and region. `targets` gives the (profile, region) pairs
+        directly instead of every profile in every region.
+        """
+        import asyncio
+        
+        if targets is None:
+            targets = self.get_discovery_targets(profiles, regions)
+        errors = []
+        
+        async def discover():
+            async with AsyncPortForwarder(self) as api:
+                return await api.discover(targets=targets, errors=errors)
+                
+        print(f"Searching {len(targets)} profile/region combinations...")
+        started_at = time.time()
+        discovered = asyncio.run(discover())
+        
+        print(f"Found {len(discovered)} instances in {time.time() - started_at:.1f}s")
+        if errors:
+            print(f"Skipped {len(errors)} profile/region combinations:")
+            for profile, region, error in errors:
+                print(f"  {profile}/{region or 'default region'}: {str(error).splitlines()[0]}")
+                
+        return discovered
+        
+    def search_instances(self, instances, query):
+        """Filter instances whose name, id, IP, profile or region contain every word of the query"""
+        terms = query.lower().split()
+        if not terms:
+            return instances
+        matches = []
+        for instance in instances:
+            haystack = " ".join(
+                str(instance.get(field, '')) for field in ('name', 'id', 'ip', 'profile', 'region')
+            ).lower()
+            if all(term in haystack for term in terms):
+                matches.append(instance)
+        return matches
+        
+    def show_discovered_instances(self, query, regions=None):
+        """Print the instances of every profile and region that match a query"""
+        from tabulate import tabulate
+        
+        instances = self.search_instances(self.discover_instances(regions=regions), query or '')
+        if not instances:
+            print("No matching instances found")
+            return
+        table_data = [[i['profile'], i['region'], i['name'], i['id'], i['ip']] for i in instances]
+        headers = ["Profile", "Region", "Name", "Instance ID", "IP"]
+        print(tabulate(table_data, headers=headers, tablefmt="grid"))
+        
+    def build_port_forwarding_command(self, connection):
+        """Build the aws CLI command that runs a port forwarding session"""
+        # Prepare parameters as a JSON string
+        parameters = json.dumps({
+            "host": [connection['remote_host']],
+            "portNumber": [connection['remote_port']],
+            "localPortNumber": [connection['local_port']]
+        })
+        
+        # Use argument list instead of shell=True
+        cmd = [
+            "aws", "ssm", "start-session",
+            "--profile", connection['profile'],
+            "--target", connection['instance_id'],
+            "--document-name", "AWS-StartPortForwardingSessionToRemoteHost",
+            "--parameters", parameters
+        ]
+        if connection.get('region'):
+            cmd += ["--region", connection['region']]
+        return cmd
+        
+    def start_port_forwarding(self, connection, name=None):
         """Start port forwarding session"""
         profile = connection['profile']
-        instance_id = connection['instance_id']
         remote_host = connection['remote_host']
         remote_port = connection['remote_port']
         local_port = connection['local_port']
         
-        # Check SSO login if needed
-        if not self.check_sso_login(profile):
-            print(f"Failed to authenticate with profile '{profile}'")
-            return
+        # Fail before authenticating if the tunnel could not listen anyway
+        if not PortAllocator.is_free(local_port):
+            print(f"Error: Local port {local_port} is already in use")
+            return
+            
+        # Check SSO login if needed
+        if not self.check_sso_login(profile):
+            print(f"Failed to authenticate with profile '{profile}'")
+            return
+            
+        # A tag-selector target that matches nothing fails here, before any session
+        try:
+            instance_id = self.resolve_target(connection)['instance_id']
+        except LookupError as e:
+            print(f"Error: {e}")
+            return
+            
+        name = name or f"localhost:{local_port}"
+        if self.engine == 'python':
+            self.start_in_process_forwarding({name: connection})
+            return
+        if self.metrics.exporting:
+            # Only the supervisor reads the session output the metrics come from
+            self.run_supervised({name: connection})
+            return
+            
+        # Start port forwarding session
+        try:
+            cmd = self.build_port_forwarding_command(dict(connection, instance_id=instance_id))
+            
+            print(f"Starting port forwarding session...")
+            print(f"Local port {local_port} → Instance {instance_id} → Remote {remote_host}:{remote_port}")
+            print("\nPress Ctrl+C to stop the session\n")
+            
+            subprocess.run(cmd, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error starting port forwarding session: {e}")
+            # The cached identity may be stale, check the credentials again next time
+            self.invalidate_identity_cache(profile)
+            # And the instance may be gone, look the target up again next time
+            self.invalidate_target_cache(connection)
+        except KeyboardInterrupt:
+            print("\nStopping port forwarding session...")
+            
+    def revalidate_credentials(self, profile):
+        """Check the credentials of a profile again, ignoring every cached result"""
+        with self.auth_lock:
+            self.invalidate_identity_cache(profile)
+            # Drop the session so that a token renewed by 'aws sso login' is picked up
+            self.forget_session(profile)
+            return self.check_sso_login(profile, prompt=False)
+            
+    def start_port_forwarding_many(self, names, reconnect=False):
+        """Start several saved connections at once and supervise them until Ctrl+C"""
+        missing = [name for name in names if name not in self.connections]
+        if missing:
+            print(f"Connection(s) not found: {', '.join(missing)}")
+            return
+            
+        # Two tunnels cannot listen on the same local port
+        names = list(dict.fromkeys(names))
+        local_ports = {}
+        for name in names:
+            local_port = self.connections[name]['local_port']
+            if local_port in local_ports:
+                print(f"Error: Connections '{local_ports[local_port]}' and '{name}' both use local port {local_port}")
+                return
+            local_ports[local_port] = name
+            
+        busy = [local_port for local_port in local_ports if not PortAllocator.is_free(local_port)]
+        if busy:
+            print(f"Error: Local port(s) already in use: {', '.join(busy)}")
+            return
+            
+        for name in names:
+            self.touch_connection(name)
+            
+        # Check SSO login once per profile
+        for profile in dict.fromkeys(self.connections[name]['profile'] for name in names):
+            if not self.check_sso_login(profile):
+                print(f"Failed to authenticate with profile '{profile}'")
+                return
+                
+        for name in names:
+            try:
+                self.resolve_target(self.connections[name])
+            except LookupError as e:
+                print(f"Error: '{name}': {e}")
+                return
+                
+        tunnels = {name: self.connections[name] for name in names}
+        if self.engine == 'python':
+            self.start_in_process_forwarding(tunnels)
+        else:
+            self.run_supervised(tunnels, reconnect)
+            
+    def run_supervised(self, tunnels, reconnect=False):
+        """Run aws CLI sessions for several connections under a TunnelSupervisor until Ctrl+C"""
+        def rebuild(name, refresh=False):
+            # Reconnects reuse the cached target resolution unless the session failed
+            return self.build_port_forwarding_command(self.resolve_target(tunnels[name], refresh))
+            
+        supervisor = TunnelSupervisor(
+            reconnect=reconnect,
+            revalidate=lambda name: self.revalidate_credentials(tunnels[name]['profile']),
+            metrics=self.metrics,
+            rebuild=rebuild
+        )
+        try:
+            print(f"Starting {len(tunnels)} port forwarding sessions...")
+            for name, connection in tunnels.items():
+                connection = self.resolve_target(connection)
+                supervisor.log(name, f"Local port {connection['local_port']} → Instance {connection['instance_id']} → "
+                                     f"Remote {connection['remote_host']}:{connection['remote_port']}")
+                supervisor.start(name, self.build_port_forwarding_command(connection), connection['local_port'])
+            print("\nPress Ctrl+C to stop all sessions\n")
+            supervisor.wait()
+        except (OSError, LookupError) as e:
+            print(f"Error starting port forwarding session: {e}")
+            supervisor.stop()
+        except KeyboardInterrupt:
+            print("\nStopping port forwarding sessions...")
+            supervisor.stop()
+            
+        if reconnect:
+            supervisor.report()
+            
+    def start_in_process_forwarding(self, tunnels):
+        """Forward several connections from one asyncio event loop, without aws CLI processes"""
+        self.run_tunnels(tunnels, 'python')
+        
+    def start_lazy_forwarding(self, names, idle_timeout=LAZY_IDLE_TIMEOUT):
+        """Listen on the local port of every connection and start each session only when a client connects"""
+        missing = [name for name in names if name not in self.connections]
+        if missing:
+            print(f"Connection(s) not found: {', '.join(missing)}")
+            return
+            
+        tunnels = {}
+        local_ports = {}
+        for name in dict.fromkeys(names):
+            local_port = self.connections[name]['local_port']
+            if local_port in local_ports:
+                print(f"Skipping '{name}': local port {local_port} is already used by '{local_ports[local_port]}'")
+            elif not PortAllocator.is_free(local_port):
+                print(f"Skipping '{name}': local port {local_port} is already in use")
+            else:
+                local_ports[local_port] = name
+                tunnels[name] = self.connections[name]
+        if not tunnels:
+            return
+            
+        self.run_tunnels(tunnels, lazy=True, idle_timeout=idle_timeout)
+        
+    def tunnel_logger(self, name):
+        """Get a function that prints a line prefixed with a tunnel name"""
+        def log(message):
+            with self.print_lock:
+                print(f"[{name}] {message}", flush=True)
+        return log
+        
+    def run_tunnels(self, tunnels, engine=None, lazy=False, idle_timeout=LAZY_IDLE_TIMEOUT):
+        """Serve tunnels from one event loop through AsyncPortForwarder until Ctrl+C"""
+        import asyncio
+        
+        async def serve():
+            async with AsyncPortForwarder(self) as api:
+                await api.serve(tunnels, engine, lazy, idle_timeout)
+                
+        print("\nPress Ctrl+C to stop forwarding\n")
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            print("\nStopping port forwarding...")
+            
+    def get_group_connections(self, group):
+        """Get the names of the saved connections that belong to a group"""
+        return [name for name, conn in self.connections.items() if conn.get('group') == group]
+        
+    def select_instance(self, profile):
+        """Ask the user to pick one of the SSM instances of a profile"""
+        # Get SSM instances, from the inventory cache when available
+        instances, refresh_thread = self.get_cached_ssm_instances(profile)
+        
+        while True:
+            if not instances:
+                print("No instances managed by SSM found")
+                return None
+                
+            # Ask for instance
+            print("\nAvailable instances:")
+            for i, instance in enumerate(instances):
+                print(f"{i+1}. {instance['name']} ({instance['id']}) - {instance['ip']}")
+                
+            selection = input("\nSelect instance (number, or 'r' to refresh the list): ")
+            if selection.strip().lower() != 'r':
+                break
+                
+            # Wait for the background refresh, or fetch from AWS if none is running
+            print(f"\nRefreshing instances managed by SSM for profile '{profile}'...")
+            if refresh_thread is None:
+                refresh_thread = self.refresh_inventory_async(profile, self.get_profile_region(profile))
+            refresh_thread.join()
+            instances = refresh_thread.result.get('instances') or instances
+            refresh_thread = None
             
-        # Start port forwarding session using argument list instead of shell=True
         try:
-            # Prepare parameters as a JSON string
-            parameters = json.dumps({
-                "host": [remote_host],
-                "portNumber": [remote_port],
-                "localPortNumber": [local_port]
-            })
+            instance_idx = int(selection) - 1
+            if instance_idx < 0 or instance_idx >= len(instances):
+                print("Error: Invalid instance selection")
+                return None
+        except ValueError:
+            print("Error: Please enter a valid number")
+            return None
             
-            cmd = [
-                "aws", "ssm", "start-session",
-                "--profile", profile,
-                "--target", instance_id,
-                "--document-name", "AWS-StartPortForwardingSessionToRemoteHost",
-                "--parameters", parameters
-            ]
+        return instances[instance_idx]
+        
+    def select_discovered_instance(self):
+        """Ask the user to pick an instance found in any profile and region"""
+        query = input("Search instances (name, id, IP, profile or region; empty for all): ")
+        instances = self.search_instances(self.discover_instances(regions=self.discovery_regions), query)
+        
+        if not instances:
+            print("No matching instances found")
+            return None
             
-            print(f"Starting port forwarding session...")
-            print(f"Local port {local_port} → Instance {instance_id} → Remote {remote_host}:{remote_port}")
-            print("\nPress Ctrl+C to stop the session\n")
+        print("\nMatching instances:")
+        for i, instance in enumerate(instances):
+            print(f"{i+1}. {instance['name']} ({instance['id']}) - {instance['ip']} "
+                  f"[{instance['profile']} / {instance['region']}]")
             
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error starting port forwarding session: {e}")
-        except KeyboardInterrupt:
-            print("\nStopping port forwarding session...")
+        try:
+            instance_idx = int(input("\nSelect instance (number): ")) - 1
+            if instance_idx < 0 or instance_idx >= len(instances):
+                print("Error: Invalid instance selection")
+                return None
+        except ValueError:
+            print("Error: Please enter a valid number")
+            return None
             
+        return instances[instance_idx]
+        
     def create_new_connection(self):
         """Create a new connection configuration"""
         # Get available AWS profiles
@@ -325,49 +3178,38 @@ class SSMPortForwarder:
                 
         # Ask for AWS profile
         print("\nAvailable AWS profiles:")
+        print("0. Search all profiles and regions")
         for i, profile in enumerate(profiles):
             print(f"{i+1}. {profile}")
             
         try:
             profile_idx = int(input("\nSelect profile (number): ")) - 1
-            if profile_idx < 0 or profile_idx >= len(profiles):
+            if profile_idx < -1 or profile_idx >= len(profiles):
                 print("Error: Invalid profile selection")
                 return None
         except ValueError:
             print("Error: Please enter a valid number")
             return None
             
-        profile = profiles[profile_idx]
-        
-        # Check SSO login if needed
-        if not self.check_sso_login(profile):
-            print(f"Failed to authenticate with profile '{profile}'")
-            return None
-            
-        # Get SSM instances
-        print(f"\nGetting instances managed by SSM for profile '{profile}'...")
-        instances = self.get_ssm_instances(profile)
-        
-        if not instances:
-            print("No instances managed by SSM found")
-            return None
-            
-        # Ask for instance
-        print("\nAvailable instances:")
-        for i, instance in enumerate(instances):
-            print(f"{i+1}. {instance['name']} ({instance['id']}) - {instance['ip']}")
-            
-        try:
-            instance_idx = int(input("\nSelect instance (number): ")) - 1
-            if instance_idx < 0 or instance_idx >= len(instances):
-                print("Error: Invalid instance selection")
+        if profile_idx == -1:
+            instance = self.select_discovered_instance()
+            if not instance:
                 return None
-        except ValueError:
-            print("Error: Please enter a valid number")
-            return None
+            profile = instance['profile']
+            region = instance['region']
+        else:
+            profile = profiles[profile_idx]
+            region = None
             
-        instance = instances[instance_idx]
-        
+            # Check SSO login if needed
+            if not self.check_sso_login(profile):
+                print(f"Failed to authenticate with profile '{profile}'")
+                return None
+                
+            instance = self.select_instance(profile)
+            if not instance:
+                return None
+                
         # Ask for remote host and ports
         remote_host = input("\nEnter remote host (IP or hostname): ")
         if not remote_host:
@@ -384,9 +3226,20 @@ class SSMPortForwarder:
             print("Error: Remote port must be a number between 1 and 65535")
             return None
             
-        local_port = input("Enter local port: ")
-        if not local_port.isdigit() or int(local_port) < 1 or int(local_port) > 65535:
-            print("Error: Local port must be a number between 1 and 65535")
+        local_port = self.select_local_port(name)
+        if not local_port:
+            return None
+            
+        # A tag selector keeps the connection working when the instance is replaced
+        example = f"Name={instance['name']}" if instance['name'] != instance['id'] else "Name=bastion-prod"
+        target = input(f"Follow instances by tag instead of {instance['id']}, e.g. {example} (optional): ").strip()
+        if target and not re.match(r'^[^=\s]+=\S.*$', target):
+            print("Error: The tag selector must look like Key=Value")
+            return None
+            
+        group = input("Enter a group for this connection (optional): ").strip()
+        if group and not re.match(r'^[a-zA-Z0-9_-]+$', group):
+            print("Error: Group name can only contain letters, numbers, underscores and hyphens")
             return None
             
         # Create connection object
@@ -398,15 +3251,52 @@ class SSMPortForwarder:
             'local_port': local_port,
             'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
         }
+        if region:
+            connection['region'] = region
+        if target:
+            connection['target'] = target
+        if group:
+            connection['group'] = group
         
         # Save connection
         self.connections[name] = connection
-        self.save_connections()
+        self.save_connection(name)
         
         return connection
         
+    def select_local_port(self, name):
+        """Ask for a local port, checking it against saved connections and bound ports"""
+        allocator = PortAllocator(self.connections, self.port_range)
+        local_port = input("Enter local port (leave empty to pick a free one): ").strip()
+        if not local_port:
+            port = allocator.allocate()
+            if port is None:
+                print(f"Error: No free local port between {self.port_range[0]} and {self.port_range[1]}")
+                return None
+            print(f"Using local port {port}")
+            return str(port)
+            
+        if not local_port.isdigit() or int(local_port) < 1 or int(local_port) > 65535:
+            print("Error: Local port must be a number between 1 and 65535")
+            return None
+            
+        owners = allocator.owners(local_port, exclude=name)
+        if owners:
+            print(f"Warning: Local port {local_port} is also used by: {', '.join(owners)}")
+        elif not allocator.is_free(local_port):
+            print(f"Warning: Local port {local_port} is in use right now")
+        else:
+            return local_port
+            
+        port = allocator.allocate()
+        if port is not None and input(f"Use free port {port} instead? (y/n): ").lower() == 'y':
+            return str(port)
+        return local_port
+        
     def list_connections(self):
         """List saved connections"""
+        from tabulate import tabulate
+        
         if not self.connections:
             print("No saved connections found")
             return []
@@ -417,18 +3307,271 @@ class SSMPortForwarder:
             table_data.append([
                 name,
                 conn['profile'],
-                conn['instance_id'],
+                conn.get('target') or conn['instance_id'],
                 f"{conn['remote_host']}:{conn['remote_port']}",
                 conn['local_port'],
+                conn.get('group', ''),
                 conn['created_at']
             ])
             
         # Print table
-        headers = ["Name", "Profile", "Instance ID", "Remote Host:Port", "Local Port", "Created At"]
+        headers = ["Name", "Profile", "Instance", "Remote Host:Port", "Local Port", "Group", "Created At"]
         print(tabulate(table_data, headers=headers, tablefmt="grid"))
         
         return list(self.connections.keys())
         
+    def find_connections(self, query, limit=FIND_PAGE_SIZE, page=1):
+        """Print saved connections matching a query, best first, one page at a time"""
+        matches = ConnectionIndex(self.connections).search(query)
+        if not matches:
+            print(f"No connections match '{query}'")
+            return []
+            
+        start = (page - 1) * limit
+        if start >= len(matches):
+            pages = (len(matches) + limit - 1) // limit
+            print(f"No results on page {page} of {pages} for '{query}'")
+            return [name for name, _ in matches]
+            
+        for name, _ in matches[start:start + limit]:
+            conn = self.connections[name]
+            print(f"{name:<30} {conn['profile']:<20} {conn['instance_id']:<20} "
+                  f"{conn['remote_host']}:{conn['remote_port']} → localhost:{conn['local_port']}", flush=True)
+                  
+        remaining = len(matches) - start - limit
+        if remaining > 0:
+            print(f"... {remaining} more matches, use --page {page + 1} to see them")
+        return [name for name, _ in matches]
+        
+    def resolve_connection(self, query):
+        """Find the saved connection a query refers to: exact name, or the single best match"""
+        if query in self.connections:
+            return query
+            
+        matches = ConnectionIndex(self.connections).search(query)
+        if not matches:
+            print(f"No connections match '{query}'")
+            return None
+        if len(matches) == 1 or matches[0][1] > matches[1][1]:
+            print(f"Using connection '{matches[0][0]}'")
+            return matches[0][0]
+            
+        # Several equally good matches, let the user choose
+        candidates = [name for name, score in matches if score == matches[0][1]][:FIND_PAGE_SIZE]
+        print(f"'{query}' matches several connections:")
+        for i, name in enumerate(candidates):
+            conn = self.connections[name]
+            print(f"{i+1}. {name} ({conn['remote_host']}:{conn['remote_port']} → localhost:{conn['local_port']})")
+        try:
+            choice = int(input("\nSelect connection (number): ")) - 1
+            if 0 <= choice < len(candidates):
+                return candidates[choice]
+        except (ValueError, EOFError):
+            pass
+        print("Error: Invalid connection selection")
+        return None
+        
+    def get_file_format(self, path, file_format=None):
+        """Get the format of a connections file from --format or its extension"""
+        if file_format:
+            return file_format
+        extension = os.path.splitext(path)[1].lower().lstrip('.')
+        return {'yml': 'yaml'}.get(extension, extension) if extension in CONNECTION_FILE_FORMATS + ['yml'] else 'json'
+        
+    def read_connection_file(self, path, file_format):
+        """Read connection definitions from a JSON, YAML or CSV file, returns a list of dicts"""
+        if file_format == 'csv':
+            import csv
+            
+            with open(path, 'r', newline='') as f:
+                # Empty cells mean "not set", like a missing key in JSON or YAML
+                return [{key: value for key, value in row.items() if key and value not in (None, '')}
+                        for row in csv.DictReader(f)]
+                        
+        with open(path, 'r') as f:
+            if file_format == 'yaml':
+                import yaml
+                data = yaml.safe_load(f)
+            else:
+                data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get('connections', data)
+        if isinstance(data, dict):
+            # {name: definition} mapping
+            if not all(isinstance(definition, dict) for definition in data.values()):
+                raise ValueError("expected a list of connections")
+            data = [dict(definition, name=name) for name, definition in data.items()]
+        if not isinstance(data, list) or not all(isinstance(record, dict) for record in data):
+            raise ValueError("expected a list of connections")
+        return data
+        
+    def write_connection_file(self, path, file_format, records):
+        """Write connection definitions as JSON, YAML or CSV ('-' writes to stdout)"""
+        if file_format == 'csv':
+            import csv
+            import io
+            
+            output = io.StringIO()
+            writer = csv.DictWriter(output, fieldnames=CONNECTION_FILE_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+            data = output.getvalue()
+        elif file_format == 'yaml':
+            import yaml
+            data = yaml.safe_dump({'connections': records}, sort_keys=False)
+        else:
+            data = json.dumps({'connections': records}, indent=2) + "\n"
+            
+        if path == '-':
+            print(data, end='')
+        else:
+            self.write_file_atomic(path, data.encode())
+            
+    def validate_connection(self, record):
+        """Check an imported connection definition, returns an error message or None"""
+        for field in ('name', 'profile', 'remote_host', 'remote_port'):
+            if not record.get(field):
+                return f"'{field}' is required"
+        if not (record.get('instance_id') or record.get('target')):
+            return "'instance_id' or 'target' is required"
+        if not re.match(r'^[a-zA-Z0-9_-]+$', record['name']):
+            return "the name can only contain letters, numbers, underscores and hyphens"
+        if not re.match(r'^[a-zA-Z0-9_-]+$', record['profile']):
+            return "invalid profile name"
+        if not re.match(r'^[a-zA-Z0-9.-]+$', record['remote_host']):
+            return "invalid remote host format"
+        for field in ('remote_port', 'local_port'):
+            if field in record and not (record[field].isdigit() and 1 <= int(record[field]) <= 65535):
+                return f"'{field}' must be a number between 1 and 65535"
+        if record.get('group') and not re.match(r'^[a-zA-Z0-9_-]+$', record['group']):
+            return "the group can only contain letters, numbers, underscores and hyphens"
+        return None
+        
+    def match_instances(self, instances, target):
+        """Find the instances a target refers to: an instance id, a Name tag, or a Key=Value tag selector"""
+        from fnmatch import fnmatchcase
+        
+        if '=' in target:
+            key, _, pattern = target.partition('=')
+            return [i for i in instances if fnmatchcase(i.get('tags', {}).get(key.strip(), ''), pattern.strip())
+                    or (key.strip() == 'Name' and fnmatchcase(i['name'], pattern.strip()))]
+        return [i for i in instances if target in (i['id'], i['name'])]
+        
+    def import_connections(self, path, file_format=None, overwrite=False):
+        """Create connections from a file, resolving targets in one discovery pass and saving once"""
+        file_format = self.get_file_format(path, file_format)
+        try:
+            records = self.read_connection_file(path, file_format)
+        except ImportError:
+            print("Error: Reading YAML files needs PyYAML (pip install pyyaml)")
+            return
+        except (IOError, OSError, ValueError) as e:
+            print(f"Error reading {path}: {e}")
+            return
+            
+        pending = {}
+        skipped = 0
+        for number, record in enumerate(records, 1):
+            record = {key: str(value).strip() for key, value in record.items() if value is not None}
+            error = self.validate_connection(record)
+            if not error and record['name'] in pending:
+                error = "duplicate name in the file"
+            if not error and record['name'] in self.connections and not overwrite:
+                error = "a connection with this name already exists (use --overwrite)"
+            if error:
+                print(f"Skipping entry {number} ({record.get('name', 'no name')}): {error}")
+                skipped += 1
+                continue
+            pending[record['name']] = record
+            
+        # One SSO check per profile
+        for profile in dict.fromkeys(record['profile'] for record in pending.values()):
+            if not self.check_sso_login(profile, prompt=False):
+                for name in [name for name, record in pending.items() if record['profile'] == profile]:
+                    print(f"Skipping '{name}': profile '{profile}' is not authenticated")
+                    del pending[name]
+                    skipped += 1
+                    
+        # Every target is resolved from a single parallel discovery over the profile/region pairs involved
+        targets = list(dict.fromkeys(
+            (record['profile'], record.get('region') or self.get_profile_region(record['profile']))
+            for record in pending.values() if not record.get('instance_id')
+        ))
+        inventory = {}
+        if targets:
+            for instance in self.discover_instances(targets=targets):
+                inventory.setdefault((instance['profile'], instance['region']), []).append(instance)
+                
+        allocator = PortAllocator(self.connections, self.port_range)
+        imported = []
+        for name, record in pending.items():
+            instance_id = record.get('instance_id')
+            if not instance_id:
+                region = record.get('region') or self.get_profile_region(record['profile'])
+                matches = self.match_instances(inventory.get((record['profile'], region), []), record['target'])
+                if not matches:
+                    print(f"Skipping '{name}': no online instance matches '{record['target']}'")
+                    skipped += 1
+                    continue
+                instance_id = matches[0]['id']
+                if len(matches) > 1:
+                    print(f"'{name}': {len(matches)} instances match '{record['target']}', using {instance_id}")
+                    
+            local_port = record.get('local_port')
+            if not local_port:
+                port = allocator.allocate()
+                if port is None:
+                    print(f"Skipping '{name}': no free local port between {self.port_range[0]} and {self.port_range[1]}")
+                    skipped += 1
+                    continue
+                local_port = str(port)
+            owners = allocator.owners(local_port, exclude=name)
+            if owners:
+                print(f"Warning: '{name}' uses local port {local_port}, like: {', '.join(owners)}")
+            allocator.reserved.setdefault(int(local_port), []).append(name)
+            
+            connection = {
+                'profile': record['profile'],
+                'instance_id': instance_id,
+                'remote_host': record['remote_host'],
+                'remote_port': record['remote_port'],
+                'local_port': local_port,
+                'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+            for field in ('region', 'group'):
+                if record.get(field):
+                    connection[field] = record[field]
+            if record.get('target') and not re.match(r'^(i|mi)-[0-9a-f]+$', record['target']):
+                # Resolved again at connect time, so the connection follows replaced instances
+                connection['target'] = record['target']
+            self.connections[name] = connection
+            imported.append(name)
+            
+        if imported:
+            self.save_connections(imported)
+        print(f"Imported {len(imported)} connections, skipped {skipped}")
+        
+    def export_connections(self, path, file_format=None, names=None):
+        """Write saved connections to a file that --import can read back"""
+        file_format = self.get_file_format(path, file_format)
+        names = names if names is not None else sorted(self.connections)
+        records = []
+        for name in names:
+            connection = self.connections[name]
+            record = {'name': name}
+            record.update({field: connection[field] for field in CONNECTION_FILE_FIELDS[1:] if connection.get(field)})
+            records.append(record)
+        try:
+            self.write_connection_file(path, file_format, records)
+        except ImportError:
+            print("Error: Writing YAML files needs PyYAML (pip install pyyaml)")
+            return
+        except (IOError, OSError) as e:
+            print(f"Error writing {path}: {e}")
+            return
+        if path != '-':
+            print(f"Exported {len(records)} connections to {path}")
+            
     def delete_connection(self, name):
         """Delete a saved connection"""
         if not name:
@@ -442,27 +3585,23 @@ class SSMPortForwarder:
                 return
                 
             del self.connections[name]
-            self.save_connections()
+            self.remove_connection(name)
             print(f"Connection '{name}' deleted.")
         else:
             print(f"Connection '{name}' not found.")
             
     def change_password(self):
         """Change the password used to encrypt connections"""
-        if not os.path.exists(self.connections_file):
+        from cryptography.fernet import InvalidToken
+        
+        if not self.store_exists():
             print("Error: No saved connections found. Create a connection first.")
             return
             
         # Load connections with current password
         try:
             old_key = self.get_encryption_key()
-            fernet_old = Fernet(old_key)
-            
-            with open(self.connections_file, 'rb') as f:
-                encrypted_data = f.read()
-                
-            decrypted_data = fernet_old.decrypt(encrypted_data)
-            connections_data = decrypted_data.decode()
+            self.verify_key(old_key)
             
             # Request and validate new password
             new_password = getpass.getpass("Enter new password: ")
@@ -475,26 +3614,10 @@ class SSMPortForwarder:
                 print("Error: Passwords do not match")
                 return
                 
-            # Generate new salt and key
-            new_salt = os.urandom(16)
-            with open(self.key_file, 'wb') as f:
-                f.write(new_salt)
-                
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=new_salt,
-                iterations=100000,
-            )
-            new_key = base64.urlsafe_b64encode(kdf.derive(new_password.encode()))
-            fernet_new = Fernet(new_key)
-            
-            # Re-encrypt with new key
-            new_encrypted_data = fernet_new.encrypt(connections_data.encode())
-            
-            with open(self.connections_file, 'wb') as f:
-                f.write(new_encrypted_data)
-                
+            kdf = self.get_store_kdf()
+            if KeyDerivation.is_weak(kdf):
+                kdf = KeyDerivation.DEFAULTS[self.kdf]
+            self.rekey_store(old_key, new_password, kdf)
             print("Password changed successfully")
             
         except InvalidToken:
@@ -506,21 +3629,267 @@ class SSMPortForwarder:
             # Log the exception type for debugging
             print(f"Exception type: {type(e).__name__}")
             
+    def rekey_store(self, old_key, password, kdf):
+        """Re-encrypt the store with a new salt and key derivation, swapping it in with renames.
+        
+        The records are read under the same lock as the swap, so connections
+        saved by other invocations in the meantime are carried over. Raises
+        InvalidToken if old_key no longer opens the store.
+        """
+        new_salt = os.urandom(16)
+        new_key = self.get_encryption_key(password, new_salt, kdf)
+        
+        with self.store_lock():
+            self.verify_key(old_key)
+            connections = self.read_records(old_key)
+            new_dir = self.store_dir + ".new"
+            old_dir = self.store_dir + ".old"
+            for leftover in (new_dir, old_dir):
+                if os.path.exists(leftover):
+                    shutil.rmtree(leftover)
+            self.write_store(new_dir, new_salt, new_key, connections, kdf)
+            os.rename(self.store_dir, old_dir)
+            os.rename(new_dir, self.store_dir)
+            shutil.rmtree(old_dir)
+            self.remove_legacy_store()
+            
+        self.encryption_key = new_key
+        # Keep a running unlock agent in sync with the new key
+        if UnlockAgent.request(self.agent_socket, b"SET " + new_key) == b"OK":
+            print("Unlock agent updated with the new key")
+            
+    def upgrade_store_kdf(self, password):
+        """Re-encrypt a store whose key derivation is weaker than the minimum, keeping its password"""
+        from cryptography.fernet import InvalidToken
+        
+        kdf = KeyDerivation.DEFAULTS[self.kdf]
+        try:
+            self.rekey_store(self.encryption_key, password, kdf)
+            print(f"Upgraded the store key derivation to {KeyDerivation.describe(kdf)}")
+        except InvalidToken:
+            print("Warning: Could not upgrade the store key derivation: the store was re-encrypted by another session")
+        except (IOError, OSError, ValueError) as e:
+            print(f"Warning: Could not upgrade the store key derivation: {e}")
+            
+    def calibrate_kdf(self, target_seconds=KDF_TARGET_SECONDS):
+        """Re-encrypt the store with key derivation parameters that take about target_seconds on this host"""
+        from cryptography.fernet import InvalidToken
+        
+        if not self.store_exists():
+            print("Error: No saved connections found. Create a connection first.")
+            return
+            
+        print(f"Calibrating {self.kdf} for a {target_seconds:.2f}s unlock...")
+        kdf, elapsed = KeyDerivation.calibrate(self.kdf, target_seconds)
+        print(f"Selected {KeyDerivation.describe(kdf)}: {elapsed:.2f}s on this host")
+        try:
+            password = getpass.getpass("Enter password to decrypt connections: ")
+            key = self.get_encryption_key(password)
+            self.verify_key(key)
+            self.rekey_store(key, password, kdf)
+            print("Key derivation updated")
+        except InvalidToken:
+            print("Error: Incorrect password. Key derivation not changed.")
+        except ValueError as e:
+            print(f"Error: {str(e)}")
+        except (IOError, OSError) as e:
+            print(f"Error re-encrypting connections: {e}")
+            
+    def run_benchmark(self, bench_args):
+        """Run the tunnel benchmark next to this script, returns its exit code"""
+        import sys
+        
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "tunnel_bench.py")
+        if not os.path.exists(script):
+            print(f"Error: The tunnel benchmark was not found at {script}")
+            return 1
+        return subprocess.call([sys.executable, script] + bench_args)
+        
+    def show_dashboard(self):
+        """Open the terminal dashboard of saved connections and running tunnels"""
+        try:
+            import curses  # noqa: F401
+        except ImportError:
+            print("Error: The dashboard needs the curses module (on Windows: pip install windows-curses)")
+            return
+        if not self.connections:
+            print("No saved connections found.")
+            return
+        TunnelDashboard(self).run()
+        
+    def start_metrics(self, port=None, log_file=None, interval=METRICS_LOG_INTERVAL):
+        """Start the metrics exporters, stopped when the process exits"""
+        import atexit
+        
+        if port:
+            try:
+                self.metrics.serve(port)
+                print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+            except OSError as e:
+                print(f"Error serving metrics on port {port}: {e}")
+        if log_file:
+            self.metrics.log_json_lines(log_file, interval)
+        atexit.register(self.metrics.close)
+        
+    def start_agent(self, idle_timeout):
+        """Start an unlock agent holding the key of the loaded connections"""
+        if not self.encryption_key:
+            print("Error: Connections must be unlocked before starting the agent. Create a connection first.")
+            return
+            
+        # Reuse a running agent instead of starting a second one
+        if UnlockAgent.request(self.agent_socket, b"SET " + self.encryption_key) == b"OK":
+            print("Unlock agent is already running, key updated")
+            return
+            
+        agent = UnlockAgent(self.agent_socket, self.encryption_key, idle_timeout)
+        if agent.start():
+            print(f"Unlock agent started, it will stop after {idle_timeout}s without use")
+        else:
+            print("Error: Could not start the unlock agent")
+            
+    def stop_agent(self):
+        """Stop a running unlock agent"""
+        if UnlockAgent.request(self.agent_socket, b"STOP") == b"OK":
+            print("Unlock agent stopped")
+        else:
+            print("Unlock agent is not running")
+            
     def main(self):
         """Main function to run the tool"""
         parser = argparse.ArgumentParser(description="AWS SSM Port Forwarding Manager")
         parser.add_argument('--new', action='store_true', help='Create a new connection')
         parser.add_argument('--list', action='store_true', help='List saved connections')
-        parser.add_argument('--connect', metavar='NAME', help='Connect using a saved connection')
+        parser.add_argument('--connect', metavar='NAME', nargs='+', help='Connect using one or more saved connections')
+        parser.add_argument('--group', metavar='GROUP', help='Connect every saved connection in a group')
+        parser.add_argument('--engine', choices=['cli', 'python'], default='cli',
+                            help="Run tunnels with the aws CLI (default) or in-process with boto3")
+        parser.add_argument('--standby', metavar='N', type=int,
+                            help='Keep N pre-established sessions per connection so clients connect at once (needs --engine python)')
+        parser.add_argument('--standby-idle', metavar='SECONDS', type=int, default=STANDBY_IDLE_TIMEOUT,
+                            help='Close the standby sessions after this many seconds without clients')
+        parser.add_argument('--standby-max-age', metavar='SECONDS', type=int, default=STANDBY_MAX_AGE,
+                            help='Replace standby sessions older than this many seconds')
+        parser.add_argument('--tui', action='store_true',
+                            help='Open a dashboard to start, stop and watch tunnels from one screen')
+        parser.add_argument('--lazy', action='store_true',
+                            help='Start each session only when a client connects to its local port '
+                                 '(all saved connections unless --connect or --group is given)')
+        parser.add_argument('--lazy-idle', metavar='SECONDS', type=int, default=LAZY_IDLE_TIMEOUT,
+                            help='Stop a lazy session after this many seconds without clients')
+        parser.add_argument('--reconnect', action='store_true',
+                            help='Restart sessions that exit or stop answering, with exponential backoff')
+        parser.add_argument('--connect-fuzzy', metavar='QUERY', help='Connect to the saved connection that best matches QUERY')
+        parser.add_argument('--find', metavar='QUERY', help='Search saved connections by name, profile, instance, host or port')
+        parser.add_argument('--limit', metavar='N', type=int, default=FIND_PAGE_SIZE, help='Matches per page for --find')
+        parser.add_argument('--page', metavar='N', type=int, default=1, help='Page of --find matches to show')
         parser.add_argument('--delete', metavar='NAME', help='Delete a saved connection')
+        parser.add_argument('--import', dest='import_file', metavar='FILE',
+                            help="Create connections from a JSON, YAML or CSV file; targets can be an instance id, "
+                                 "a Name tag or a Key=Value tag selector")
+        parser.add_argument('--export', metavar='FILE',
+                            help="Write the saved connections (or those of --group) to a JSON, YAML or CSV file ('-' for stdout)")
+        parser.add_argument('--format', choices=CONNECTION_FILE_FORMATS,
+                            help='File format for --import/--export (default: from the file extension)')
+        parser.add_argument('--overwrite', action='store_true', help='Let --import replace connections with the same name')
         parser.add_argument('--change-password', action='store_true', help='Change the encryption password')
+        parser.add_argument('--kdf', choices=KeyDerivation.ALGORITHMS, default=DEFAULT_KDF,
+                            help='Key derivation function of new, upgraded and calibrated stores')
+        parser.add_argument('--calibrate-kdf', metavar='SECONDS', type=float, nargs='?', const=KDF_TARGET_SECONDS,
+                            help='Tune the key derivation to take SECONDS on this host and re-encrypt the store '
+                                 f'(default {KDF_TARGET_SECONDS})')
+        parser.add_argument('--agent-start', action='store_true',
+                            help='Unlock connections once and keep the key in a background agent')
+        parser.add_argument('--agent-stop', action='store_true', help='Stop the unlock agent')
+        parser.add_argument('--agent-timeout', metavar='SECONDS', type=int, default=AGENT_IDLE_TIMEOUT,
+                            help='Seconds the unlock agent keeps the key without being used')
+        parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                            help='Serve tunnel metrics on http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json')
+        parser.add_argument('--metrics-log', metavar='FILE',
+                            help="Append tunnel metrics to FILE as JSON lines ('-' for stdout)")
+        parser.add_argument('--metrics-interval', metavar='SECONDS', type=float, default=METRICS_LOG_INTERVAL,
+                            help='Seconds between --metrics-log lines')
+        parser.add_argument('--port-range', metavar='START-END',
+                            help=f'Range free local ports are picked from (default: {LOCAL_PORT_RANGE[0]}-{LOCAL_PORT_RANGE[1]})')
+        parser.add_argument('--cache-ttl', metavar='SECONDS', type=int, default=INVENTORY_CACHE_TTL,
+                            help='Seconds a cached instance list is used before refreshing it')
+        parser.add_argument('--discover', metavar='QUERY', nargs='?', const='',
+                            help='Search SSM instances across every profile (and --regions)')
+        parser.add_argument('--regions', metavar='REGION[,REGION...]',
+                            help="Regions searched by --discover and the 'all profiles' picker "
+                                 "(default: each profile's region)")
+        parser.add_argument('--profiles', metavar='SELECTOR[,SELECTOR...]',
+                            help="Profiles searched by --discover and the 'all profiles' picker: name patterns "
+                                 "('prod-*') or metadata ('region=eu-*', 'sso_account_id=1234*', joined with '+')")
+        parser.add_argument('--bench', metavar='ARGS', nargs=argparse.REMAINDER,
+                            help='Run benchmarks/tunnel_bench.py with the remaining arguments and exit')
+        parser.add_argument('--clear-cache', action='store_true',
+                            help='Delete the cached instance lists, AWS identities, profile list and target resolutions')
         
         args = parser.parse_args()
+        self.inventory_ttl = args.cache_ttl
+        self.engine = args.engine
+        if not KeyDerivation.is_available(args.kdf):
+            print(f"Error: --kdf {args.kdf} is not supported by the installed cryptography package")
+            return
+        self.kdf = args.kdf
+        if args.regions:
+            self.discovery_regions = [region.strip() for region in args.regions.split(',') if region.strip()]
+        if args.profiles:
+            self.discovery_profiles = [selector.strip() for selector in args.profiles.split(',') if selector.strip()]
+        if args.standby:
+            if self.engine != 'python':
+                print("Error: --standby needs --engine python")
+                return
+            self.standby = {
+                'size': args.standby,
+                'idle_timeout': args.standby_idle,
+                'max_age': args.standby_max_age
+            }
+        if args.metrics_port or args.metrics_log:
+            self.start_metrics(args.metrics_port, args.metrics_log, args.metrics_interval)
+        if args.port_range:
+            match = re.match(r'^(\d+)-(\d+)$', args.port_range)
+            if not match or not 1 <= int(match.group(1)) <= int(match.group(2)) <= 65535:
+                print("Error: --port-range must look like START-END, between 1 and 65535")
+                return
+            self.port_range = (int(match.group(1)), int(match.group(2)))
         
+        if args.clear_cache:
+            removed = self.invalidate_inventory_cache()
+            self.invalidate_identity_cache()
+            for cache_file in (self.profile_catalog.cache_file, self.target_cache_file):
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+            print(f"Removed {removed} cached instance lists, the cached AWS identities, profiles and targets")
+            if not (args.new or args.list or args.find is not None or args.connect_fuzzy or args.delete
+                    or args.connect or args.group or args.lazy or args.import_file or args.export
+                    or args.change_password or args.calibrate_kdf is not None or args.tui):
+                return
+                
+        if args.bench is not None:
+            raise SystemExit(self.run_benchmark(args.bench))
+            
+        if args.agent_stop:
+            self.stop_agent()
+            return
+            
+        # Calibration re-encrypts the whole store and asks for its password itself
+        if args.calibrate_kdf is not None:
+            self.calibrate_kdf(args.calibrate_kdf)
+            return
+            
+        # Discovery needs AWS credentials only, not the saved connections
+        if args.discover is not None:
+            self.show_discovered_instances(args.discover, self.discovery_regions)
+            return
+            
         # Load saved connections
         self.load_connections()
         
-        if args.new:
+        if args.agent_start:
+            self.start_agent(args.agent_timeout)
+        elif args.new:
             connection = self.create_new_connection()
             if connection:
                 answer = input("Do you want to start this connection now? (y/n): ")
@@ -528,15 +3897,44 @@ class SSMPortForwarder:
                     self.start_port_forwarding(connection)
         elif args.list:
             self.list_connections()
+        elif args.find is not None:
+            self.find_connections(args.find, max(1, args.limit), max(1, args.page))
+        elif args.connect_fuzzy:
+            name = self.resolve_connection(args.connect_fuzzy)
+            if name:
+                self.touch_connection(name)
+                self.start_port_forwarding(self.connections[name], name)
         elif args.delete:
             self.delete_connection(args.delete)
+        elif args.import_file:
+            self.import_connections(args.import_file, args.format, args.overwrite)
+        elif args.export:
+            names = self.get_group_connections(args.group) if args.group else None
+            self.export_connections(args.export, args.format, names)
+        elif args.lazy:
+            names = args.connect or (self.get_group_connections(args.group) if args.group else list(self.connections))
+            if names:
+                self.start_lazy_forwarding(names, args.lazy_idle)
+            else:
+                print("No connections to serve.")
+        elif args.connect and (len(args.connect) > 1 or args.reconnect):
+            self.start_port_forwarding_many(args.connect, reconnect=args.reconnect)
         elif args.connect:
-            if args.connect in self.connections:
-                self.start_port_forwarding(self.connections[args.connect])
+            if args.connect[0] in self.connections:
+                self.touch_connection(args.connect[0])
+                self.start_port_forwarding(self.connections[args.connect[0]], args.connect[0])
             else:
-                print(f"Connection '{args.connect}' not found.")
+                print(f"Connection '{args.connect[0]}' not found.")
+        elif args.group:
+            names = self.get_group_connections(args.group)
+            if names:
+                self.start_port_forwarding_many(names, reconnect=args.reconnect)
+            else:
+                print(f"No connections found in group '{args.group}'.")
         elif args.change_password:
             self.change_password()
+        elif args.tui:
+            self.show_dashboard()
         else:
             # Interactive mode
             while True:
@@ -546,9 +3944,10 @@ class SSMPortForwarder:
                 print("3. Connect using saved connection")
                 print("4. Delete connection")
                 print("5. Change password")
-                print("6. Exit")
+                print("6. Open dashboard")
+                print("7. Exit")
                 
-                choice = input("\nEnter your choice (1-6): ")
+                choice = input("\nEnter your choice (1-7): ")
                 
                 if choice == '1':
                     connection = self.create_new_connection()
@@ -561,11 +3960,14 @@ class SSMPortForwarder:
                 elif choice == '3':
                     connection_names = self.list_connections()
                     if connection_names:
-                        name = input("\nEnter connection name to connect: ")
-                        if name in self.connections:
-                            self.start_port_forwarding(self.connections[name])
-                        else:
-                            print(f"Connection '{name}' not found.")
+                        names = input("\nEnter connection name(s) to connect, separated by spaces: ").split()
+                        if len(names) > 1:
+                            self.start_port_forwarding_many(names)
+                        elif names:
+                            name = self.resolve_connection(names[0])
+                            if name:
+                                self.touch_connection(name)
+                                self.start_port_forwarding(self.connections[name], name)
                 elif choice == '4':
                     connection_names = self.list_connections()
                     if connection_names:
@@ -574,10 +3976,486 @@ class SSMPortForwarder:
                 elif choice == '5':
                     self.change_password()
                 elif choice == '6':
+                    self.show_dashboard()
+                elif choice == '7':
                     break
                 else:
                     print("Invalid choice. Please try again.")
 
+class Tunnel:
+    """A tunnel opened by AsyncPortForwarder.open_tunnel.
+    
+    Serves its local port from the event loop that opened it until close()
+    is awaited, or until a task waiting on it with wait() is cancelled.
+    """
+    
+    def __init__(self, name, connection, forwarder, task):
+        self.name = name
+        self.connection = connection
+        self.forwarder = forwarder
+        self.task = task
+        
+    @property
+    def local_port(self):
+        return int(self.connection['local_port'])
+        
+    @property
+    def stats(self):
+        """Counters of the tunnel, see MetricsRegistry.TUNNEL_DEFAULTS"""
+        return self.forwarder.stats
+        
+    @property
+    def closed(self):
+        return self.task.done()
+        
+    async def wait(self):
+        """Wait until the tunnel is closed, closing it if the wait is cancelled"""
+        import asyncio
+        
+        try:
+            await asyncio.wait([self.task])
+        except asyncio.CancelledError:
+            await self.close()
+            raise
+        if not self.task.cancelled():
+            self.task.result()
+            
+    async def close(self):
+        """Stop listening on the local port and end the tunnel's sessions"""
+        import asyncio
+        
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        
+    async def __aenter__(self):
+        return self
+        
+    async def __aexit__(self, *exc_info):
+        await self.close()
+        
+class AsyncPortForwarder:
+    """asyncio API of the forwarder, for embedding it in other programs.
+    
+    Wraps an SSMPortForwarder, whose connections must already be loaded to
+    open them by name. Blocking boto3 calls run in a private thread pool, at
+    most `max_concurrency` at a time, and every coroutine can be cancelled.
+    One instance belongs to one event loop; the command line drives
+    discovery and the asyncio tunnel engines through this class too.
+    """
+    
+    def __init__(self, forwarder=None, max_concurrency=DISCOVERY_MAX_TARGETS):
+        self.forwarder = forwarder or SSMPortForwarder()
+        self.max_concurrency = max_concurrency
+        self.limit = None
+        self.executor = None
+        self.auth_tasks = {}
+        
+    async def call(self, function, *args):
+        """Run a blocking function in the thread pool, within the concurrency limit"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        
+        if self.limit is None:
+            self.limit = asyncio.Semaphore(self.max_concurrency)
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        async with self.limit:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+            
+    async def ensure_auth(self, profile):
+        """Check that a profile has valid credentials, returns False when it has not.
+        
+        Cached identities are answered without calling STS, and concurrent
+        calls for the same profile share one check. Never prompts.
+        """
+        import asyncio
+        
+        if self.forwarder.is_identity_cached(profile):
+            return True
+        task = self.auth_tasks.get(profile)
+        if task is None or task.done():
+            task = self.auth_tasks[profile] = asyncio.ensure_future(
+                self.call(self.forwarder.check_sso_login, profile, False)
+            )
+        return await asyncio.shield(task)
+        
+    async def discover(self, profiles=None, regions=None, targets=None, errors=None):
+        """Search SSM instances across profiles and regions concurrently.
+        
+        Takes the same arguments and uses the same inventory cache as
+        SSMPortForwarder.discover_instances. Pairs that fail are left out of
+        the result and appended to `errors`, when given, as (profile, region,
+        exception) tuples.
+        """
+        import asyncio
+        
+        forwarder = self.forwarder
+        if targets is None:
+            targets = forwarder.get_discovery_targets(profiles, regions)
+        with forwarder.metrics.timed('discovery'):
+            results = await asyncio.gather(
+                *(self.call(forwarder.discover_target, profile, region) for profile, region in targets),
+                return_exceptions=True
+            )
+            
+        discovered = []
+        for (profile, region), result in zip(targets, results):
+            if isinstance(result, Exception):
+                if errors is not None:
+                    errors.append((profile, region, result))
+            else:
+                discovered.extend(result)
+        return sorted(discovered, key=lambda i: (i['name'].lower(), i['profile'], i['region']))
+        
+    async def resolve(self, connection, refresh=False):
+        """Get the connection with its target resolved to an instance, see SSMPortForwarder.resolve_target"""
+        return await self.call(self.forwarder.resolve_target, connection, refresh)
+        
+    async def open_tunnel(self, connection, name=None, engine=None, lazy=False, idle_timeout=LAZY_IDLE_TIMEOUT):
+        """Start forwarding a connection, given as a saved name or a dict.
+        
+        Returns a Tunnel once its local port is listening. With the aws CLI
+        engine the session is started before returning and kept open unless
+        `lazy` is set, in which case nothing is checked until the first
+        client and the session stops after `idle_timeout` seconds without
+        clients; the in-process engine always starts one session per client. Raises
+        LookupError for an unknown name or a target without instances,
+        OSError when the local port is taken and PermissionError when the
+        profile is not logged in.
+        """
+        import asyncio
+        
+        forwarder = self.forwarder
+        if isinstance(connection, str):
+            name = name or connection
+            if connection not in forwarder.connections:
+                raise LookupError(f"Connection not found: {connection}")
+            connection = forwarder.connections[connection]
+        name = name or f"localhost:{connection['local_port']}"
+        engine = engine or forwarder.engine
+        profile = connection['profile']
+        
+        if not PortAllocator.is_free(connection['local_port']):
+            raise OSError(f"Local port {connection['local_port']} is already in use")
+        instance = connection.get('target') or connection['instance_id']
+        if not lazy:
+            if not await self.ensure_auth(profile):
+                raise PermissionError(f"Failed to authenticate with profile '{profile}'")
+            instance = (await self.resolve(connection))['instance_id']
+            
+        log = forwarder.tunnel_logger(name)
+        log(f"Local port {connection['local_port']} → Instance {instance} → "
+            f"Remote {connection['remote_host']}:{connection['remote_port']}{' (on demand)' if lazy else ''}")
+        if engine == 'python':
+            ssm_client = await self.call(forwarder.get_client, profile, 'ssm', connection.get('region'))
+            resolve = None
+            if connection.get('target'):
+                resolve = lambda refresh: forwarder.resolve_target(connection, refresh)['instance_id']
+            server = InProcessForwarder(name, connection, ssm_client, log, forwarder.standby, forwarder.metrics, resolve)
+        else:
+            def build_command(connection, refresh=False):
+                return forwarder.build_port_forwarding_command(forwarder.resolve_target(connection, refresh))
+                
+            def authenticate():
+                return forwarder.check_sso_login(profile, prompt=False)
+                
+            server = LazyTunnel(name, connection, build_command, authenticate, log,
+                                idle_timeout if lazy else None, forwarder.metrics)
+            
+        tunnel = Tunnel(name, connection, server, asyncio.ensure_future(server.serve_forever()))
+        try:
+            while server.server is None and not tunnel.closed:
+                await asyncio.sleep(TUNNEL_LISTEN_POLL)
+            if tunnel.closed:
+                tunnel.task.result()
+            if engine != 'python' and not lazy and not await server.activate():
+                raise RuntimeError(f"Session of '{name}' did not start")
+        except BaseException:
+            await tunnel.close()
+            raise
+        return tunnel
+        
+    async def serve(self, tunnels, engine=None, lazy=False, idle_timeout=LAZY_IDLE_TIMEOUT):
+        """Open tunnels, a dict of name to connection, and keep them open until cancelled.
+        
+        Tunnels that cannot be opened, or that stop with an error, are reported
+        on their own line while the others keep running.
+        """
+        import asyncio
+        
+        async def watch(tunnel):
+            try:
+                await tunnel.wait()
+            except Exception as e:
+                self.forwarder.tunnel_logger(tunnel.name)(f"Error: tunnel stopped: {e}")
+                
+        names = list(tunnels)
+        results = await asyncio.gather(
+            *(self.open_tunnel(tunnels[name], name, engine, lazy, idle_timeout) for name in names),
+            return_exceptions=True
+        )
+        opened = []
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                self.forwarder.tunnel_logger(name)(f"Error: {result}")
+            else:
+                opened.append(result)
+        try:
+            await asyncio.gather(*(watch(tunnel) for tunnel in opened))
+        finally:
+            await asyncio.gather(*(tunnel.close() for tunnel in opened), return_exceptions=True)
+            
+    async def close(self):
+        """Stop the thread pool, calls still running finish in the background"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.limit = None
+            
+    async def __aenter__(self):
+        return self
+        
+    async def __aexit__(self, *exc_info):
+        await self.close()
+        
+class TunnelDashboard:
+    """Terminal dashboard of the saved connections and the tunnels started from it.
+    
+    Tunnels run through an AsyncPortForwarder on an event loop in a
+    background thread, so starting or stopping one never blocks the screen,
+    which refreshes every DASHBOARD_REFRESH_INTERVAL seconds. Only the rows
+    that fit are formatted and only those whose text changed are redrawn.
+    While it runs the dashboard stands in for stdout, so tunnel output lands
+    in its log pane instead of scrolling the screen.
+    """
+    
+    COLUMNS = [('NAME', 20), ('PROFILE', 14), ('LOCAL', 6), ('REMOTE', 24), ('STATE', 16),
+               ('CLIENTS', 8), ('IN/s', 9), ('OUT/s', 9), ('SETUP', 7)]
+    
+    def __init__(self, forwarder, engine=None, refresh_interval=DASHBOARD_REFRESH_INTERVAL):
+        self.forwarder = forwarder
+        self.engine = engine or forwarder.engine
+        self.refresh_interval = refresh_interval
+        self.names = sorted(forwarder.connections, key=str.lower)
+        self.api = None
+        self.loop = None
+        self.thread = None
+        self.tunnels = {}
+        self.states = {}
+        self.rates = {}
+        self.log_lines = deque(maxlen=DASHBOARD_LOG_LINES)
+        self.partial_line = ""
+        self.write_lock = threading.Lock()
+        self.selected = 0
+        self.top = 0
+        self.rendered = {}
+        
+    def write(self, text):
+        """Collect printed text into the log pane, a line at a time"""
+        with self.write_lock:
+            lines = (self.partial_line + text).split("\n")
+            self.partial_line = lines.pop()
+            self.log_lines.extend(line for line in lines if line.strip())
+        return len(text)
+        
+    def flush(self):
+        pass
+        
+    def run(self):
+        """Show the dashboard until the user quits, then stop every tunnel it started"""
+        import asyncio
+        import curses
+        
+        self.loop = asyncio.new_event_loop()
+        self.api = AsyncPortForwarder(self.forwarder)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        with redirect_stdout(self):
+            try:
+                curses.wrapper(self.main)
+            finally:
+                self.call(self.close_all()).result()
+                self.call(self.api.close()).result()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                
+    def call(self, coroutine):
+        """Schedule a coroutine on the tunnel event loop, returns a concurrent.futures.Future"""
+        import asyncio
+        
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        
+    def main(self, screen):
+        """Read keys and redraw until q"""
+        import curses
+        
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        screen.timeout(int(self.refresh_interval * 1000))
+        while True:
+            page = max(1, self.draw(screen))
+            key = screen.getch()
+            if key == ord('q'):
+                break
+            elif key in (curses.KEY_UP, ord('k')):
+                self.selected -= 1
+            elif key in (curses.KEY_DOWN, ord('j')):
+                self.selected += 1
+            elif key == curses.KEY_PPAGE:
+                self.selected -= page
+            elif key == curses.KEY_NPAGE:
+                self.selected += page
+            elif key == curses.KEY_HOME:
+                self.selected = 0
+            elif key == curses.KEY_END:
+                self.selected = len(self.names) - 1
+            elif key in (10, 13, ord(' '), curses.KEY_ENTER) and self.names:
+                self.toggle(self.names[self.selected])
+            elif key == ord('a'):
+                for name in self.names:
+                    if name not in self.tunnels and name not in self.states:
+                        self.start(name)
+            elif key == ord('x'):
+                for name in list(self.tunnels):
+                    self.stop(name)
+            elif key == curses.KEY_RESIZE:
+                self.rendered.clear()
+                screen.erase()
+            self.selected = min(max(self.selected, 0), max(len(self.names) - 1, 0))
+            
+    def toggle(self, name):
+        """Start a stopped tunnel or stop a running one"""
+        if name in self.tunnels:
+            self.stop(name)
+        elif name not in self.states or self.states[name].startswith('error'):
+            self.start(name)
+            
+    def start(self, name):
+        self.states[name] = 'starting'
+        self.call(self.open(name))
+        
+    def stop(self, name):
+        tunnel = self.tunnels.pop(name, None)
+        if tunnel is not None:
+            self.states[name] = 'stopping'
+            self.call(self.close(name, tunnel))
+            
+    async def open(self, name):
+        """Open a tunnel, keeping the first line of the error as its state when it fails"""
+        try:
+            self.tunnels[name] = await self.api.open_tunnel(name, engine=self.engine)
+            self.rates.pop(name, None)
+            del self.states[name]
+        except Exception as e:
+            message = str(e).splitlines()[0] if str(e) else type(e).__name__
+            self.states[name] = f"error: {message}"
+            self.log_lines.append(f"[{name}] Error: {message}")
+            
+    async def close(self, name, tunnel):
+        await tunnel.close()
+        self.states.pop(name, None)
+        
+    async def close_all(self):
+        import asyncio
+        
+        tunnels, self.tunnels = self.tunnels, {}
+        await asyncio.gather(*(tunnel.close() for tunnel in tunnels.values()), return_exceptions=True)
+        
+    def get_state(self, name):
+        """Get the state shown for a connection"""
+        if name in self.states:
+            return self.states[name]
+        tunnel = self.tunnels.get(name)
+        if tunnel is None:
+            return 'stopped'
+        if tunnel.closed:
+            return 'exited'
+        if tunnel.stats['clients']:
+            return 'active'
+        return 'up' if tunnel.stats['session_started'] else 'listening'
+        
+    def get_rates(self, name, now):
+        """Get the (in, out) bytes per second of a tunnel since the last refresh"""
+        tunnel = self.tunnels.get(name)
+        if tunnel is None:
+            return None
+        bytes_in, bytes_out = tunnel.stats['bytes_in'], tunnel.stats['bytes_out']
+        last = self.rates.get(name)
+        if last is None or now - last[2] >= self.refresh_interval:
+            rates = (0.0, 0.0)
+            if last is not None:
+                rates = ((bytes_in - last[0]) / (now - last[2]), (bytes_out - last[1]) / (now - last[2]))
+            last = self.rates[name] = (bytes_in, bytes_out, now, rates)
+        return last[3]
+        
+    @staticmethod
+    def format_rate(rate):
+        """Format bytes per second, e.g. 1.5M"""
+        for unit in ('B', 'K', 'M', 'G'):
+            if rate < 1024 or unit == 'G':
+                return f"{rate:.0f}{unit}" if unit == 'B' else f"{rate:.1f}{unit}"
+            rate /= 1024
+            
+    def format_row(self, name, now):
+        """Format the columns of one connection"""
+        connection = self.forwarder.connections[name]
+        rates = self.get_rates(name, now)
+        stats = self.tunnels[name].stats if name in self.tunnels else None
+        values = [
+            name,
+            connection.get('profile', ''),
+            str(connection.get('local_port', '')),
+            f"{connection.get('remote_host', '')}:{connection.get('remote_port', '')}",
+            self.get_state(name),
+            str(stats['clients']) if stats else '',
+            self.format_rate(rates[0]) if rates else '',
+            self.format_rate(rates[1]) if rates else '',
+            f"{stats['setup_seconds_last']:.2f}s" if stats and stats['setup_seconds_last'] is not None else '',
+        ]
+        return " ".join(value[:width].ljust(width) for value, (_, width) in zip(values, self.COLUMNS))
+        
+    def draw(self, screen):
+        """Redraw the lines that changed, returns the number of connection rows that fit"""
+        import curses
+        
+        height, width = screen.getmaxyx()
+        now = time.time()
+        page = max(0, height - 4 - DASHBOARD_LOG_LINES)
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + page:
+            self.top = self.selected - page + 1
+            
+        # The event loop thread adds and removes tunnels while this runs
+        running = sum(1 for tunnel in list(self.tunnels.values()) if not tunnel.closed)
+        lines = [
+            (f"SSM Port Forwarder - {running} of {len(self.names)} tunnels running "
+             f"({self.engine} engine)  {datetime.now().strftime('%H:%M:%S')}", curses.A_BOLD),
+            (" ".join(title.ljust(width) for title, width in self.COLUMNS), curses.A_UNDERLINE),
+        ]
+        for index in range(self.top, self.top + page):
+            if index < len(self.names):
+                attr = curses.A_REVERSE if index == self.selected else curses.A_NORMAL
+                lines.append((self.format_row(self.names[index], now), attr))
+            else:
+                lines.append(("", curses.A_NORMAL))
+        log = list(self.log_lines)
+        lines.extend((line, curses.A_DIM) for line in [""] * (DASHBOARD_LOG_LINES - len(log)) + log)
+        lines.append(("Enter: start/stop  a: start all  x: stop all  arrows/PgUp/PgDn: move  q: quit",
+                      curses.A_BOLD))
+        
+        for y, (text, attr) in enumerate(lines[:height]):
+            # The last column is left alone: writing it would scroll the bottom line
+            text = text[:width - 1].ljust(width - 1)
+            if self.rendered.get(y) != (text, attr):
+                screen.addstr(y, 0, text, attr)
+                self.rendered[y] = (text, attr)
+        screen.noutrefresh()
+        curses.doupdate()
+        return page
+        
 if __name__ == "__main__":
     try:
         SSMPortForwarder().main()
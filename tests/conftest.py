@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+AWS_VARIABLES = ['AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_DEFAULT_REGION', 'AWS_ACCESS_KEY_ID',
+                 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """An empty home directory with its own AWS config files, and no AWS variables from the caller"""
+    for variable in AWS_VARIABLES:
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'config'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'credentials'))
+    monkeypatch.setenv('AWS_EC2_METADATA_DISABLED', 'true')
+    return tmp_path
+
+
+@pytest.fixture
+def forwarder(home):
+    """An SSMPortForwarder whose config directory is inside the test's home"""
+    from ssm_port_forwarder import SSMPortForwarder
+    
+    return SSMPortForwarder()
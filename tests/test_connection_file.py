@@ -0,0 +1,57 @@
+"""Reading connection definitions for --import."""
+import pytest
+
+RECORD = {'name': 'db', 'profile': 'dev', 'target': 'Role=db', 'remote_host': 'db.internal', 'remote_port': '5432'}
+
+
+def read(forwarder, tmp_path, text, file_format='json'):
+    path = tmp_path / f"connections.{file_format}"
+    path.write_text(text)
+    return forwarder.read_connection_file(str(path), file_format)
+
+
+def test_reads_a_list(forwarder, tmp_path):
+    assert read(forwarder, tmp_path, '[{"name": "db", "profile": "dev"}]') == [{'name': 'db', 'profile': 'dev'}]
+
+
+def test_reads_the_connections_key(forwarder, tmp_path):
+    assert read(forwarder, tmp_path, '{"connections": [{"name": "db"}]}') == [{'name': 'db'}]
+
+
+def test_reads_a_mapping_of_names(forwarder, tmp_path):
+    records = read(forwarder, tmp_path, '{"connections": {"db": {"profile": "dev"}, "cache": {"profile": "ops"}}}')
+    
+    assert records == [{'profile': 'dev', 'name': 'db'}, {'profile': 'ops', 'name': 'cache'}]
+
+
+def test_csv_empty_cells_are_not_set(forwarder, tmp_path):
+    text = "name,profile,target,remote_host,remote_port,local_port\ndb,dev,Role=db,db.internal,5432,\n"
+    
+    assert read(forwarder, tmp_path, text, 'csv') == [RECORD]
+
+
+@pytest.mark.parametrize('text', [
+    '"db"',
+    '42',
+    'null',
+    '["db", "cache"]',
+    '[{"name": "db"}, "cache"]',
+    '{"connections": "db"}',
+    '{"connections": {"db": "i-0123456789abcdef0"}}',
+    '{"db": {"profile": "dev"}, "cache": []}',
+])
+def test_rejects_anything_but_connection_records(forwarder, tmp_path, text):
+    with pytest.raises(ValueError, match="expected a list of connections"):
+        read(forwarder, tmp_path, text)
+
+
+def test_rejects_invalid_json(forwarder, tmp_path):
+    with pytest.raises(ValueError):
+        read(forwarder, tmp_path, '[{"name": "db",')
+
+
+def test_rejects_yaml_that_is_not_a_list(forwarder, tmp_path):
+    pytest.importorskip('yaml')
+    
+    with pytest.raises(ValueError, match="expected a list of connections"):
+        read(forwarder, tmp_path, "connections:\n  - db\n", 'yaml')
@@ -0,0 +1,77 @@
+"""Ranking of ConnectionIndex.search, used by --find and fuzzy --connect."""
+from ssm_port_forwarder import ConnectionIndex
+
+
+def connection(**fields):
+    return dict({
+        'profile': 'dev',
+        'instance_id': 'i-0123456789abcdef0',
+        'remote_host': 'db.internal',
+        'remote_port': '5432',
+        'local_port': '15432'
+    }, **fields)
+
+
+def names(connections, query):
+    return [name for name, _ in ConnectionIndex(connections).search(query)]
+
+
+def test_exact_name_beats_prefix_beats_other_fields():
+    connections = {
+        'api': connection(remote_host='api.internal'),
+        'api-staging': connection(remote_host='staging.internal'),
+        'billing': connection(remote_host='api-billing.internal'),
+    }
+    
+    assert names(connections, 'api') == ['api', 'api-staging', 'billing']
+
+
+def test_name_tokens_are_split_on_separators():
+    connections = {'prod_orders-db': connection(), 'reports': connection(remote_host='orders.internal')}
+    
+    assert names(connections, 'orders') == ['prod_orders-db', 'reports']
+
+
+def test_every_term_must_match():
+    connections = {
+        'orders-prod': connection(profile='prod'),
+        'orders-dev': connection(profile='dev'),
+        'billing-prod': connection(profile='prod'),
+    }
+    
+    assert names(connections, 'orders prod') == ['orders-prod']
+    assert names(connections, 'orders staging') == []
+
+
+def test_fuzzy_match_only_without_prefix_match():
+    connections = {'postgres-main': connection(), 'redis': connection(remote_port='6379')}
+    
+    assert names(connections, 'pgmn') == ['postgres-main']
+    # 'redis' is a prefix match, so the subsequence r..e..d..i..s elsewhere is not scored
+    assert names(connections, 'redis') == ['redis']
+
+
+def test_fewer_gaps_rank_higher_in_fuzzy_matches():
+    connections = {'pg-main': connection(), 'postgres-main-replica': connection()}
+    
+    ranked = ConnectionIndex(connections).search('pgmn')
+    
+    assert [name for name, _ in ranked] == ['pg-main', 'postgres-main-replica']
+    assert ranked[0][1] > ranked[1][1]
+
+
+def test_ties_go_to_the_most_recently_used_then_by_name():
+    connections = {
+        'db-b': connection(last_used='2024-01-01 10:00:00'),
+        'db-c': connection(last_used='2024-03-01 10:00:00'),
+        'db-a': connection(last_used='2024-01-01 10:00:00'),
+        'db-d': connection(),
+    }
+    
+    assert names(connections, 'db') == ['db-c', 'db-a', 'db-b', 'db-d']
+
+
+def test_empty_query_lists_everything_by_name():
+    connections = {'b': connection(), 'a': connection()}
+    
+    assert ConnectionIndex(connections).search('  ') == [('a', 0), ('b', 0)]
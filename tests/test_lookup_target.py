@@ -0,0 +1,71 @@
+"""API calls made by lookup_target, answered by the fleet replay of benchmarks/fleet_replay.py."""
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fleet_replay import LATENCY_PROFILES, FleetReplay, ReplayForwarder, SyntheticFleet  # noqa: E402
+from ssm_port_forwarder import SSM_DESCRIBE_PAGE_SIZE, SSM_INSTANCE_FILTER_BATCH  # noqa: E402
+
+REGION = 'us-east-1'
+
+
+@pytest.fixture
+def replay_for(home):
+    """Build a FleetReplay and a ReplayForwarder answered by it for a fleet of one profile and region"""
+    def build(instances, offline_ratio=0.05):
+        fleet = SyntheticFleet.generate(instances, 1, [REGION], offline_ratio=offline_ratio, hybrid_ratio=0)
+        replay = FleetReplay(fleet, dict(LATENCY_PROFILES['none']))
+        replay.write_aws_config(str(home / 'config'), str(home / 'credentials'))
+        return fleet, replay, ReplayForwarder(replay)
+    return build
+
+
+def healthiest(fleet, role):
+    online = [i for i in fleet.online() if i['tags']['Role'] == role]
+    return max(online, key=lambda i: (i['last_ping'], i['launch_time']))['id']
+
+
+def test_one_call_per_service_for_a_small_selection(replay_for):
+    fleet, replay, forwarder = replay_for(100)
+    profile = fleet.profiles[0]
+    
+    instance_id = forwarder.lookup_target(profile, REGION, 'Role=bastion')
+    
+    assert instance_id == healthiest(fleet, 'bastion')
+    assert replay.take_calls() == {'ec2.DescribeInstances': 1, 'ssm.DescribeInstanceInformation': 1}
+
+
+def test_ssm_calls_follow_filter_batches_and_page_size(replay_for):
+    # 5 roles, so 600 instances give 120 bastions: three InstanceIds batches of at most 50
+    fleet, replay, forwarder = replay_for(600, offline_ratio=0)
+    profile = fleet.profiles[0]
+    bastions = 600 // 5
+    
+    forwarder.lookup_target(profile, REGION, 'Role=bastion')
+    
+    batches = math.ceil(bastions / SSM_INSTANCE_FILTER_BATCH)
+    calls = replay.take_calls()
+    assert calls == fleet.expected_lookup_calls(profile, REGION, 'bastion')
+    # Every batch fits in one page of SSM_DESCRIBE_PAGE_SIZE
+    assert SSM_INSTANCE_FILTER_BATCH <= SSM_DESCRIBE_PAGE_SIZE
+    assert calls == {'ec2.DescribeInstances': 1, 'ssm.DescribeInstanceInformation': batches}
+
+
+def test_name_selector(replay_for):
+    fleet, replay, forwarder = replay_for(20, offline_ratio=0)
+    instance = fleet.online()[3]
+    
+    assert forwarder.lookup_target(fleet.profiles[0], REGION, instance['name']) == instance['id']
+    assert replay.take_calls() == {'ec2.DescribeInstances': 1, 'ssm.DescribeInstanceInformation': 1}
+
+
+def test_no_match_makes_no_ssm_call(replay_for):
+    fleet, replay, forwarder = replay_for(20)
+    
+    with pytest.raises(LookupError, match="is online in SSM"):
+        forwarder.lookup_target(fleet.profiles[0], REGION, 'Role=missing')
+    assert replay.take_calls() == {'ec2.DescribeInstances': 1}
@@ -0,0 +1,62 @@
+"""PortAllocator.is_free on both loopback addresses."""
+import socket
+
+import pytest
+
+from ssm_port_forwarder import PortAllocator
+
+
+def listen(family, address, port=0):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.bind((address, port))
+    sock.listen()
+    return sock
+
+
+def ipv6_loopback():
+    try:
+        listen(socket.AF_INET6, '::1').close()
+        return True
+    except OSError:
+        return False
+
+
+def test_free_port():
+    assert PortAllocator.is_free(PortAllocator.ephemeral())
+
+
+def test_port_listening_on_ipv4_loopback_is_busy():
+    with listen(socket.AF_INET, '127.0.0.1') as sock:
+        assert not PortAllocator.is_free(sock.getsockname()[1])
+
+
+def test_port_listening_on_all_ipv4_addresses_is_busy():
+    with listen(socket.AF_INET, '0.0.0.0') as sock:
+        assert not PortAllocator.is_free(sock.getsockname()[1])
+
+
+@pytest.mark.skipif(not ipv6_loopback(), reason="no IPv6 loopback on this machine")
+def test_port_listening_on_ipv6_loopback_is_busy():
+    with listen(socket.AF_INET6, '::1') as sock:
+        port = sock.getsockname()[1]
+        
+        assert not PortAllocator.is_free(port)
+
+
+def test_port_is_free_again_once_closed():
+    with listen(socket.AF_INET, '127.0.0.1') as sock:
+        port = sock.getsockname()[1]
+    
+    assert PortAllocator.is_free(port)
+
+
+def test_allocate_skips_reserved_and_busy_ports():
+    with listen(socket.AF_INET, '127.0.0.1') as sock:
+        busy = sock.getsockname()[1]
+        reserved = busy + 1
+        allocator = PortAllocator({'db': {'local_port': str(reserved)}}, port_range=(busy, busy + 10))
+        
+        port = allocator.allocate()
+    
+    assert port not in (busy, reserved)
+    assert busy < port <= busy + 10
@@ -0,0 +1,98 @@
+"""ProfileCatalog parsing of the AWS config and credentials files."""
+from ssm_port_forwarder import ProfileCatalog
+
+CONFIG = """\
+[profile sso-dev]
+sso_session = corp
+sso_account_id = 111111111111
+sso_role_name = Developer
+region = eu-west-1
+
+[profile sso-admin]
+sso_session = corp
+sso_start_url = https://admin.awsapps.com/start
+sso_account_id = 222222222222
+
+[profile legacy]
+sso_start_url = https://legacy.awsapps.com/start
+sso_region = us-west-2
+
+[sso-session corp]
+sso_start_url = https://corp.awsapps.com/start
+sso_region = us-east-1
+region = ap-southeast-2
+sso_account_id = 999999999999
+
+[default]
+region = us-east-1
+"""
+
+CREDENTIALS = """\
+[static]
+aws_access_key_id = AKIAEXAMPLE
+aws_secret_access_key = secret
+region = sa-east-1
+"""
+
+
+def catalog(home):
+    (home / 'config').write_text(CONFIG)
+    (home / 'credentials').write_text(CREDENTIALS)
+    return ProfileCatalog(str(home / 'profiles.json'), lambda path, data: open(path, 'wb').write(data))
+
+
+def test_profiles_inherit_start_url_and_sso_region_from_their_sso_session(home):
+    profiles = catalog(home).load()
+    
+    assert profiles['sso-dev']['sso_start_url'] == 'https://corp.awsapps.com/start'
+    assert profiles['sso-dev']['sso_region'] == 'us-east-1'
+    assert profiles['sso-dev']['sso_session'] == 'corp'
+
+
+def test_profile_values_win_over_the_sso_session(home):
+    profiles = catalog(home).load()
+    
+    assert profiles['sso-admin']['sso_start_url'] == 'https://admin.awsapps.com/start'
+    assert profiles['sso-dev']['region'] == 'eu-west-1'
+
+
+def test_only_sso_keys_are_inherited(home):
+    profiles = catalog(home).load()
+    
+    # region and sso_account_id of the [sso-session] block are not profile settings
+    assert 'region' not in profiles['sso-admin']
+    assert profiles['sso-admin']['sso_account_id'] == '222222222222'
+
+
+def test_legacy_sso_profiles_keep_their_own_keys(home):
+    profile = catalog(home).load()['legacy']
+    
+    assert profile['sso_start_url'] == 'https://legacy.awsapps.com/start'
+    assert profile['sso_region'] == 'us-west-2'
+    assert 'sso_session' not in profile
+
+
+def test_default_first_then_credentials_then_config(home):
+    profiles = catalog(home).load()
+    
+    assert list(profiles) == ['default', 'static', 'sso-dev', 'sso-admin', 'legacy']
+    assert profiles['static'] == {'sources': ['credentials'], 'region': 'sa-east-1'}
+    assert 'corp' not in profiles
+
+
+def test_changed_files_are_parsed_again(home):
+    profiles = catalog(home)
+    profiles.load()
+    
+    with open(home / 'config', 'a') as f:
+        f.write("\n[profile added]\nregion = eu-central-1\n")
+    
+    assert profiles.load()['added']['region'] == 'eu-central-1'
+
+
+def test_sso_token_file_follows_the_sso_session(forwarder, home):
+    catalog(home)
+    
+    assert forwarder.get_sso_token_file('sso-dev') == forwarder.get_sso_token_file('sso-admin')
+    assert forwarder.get_sso_token_file('sso-dev') != forwarder.get_sso_token_file('legacy')
+    assert forwarder.get_sso_token_file('static') is None
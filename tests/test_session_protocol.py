@@ -0,0 +1,277 @@
+"""Session Manager data channel framing, checked against fixed byte fixtures.
+
+The fixtures are laid out field by field from the session-manager-plugin
+ClientMessage format, so they do not depend on SessionDataChannel.HEADER.
+"""
+import asyncio
+import json
+import os
+from unittest import mock
+
+import ssm_port_forwarder
+from ssm_port_forwarder import SessionDataChannel, WebSocketClient
+
+CREATED_DATE = 1700000000
+AGENT_MESSAGE_ID = "b1b2b3b4-b5b6-b7b8-a1a2-a3a4a5a6a7a8"
+CLIENT_MESSAGE_ID = bytes.fromhex("00112233445566778899aabbccddeeff")
+
+HANDSHAKE_REQUEST_PAYLOAD = (
+    b'{"AgentVersion": "3.3.0.0", "RequestedClientActions": [{"ActionType": "SessionType", '
+    b'"ActionParameters": {"SessionType": "Port", "Properties": {}}}]}'
+)
+HANDSHAKE_REQUEST = bytes.fromhex(
+    "00000074"                                                          # header length, 116
+    "6f75747075745f73747265616d5f646174612020202020202020202020202020"  # "output_stream_data", space padded
+    "00000001"                                                          # schema version
+    "0000018bcfe56800"                                                  # created date, ms
+    "0000000000000000"                                                  # sequence number
+    "0000000000000000"                                                  # flags
+    "a1a2a3a4a5a6a7a8b1b2b3b4b5b6b7b8"                                  # message id, 8 byte halves swapped
+    "8754924c4b4bfcaf7a9649c07af584665e5aaa8906f88786688d0b01b3d18ccc"  # sha256 of the payload
+    "00000005"                                                          # payload type, handshake request
+    "00000095"                                                          # payload length
+) + HANDSHAKE_REQUEST_PAYLOAD
+
+HANDSHAKE_RESPONSE_PAYLOAD = (
+    b'{"ClientVersion": "1.0.0.0", "ProcessedClientActions": [{"ActionType": "SessionType", '
+    b'"ActionStatus": 1}], "Errors": []}'
+)
+HANDSHAKE_RESPONSE = bytes.fromhex(
+    "00000074"
+    "696e7075745f73747265616d5f64617461202020202020202020202020202020"  # "input_stream_data"
+    "00000001"
+    "0000018bcfe56800"
+    "0000000000000000"
+    "0000000000000000"
+    "00112233445566778899aabbccddeeff"
+    "84cf8e29d43d0b0904d992f893c1ac22636dda033e0bf0cdd5e5da5b6b9f0cf7"
+    "00000006"                                                          # payload type, handshake response
+    "00000078"
+) + HANDSHAKE_RESPONSE_PAYLOAD
+
+HANDSHAKE_COMPLETE = bytes.fromhex(
+    "00000074"
+    "6f75747075745f73747265616d5f646174612020202020202020202020202020"
+    "00000001"
+    "0000018bcfe56800"
+    "0000000000000001"                                                  # sequence number 1
+    "0000000000000000"
+    "c1c2c3c4c5c6c7c8d1d2d3d4d5d6d7d8"
+    "44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a"
+    "00000007"                                                          # payload type, handshake complete
+    "00000002"
+) + b"{}"
+
+ACKNOWLEDGE_PAYLOAD = (
+    b'{"AcknowledgedMessageType": "output_stream_data", "AcknowledgedMessageId": '
+    b'"b1b2b3b4-b5b6-b7b8-a1a2-a3a4a5a6a7a8", "AcknowledgedMessageSequenceNumber": 0, '
+    b'"IsSequentialMessage": true}'
+)
+ACKNOWLEDGE = bytes.fromhex(
+    "00000074"
+    "61636b6e6f776c65646765202020202020202020202020202020202020202020"  # "acknowledge"
+    "00000001"
+    "0000018bcfe56800"
+    "0000000000000000"
+    "0000000000000003"                                                  # flags, 3 for acknowledgements
+    "00112233445566778899aabbccddeeff"
+    "bce7a3dd59f1a41f462b3bac1b0602d5553cc5b74b57079cd70d3083e8bed61c"
+    "00000000"
+    "000000b7"
+) + ACKNOWLEDGE_PAYLOAD
+
+TERMINATE_SESSION = bytes.fromhex(
+    "00000074"
+    "696e7075745f73747265616d5f64617461202020202020202020202020202020"
+    "00000001"
+    "0000018bcfe56800"
+    "0000000000000001"                                                  # after the handshake response
+    "0000000000000000"
+    "00112233445566778899aabbccddeeff"
+    "433ebf5bc03dffa38536673207a21281612cef5faa9bc7a4d5b9be2fdb12cf1a"
+    "0000000a"                                                          # payload type, flag
+    "00000004"
+    "00000002"                                                          # TerminateSession
+)
+
+
+def fixed_identity():
+    """Make encode_message use a fixed message id and creation date"""
+    return mock.patch.multiple(
+        ssm_port_forwarder.os, urandom=mock.Mock(return_value=CLIENT_MESSAGE_ID)
+    ), mock.patch.object(ssm_port_forwarder.time, 'time', return_value=CREATED_DATE)
+
+
+class RecordingWebSocket:
+    """Websocket stand-in that replays agent messages and records what the channel sends"""
+    
+    def __init__(self, incoming):
+        self.incoming = list(incoming)
+        self.sent = []
+        self.closed = False
+        
+    async def send(self, data, opcode=WebSocketClient.OPCODE_BINARY):
+        self.sent.append(data)
+        
+    def send_nowait(self, messages, opcode=WebSocketClient.OPCODE_BINARY):
+        self.sent.extend(messages)
+        
+    async def recv(self):
+        return self.incoming.pop(0) if self.incoming else None
+        
+    async def close(self, code=b"\x03\xe8"):
+        self.closed = True
+
+
+def test_header_is_116_bytes():
+    assert SessionDataChannel.HEADER.size == 116
+
+
+def test_decode_handshake_request():
+    message = SessionDataChannel.decode_message(HANDSHAKE_REQUEST)
+    
+    assert message == {
+        'message_type': 'output_stream_data',
+        'schema_version': 1,
+        'created_date': CREATED_DATE * 1000,
+        'sequence_number': 0,
+        'flags': 0,
+        'message_id': AGENT_MESSAGE_ID,
+        'payload_type': SessionDataChannel.PAYLOAD_HANDSHAKE_REQUEST,
+        'payload': HANDSHAKE_REQUEST_PAYLOAD
+    }
+
+
+def test_decode_ignores_trailing_bytes():
+    message = SessionDataChannel.decode_message(HANDSHAKE_COMPLETE + b"garbage")
+    
+    assert message['payload'] == b"{}"
+    assert message['sequence_number'] == 1
+
+
+def test_decode_rejects_short_messages():
+    try:
+        SessionDataChannel.decode_message(HANDSHAKE_REQUEST[:119])
+    except ValueError:
+        return
+    raise AssertionError("A truncated header was decoded")
+
+
+def test_encode_handshake_response():
+    identity, clock = fixed_identity()
+    with identity, clock:
+        data = SessionDataChannel.encode_message(
+            SessionDataChannel.INPUT_STREAM_DATA, HANDSHAKE_RESPONSE_PAYLOAD,
+            payload_type=SessionDataChannel.PAYLOAD_HANDSHAKE_RESPONSE
+        )
+    assert data == HANDSHAKE_RESPONSE
+
+
+def test_acknowledge_payload_matches_json():
+    payload = SessionDataChannel.ACKNOWLEDGE_PAYLOAD % ('output_stream_data', AGENT_MESSAGE_ID, 0)
+    
+    assert payload.encode() == ACKNOWLEDGE_PAYLOAD
+    assert json.loads(payload) == {
+        'AcknowledgedMessageType': 'output_stream_data',
+        'AcknowledgedMessageId': AGENT_MESSAGE_ID,
+        'AcknowledgedMessageSequenceNumber': 0,
+        'IsSequentialMessage': True
+    }
+
+
+def test_handshake_and_terminate():
+    websocket = RecordingWebSocket([HANDSHAKE_REQUEST, HANDSHAKE_COMPLETE])
+    logged = []
+    channel = SessionDataChannel(websocket, logged.append)
+    
+    async def run():
+        channel.start()
+        await channel.agent_task
+        # Lets the queued acknowledgements flush
+        await asyncio.sleep(0)
+        complete = channel.handshake_complete.is_set()
+        await channel.send_input(b"\x00\x00\x00\x02", SessionDataChannel.PAYLOAD_FLAG)
+        return complete
+        
+    identity, clock = fixed_identity()
+    with identity, clock:
+        complete = asyncio.run(run())
+        
+    assert complete
+    assert logged == []
+    assert websocket.sent[0] == HANDSHAKE_RESPONSE
+    assert websocket.sent[1] == ACKNOWLEDGE
+    second_ack = SessionDataChannel.decode_message(websocket.sent[2])
+    assert second_ack['message_type'] == SessionDataChannel.ACKNOWLEDGE
+    assert json.loads(second_ack['payload'])['AcknowledgedMessageSequenceNumber'] == 1
+    assert websocket.sent[3] == TERMINATE_SESSION
+
+
+def test_unsupported_actions_are_refused():
+    websocket = RecordingWebSocket([])
+    logged = []
+    channel = SessionDataChannel(websocket, logged.append)
+    
+    asyncio.run(channel.handle_handshake({'RequestedClientActions': [{'ActionType': 'KMSEncryption'}]}))
+    
+    response = json.loads(SessionDataChannel.decode_message(websocket.sent[0])['payload'])
+    assert response['ProcessedClientActions'] == [
+        {'ActionType': 'KMSEncryption', 'ActionStatus': SessionDataChannel.ACTION_STATUS_FAILED}
+    ]
+    assert response['Errors'] and logged
+
+
+def test_output_is_delivered_in_sequence_order():
+    messages = [
+        SessionDataChannel.encode_message(SessionDataChannel.OUTPUT_STREAM_DATA, payload, sequence_number,
+                                          payload_type=SessionDataChannel.PAYLOAD_OUTPUT)
+        for sequence_number, payload in [(1, b"world"), (0, b"hello "), (0, b"hello ")]
+    ]
+    
+    class Writer:
+        def __init__(self):
+            self.data = b""
+            
+        def write(self, data):
+            self.data += data
+            
+        def is_closing(self):
+            return False
+            
+        async def drain(self):
+            pass
+            
+    writer = Writer()
+    channel = SessionDataChannel(RecordingWebSocket(messages), lambda message: None)
+    channel.client_writer = writer
+    
+    async def run():
+        channel.start()
+        await channel.agent_task
+        await asyncio.sleep(0)
+        
+    asyncio.run(run())
+    # The duplicate of sequence number 0 is acknowledged again but not delivered twice
+    assert writer.data == b"hello world"
+    assert len(channel.websocket.sent) == 3
+
+
+def test_masking_matches_rfc_6455_example():
+    # Section 5.7: a masked "Hello"
+    assert WebSocketClient.mask(b"Hello", bytes.fromhex("37fa213d")) == bytes.fromhex("7f9f4d5158")
+
+
+def test_masking_paths_agree():
+    masking_key = os.urandom(4)
+    for length in (1, 3, 4, 1000, 4095, 4096, 4097, 70000):
+        data = os.urandom(length)
+        expected = bytes(value ^ masking_key[index % 4] for index, value in enumerate(data))
+        assert WebSocketClient.mask(data, masking_key) == expected
+
+
+def test_frame_header_lengths():
+    websocket = WebSocketClient(None, None)
+    with mock.patch.object(ssm_port_forwarder.os, 'urandom', return_value=b"\x00\x00\x00\x00"):
+        assert websocket.frame(b"Hello", WebSocketClient.OPCODE_TEXT) == bytes.fromhex("818500000000") + b"Hello"
+        assert websocket.frame(b"x" * 126)[:4] == bytes.fromhex("82fe007e")
+        assert websocket.frame(b"x" * 65536)[:10] == bytes.fromhex("82ff0000000000010000")
@@ -0,0 +1,120 @@
+"""Encrypted connection store: legacy migration, re-encryption and stale keys."""
+import json
+import os
+
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+
+import ssm_port_forwarder
+from ssm_port_forwarder import LEGACY_KDF, KeyDerivation, SSMPortForwarder
+
+PASSWORD = "correct horse"
+# The cheapest parameters KeyDerivation.is_weak still accepts
+CHEAP_KDF = {'algorithm': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1}
+CONNECTION = {
+    'profile': 'dev',
+    'instance_id': 'i-0123456789abcdef0',
+    'remote_host': 'db.internal',
+    'remote_port': '5432',
+    'local_port': '15432'
+}
+
+
+@pytest.fixture(autouse=True)
+def cheap_defaults(monkeypatch):
+    """Keep new and upgraded stores quick to derive"""
+    monkeypatch.setitem(KeyDerivation.DEFAULTS, 'scrypt', CHEAP_KDF)
+
+
+@pytest.fixture
+def passwords(monkeypatch):
+    """Answer every password prompt with PASSWORD, counting the prompts"""
+    prompts = []
+    
+    def getpass(prompt=''):
+        prompts.append(prompt)
+        return PASSWORD
+    
+    monkeypatch.setattr(ssm_port_forwarder.getpass, 'getpass', getpass)
+    return prompts
+
+
+def create_store(forwarder, connections, kdf=CHEAP_KDF):
+    """Write a store directly, returns its key"""
+    salt = os.urandom(16)
+    key = KeyDerivation.derive(PASSWORD, salt, kdf)
+    forwarder.write_store(forwarder.store_dir, salt, key, connections, kdf)
+    return key
+
+
+def test_legacy_store_is_migrated_and_upgraded(forwarder, passwords):
+    """The single-file store becomes a per-record store and its weak key derivation is replaced"""
+    salt = os.urandom(16)
+    key = KeyDerivation.derive(PASSWORD, salt, LEGACY_KDF)
+    with open(forwarder.key_file, 'wb') as f:
+        f.write(salt)
+    with open(forwarder.connections_file, 'wb') as f:
+        f.write(Fernet(key).encrypt(json.dumps({'db': CONNECTION}).encode()))
+    
+    forwarder.load_connections()
+    
+    assert forwarder.connections == {'db': CONNECTION}
+    assert forwarder.store_exists()
+    assert forwarder.get_store_kdf() == CHEAP_KDF
+    assert not os.path.exists(forwarder.connections_file)
+    assert not os.path.exists(forwarder.connections_file + ".migrated")
+    assert not os.path.exists(forwarder.key_file)
+    
+    reopened = SSMPortForwarder()
+    reopened.load_connections()
+    assert reopened.connections == {'db': CONNECTION}
+
+
+def test_weak_store_is_upgraded_on_load(forwarder, passwords):
+    create_store(forwarder, {'db': CONNECTION}, kdf=dict(LEGACY_KDF))
+    
+    forwarder.load_connections()
+    
+    assert forwarder.connections == {'db': CONNECTION}
+    assert not KeyDerivation.is_weak(forwarder.get_store_kdf())
+
+
+def test_rekey_store_replaces_the_key(forwarder, passwords):
+    old_key = create_store(forwarder, {'db': CONNECTION, 'cache': dict(CONNECTION, local_port='16379')})
+    kdf = {'algorithm': 'pbkdf2', 'iterations': 310000}
+    
+    forwarder.rekey_store(old_key, PASSWORD, kdf)
+    
+    assert forwarder.get_store_kdf() == kdf
+    with pytest.raises(InvalidToken):
+        forwarder.verify_key(old_key)
+    forwarder.verify_key(forwarder.encryption_key)
+    assert set(forwarder.read_records(forwarder.encryption_key)) == {'db', 'cache'}
+    assert not os.path.exists(forwarder.store_dir + ".new")
+    assert not os.path.exists(forwarder.store_dir + ".old")
+
+
+def test_rekey_store_refuses_a_stale_key(forwarder, passwords):
+    create_store(forwarder, {'db': CONNECTION})
+    stale_key = Fernet.generate_key()
+    
+    with pytest.raises(InvalidToken):
+        forwarder.rekey_store(stale_key, PASSWORD, CHEAP_KDF)
+    assert forwarder.get_store_kdf() == CHEAP_KDF
+
+
+def test_writable_store_asks_again_after_another_session_rekeyed(forwarder, passwords):
+    """A save with a key from before a re-encryption derives the new key instead of writing unreadable records"""
+    key = create_store(forwarder, {'db': CONNECTION})
+    forwarder.connections = {'db': CONNECTION}
+    forwarder.encryption_key = key
+    
+    other = SSMPortForwarder()
+    other.rekey_store(key, PASSWORD, {'algorithm': 'pbkdf2', 'iterations': 310000})
+    
+    forwarder.connections['cache'] = dict(CONNECTION, local_port='16379')
+    assert forwarder.save_connection('cache')
+    
+    assert len(passwords) == 1
+    assert forwarder.encryption_key == other.encryption_key
+    assert set(other.read_records(other.encryption_key)) == {'db', 'cache'}